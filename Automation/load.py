@@ -25,6 +25,7 @@ import logging
 import pprint
 import operator
 import datetime
+import collections
 import pynliner
 from multiprocessing.pool import ThreadPool
 
@@ -39,71 +40,139 @@ import sender
 from config import config
 
 import psi_ops
-
-def check_load_on_host(host):
+import psi_ops_deploy
+
+# Each host check is a single SSH exec of the host probe, so hosts are mostly
+# waiting on the network and many can be checked at once
+CHECK_HOST_THREAD_COUNT = 100
+
+HostLoad = collections.namedtuple(
+    'HostLoad',
+    'users, load, free, free_swap, disk_load, process_alerts')
+
+FAILED_HOST_LOAD = HostLoad(-1, -1, -1, -1, -1, '')
+
+# Output of the host check command on hosts without psi_host_probe.py
+HOST_PROBE_MISSING = 'host probe missing'
+
+
+def get_processes_to_check(host, host_servers):
+    processes_to_check = ['cron', 'rsyslogd', 'fail2ban-server', 'ntpd', 'systemctl']
+    legacy_process = ['psi_web.py', 'redis-server', 'badvpn-udpgw', 'xinetd']
+    if host.is_TCS:
+        processes_to_check.append('docker')
+    else:
+        processes_to_check = processes_to_check + legacy_process
+
+        if host.meek_server_port:
+            processes_to_check.append('meek-server')
+        if any(server.capabilities['VPN'] for server in host_servers):
+            processes_to_check.append('xl2tpd')
+    return processes_to_check
+
+
+def get_process_alerts(processes_to_check, process_counts, host_servers):
+    process_alerts = []
+    for process in processes_to_check:
+        instances = process_counts[process]
+        if process == 'cron':
+            alert = instances < 1
+        elif process == 'xl2tpd':
+            alert = instances != len(host_servers)
+        elif process == 'systemctl':
+            alert = instances > 0
+        else:
+            alert = instances != 1
+        if alert:
+            process_alerts.append(process)
+    return process_alerts
+
+
+def probe_host(psinet, host, processes_to_check):
+    # Returns the psi_host_probe.py metrics for the host. Hosts which don't
+    # have the probe yet (it's installed with the implementation, or by
+    # deploy_host_probe) are checked with shell commands instead.
+    output = psinet.run_command_on_host(host, 'if [ -f %s ]; then python %s %s; else echo %s; fi' % (
+                psi_ops_deploy.HOST_PROBE_FILE_NAME,
+                psi_ops_deploy.HOST_PROBE_FILE_NAME,
+                ' '.join(processes_to_check),
+                HOST_PROBE_MISSING))
+    if output.strip() == HOST_PROBE_MISSING:
+        return probe_host_with_commands(psinet, host, processes_to_check)
+    try:
+        return json.loads(output)
+    except ValueError:
+        raise Exception('unexpected host probe output: %s' % (output[:100],))
+
+
+def probe_host_with_commands(psinet, host, processes_to_check):
+    # The psi_host_probe.py metrics, from the same sources. All of the
+    # commands run at once over the host's one SSH connection.
+    (users, load, cpu_count, memory_free, swap_free, disk_used, process_counts) = psinet.run_commands_on_host(host, [
+        'echo $(ifconfig | grep ppp | wc -l) $(ps ax | grep ssh | grep "[p]siphon" | wc -l)',
+        'cut -d " " -f 1-3 /proc/loadavg',
+        'grep -c ^processor /proc/cpuinfo',
+        'awk \'/^MemTotal:/ {total = $2} /^(MemFree|Buffers|Cached):/ {free += $2} END {print free / total * 100.0}\' /proc/meminfo',
+        'awk \'/^SwapTotal:/ {total = $2} /^SwapFree:/ {free = $2} END {if (total == 0) {print 0} else {print free / total * 100.0}}\' /proc/meminfo',
+        'df -P / | tail -n 1 | awk \'{if ($2 == 0) {print 0} else {print $3 / $2 * 100.0}}\'',
+        '; '.join(['pgrep -xc ' + process for process in processes_to_check])])
+    vpn_users, ssh_processes = users.split()
+    return {
+        'vpn_users': int(vpn_users),
+        # Each SSH user has a privileged and an unprivileged sshd process
+        'ssh_users': int(ssh_processes) // 2,
+        'load': [float(value) for value in load.split()],
+        'cpu_count': int(cpu_count),
+        'memory_free_percent': float(memory_free),
+        'swap_free_percent': float(swap_free),
+        'disk_used_percent': float(disk_used),
+        'process_counts': dict(zip(processes_to_check, [int(count) for count in process_counts.split()]))
+    }
+
+
+def check_load_on_host(psinet, host, host_servers):
     try:
         log_diagnostics('checking host: %s' % (host.id))
-        users = g_psinet._PsiphonNetwork__count_users_on_host(host.id)
-        load_metrics = g_psinet.run_command_on_host(host,
-            'uptime | cut -d , -f 4 | cut -d : -f 2; grep "model name" /proc/cpuinfo | wc -l').split('\n')
-        load_threshold = 4.0 * float(load_metrics[1].strip()) - 1
-        load = str(float(load_metrics[0].strip())/load_threshold * 100.0)
-        free = g_psinet.run_command_on_host(host, 'free | grep "buffers/cache" | awk \'{print $4/($3+$4) * 100.0}\'')
-        free_swap = g_psinet.run_command_on_host(host, 'free | grep "Swap" | awk \'{if ($2 == 0) {print 0} else {print $4/$2 * 100.0}}\'')
-        disk_load = g_psinet.run_command_on_host(host, 'df -hT / | grep "/" | awk \'{if ($4 == 0) {print 0} else {print $4/$3 * 100.0}}\'')
-        processes_to_check = ['cron', 'rsyslogd', 'fail2ban-server', 'ntpd', 'systemctl']
-        legacy_process = ['psi_web.py', 'redis-server', 'badvpn-udpgw', 'xinetd']
-        vpn_servers = [server.host_id for server in g_psinet.get_servers() if server.host_id == host.id and server.capabilities['VPN'] == True]
-        if host.is_TCS:
-            processes_to_check.append('docker')
-        else:
-            processes_to_check = processes_to_check + legacy_process
-
-            if host.meek_server_port:
-                processes_to_check.append('meek-server')
-            if len(vpn_servers) > 0:
-                processes_to_check.append('xl2tpd')
-
-        process_counts = g_psinet.run_command_on_host(host,
-            '; '.join(['pgrep -xc ' + process for process in processes_to_check])).split('\n')
-        process_alerts = []
-        for index, process in enumerate(processes_to_check):
-            alert = False
-            instances = int(process_counts[index])
-            if process == 'cron':
-                alert = instances < 1
-            elif process == 'xl2tpd':
-                alert = instances != len([server.id for server in g_psinet.get_servers() if server.host_id == host.id])
-            elif process == 'systemctl':
-                alert = instances > 0
-            else:
-                alert = instances != 1
-            if alert:
-                process_alerts.append(process)
-        return (host.id, users, load, free.rstrip(), free_swap.rstrip(), disk_load.rstrip(), ', '.join(process_alerts))
+        processes_to_check = get_processes_to_check(host, host_servers)
+        metrics = probe_host(psinet, host, processes_to_check)
+        load_threshold = 4.0 * metrics['cpu_count'] - 1
+        return host.id, HostLoad(
+                    metrics['vpn_users'] + metrics['ssh_users'],
+                    metrics['load'][0] / load_threshold * 100.0,
+                    metrics['memory_free_percent'],
+                    metrics['swap_free_percent'],
+                    metrics['disk_used_percent'],
+                    ', '.join(get_process_alerts(processes_to_check, metrics['process_counts'], host_servers)))
     except Exception as e:
         log_diagnostics('failed host: %s %s' % (host.id, str(e)))
-        return (host.id, -1, -1, -1, -1, -1, '')
+        return host.id, FAILED_HOST_LOAD
 
 # TODO: print if server is discovery or propagation etc
 def check_load_on_hosts(psinet, hosts):
-    loads = {}
+    hosts = list(hosts)
+    servers_by_host = collections.defaultdict(list)
+    for server in psinet.get_servers():
+        servers_by_host[server.host_id].append(server)
+
+    def do_check_load_on_host(host):
+        return check_load_on_host(psinet, host, servers_by_host[host.id])
 
-    pool = ThreadPool(25)
-    global g_psinet
-    g_psinet = psinet
+    pool = ThreadPool(min(CHECK_HOST_THREAD_COUNT, max(len(hosts), 1)))
     log_diagnostics('Checking Hosts...')
-    results = pool.map(check_load_on_host, hosts)
+    results = dict(pool.map(do_check_load_on_host, hosts))
     log_diagnostics('...done checking hosts')
 
-    # retry failed hosts
-    failed_hosts = [psinet._PsiphonNetwork__hosts[result[0]] for result in results if result[1] == -1 or result[5]]
-    if len(failed_hosts):
+    # Retry unreachable hosts and hosts with process alerts, as processes
+    # may have been restarting
+    hosts_to_retry = [host for host in hosts
+                      if results[host.id] == FAILED_HOST_LOAD or results[host.id].process_alerts]
+    if len(hosts_to_retry):
         log_diagnostics('Retrying failed hosts')
-    new_results = pool.map(check_load_on_host, failed_hosts)
+        results.update(pool.map(do_check_load_on_host, hosts_to_retry))
+    pool.close()
 
-    for result in results + new_results:
-        loads[result[0]] = result[1:]
+    # Plain tuples, as the results log is read back with ast.literal_eval
+    loads = dict((host_id, tuple(host_load)) for host_id, host_load in results.iteritems())
 
     cur_users = sum([load[0] for load in loads.itervalues() if load[0] > 0])
     unreachable_hosts = len([load for load in loads.itervalues() if load[0] == -1])
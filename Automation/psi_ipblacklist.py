@@ -19,12 +19,15 @@
 
 import os
 import re
+import hashlib
+import shlex
+import socket
+import struct
 import subprocess
 import sys
 import urllib
 import urllib2
 
-EXECUTABLE = 00744
 BASE_PATH = '/usr/local/share/PsiphonV'
 BLACKLIST_DIR = 'malware_blacklist'
 IPSET_DIR = os.path.abspath(os.path.join(BASE_PATH, BLACKLIST_DIR, 'ipset'))
@@ -32,6 +35,16 @@ LIST_DIR = os.path.abspath(os.path.join(BASE_PATH, BLACKLIST_DIR, 'lists'))
 
 LISTS_URL = 'https://s3.amazonaws.com/p3_malware_lists/'
 
+# Lists are loaded into a temporary set with ipset restore, which is then
+# swapped with the set used by iptables, so the set is never partly loaded
+IPSET_TYPE = 'hash:net'
+IPSET_HASH_SIZE = 1024
+IPSET_MAX_ELEMENTS = 65536
+IPSET_MAX_SET_NAME_LENGTH = 31
+IPSET_TEMPORARY_SET_SUFFIX = '_tmp'
+
+IPV4_NETWORK_REGEX = re.compile(r'^\d{1,3}(\.\d{1,3}){3}(/\d{1,2})?$')
+
 
 def apply_local_lists(mal_lists, list_dir=LIST_DIR):
     """Check if there is a local list. One that is not published. Apply it."""
@@ -106,30 +119,145 @@ def parse_ip_list(raw_list_filename, read_mode):
     return blackhole_list
 
 
-# Create the ipset script which includes creating the set name and blocklist
-# which is stored in a file for execution
+def parse_network(entry):
+    """Parse an IPv4 address or CIDR block into (network, prefix length)."""
+    if not IPV4_NETWORK_REGEX.match(entry):
+        raise ValueError(entry)
+    address, _, prefix_length = entry.partition('/')
+    prefix_length = int(prefix_length) if prefix_length else 32
+    if prefix_length > 32:
+        raise ValueError(entry)
+    try:
+        network = struct.unpack('!I', socket.inet_aton(address))[0]
+    except socket.error:
+        raise ValueError(entry)
+    mask = (0xFFFFFFFF << (32 - prefix_length)) & 0xFFFFFFFF
+    return network & mask, prefix_length
+
+
+def format_network(network, prefix_length):
+    address = socket.inet_ntoa(struct.pack('!I', network))
+    if prefix_length == 32:
+        return address
+    return '%s/%d' % (address, prefix_length)
+
+
+def aggregate_networks(networks):
+    """Merge networks into the fewest CIDR blocks covering the same addresses."""
+    ranges = sorted((network, network + (1 << (32 - prefix_length)) - 1)
+                    for network, prefix_length in networks)
+    merged_ranges = []
+    for first, last in ranges:
+        if merged_ranges and first <= merged_ranges[-1][1] + 1:
+            merged_ranges[-1][1] = max(merged_ranges[-1][1], last)
+        else:
+            merged_ranges.append([first, last])
+
+    blocks = []
+    for first, last in merged_ranges:
+        while first <= last:
+            # The largest block starting at first which fits in the range.
+            # hash:net doesn't take /0.
+            size = min(first & -first, 1 << 31) if first else 1 << 31
+            while size > last - first + 1:
+                size >>= 1
+            blocks.append((first, 33 - size.bit_length()))
+            first += size
+    return blocks
+
+
+def get_temporary_set_name(set_name):
+    return set_name[:IPSET_MAX_SET_NAME_LENGTH - len(IPSET_TEMPORARY_SET_SUFFIX)] + IPSET_TEMPORARY_SET_SUFFIX
+
+
+# Create the ipset restore commands which load the blocklist into a temporary
+# set, and are stored in a file for apply_ipset_list
 def create_ipset_commands(tracker):
-    """Create the ipset name and add elements of the list."""
-    ipset_base = ["ipset -N %s iphash" % str(tracker['set_name']),
-                  "ipset -F %s" % str(tracker['set_name'])]
+    """Create the temporary set and add the aggregated elements of the list."""
+    networks = []
+    for entry in tracker['ip_list']:
+        try:
+            networks.append(parse_network(entry))
+        except ValueError:
+            # ipset restore stops at the first bad line
+            print 'Skipping invalid entry in %s: %s' % (tracker['set_name'], entry)
+    blocks = aggregate_networks(networks)
+    temporary_set_name = get_temporary_set_name(str(tracker['set_name']))
+    ipset_base = ["create %s %s family inet hashsize %d maxelem %d" % (
+                    temporary_set_name, IPSET_TYPE, IPSET_HASH_SIZE, max(IPSET_MAX_ELEMENTS, len(blocks)))]
     tracker['ipset_rules'] = ipset_base + \
-        ["ipset -A %s %s" % (str(tracker['set_name']), str(ip)) for ip in tracker['ip_list']]
+        ["add %s %s" % (temporary_set_name, format_network(*block)) for block in blocks]
 
 
 def write_ipset_list_file(tracker):
-    """Create an .ipset file for loading the list into iptables."""
+    """Create an .ipset file for loading the list with ipset restore."""
     script = os.path.join(IPSET_DIR, tracker['ipset_file'])
     subprocess.call(['mkdir', '-p', IPSET_DIR])
+    content = ''.join('%s\n' % rule for rule in tracker['ipset_rules'])
+    previous_digest = None
+    if os.path.isfile(script):
+        with open(script) as f:
+            previous_digest = hashlib.sha1(f.read()).hexdigest()
+    tracker['ipset_changed'] = hashlib.sha1(content).hexdigest() != previous_digest
     with open(script, 'w') as f:
-        for rule in tracker['ipset_rules']:
-            f.write('%s\n' % rule)
-    os.chmod(script, EXECUTABLE)  # Make the file world readable.
+        f.write(content)
+
+
+def get_ipset_type(set_name):
+    """Return the type of the set, or None if it doesn't exist."""
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(['ipset', 'list', '-t', set_name],
+                                   stdout=subprocess.PIPE, stderr=devnull)
+        output = process.communicate()[0]
+    if process.returncode != 0:
+        return None
+    match = re.search(r'^Type: (\S+)', output, re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def remove_iptables_references(set_name):
+    """Delete the iptables rules which match the set."""
+    process = subprocess.Popen(['iptables', '-S'], stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    for rule in output.split('\n'):
+        if rule.startswith('-A ') and ('--match-set %s ' % (set_name,)) in rule:
+            subprocess.call(['iptables', '-D'] + shlex.split(rule)[1:])
 
 
 def apply_ipset_list(tracker):
-    """Run the .ipset file which creates the list to be used by iptables."""
+    """Load the .ipset file and swap it in as the set used by iptables."""
     script = os.path.join(IPSET_DIR, tracker['ipset_file'])
-    subprocess.call(script, shell=True)
+    set_name = str(tracker['set_name'])
+    temporary_set_name = get_temporary_set_name(set_name)
+
+    current_type = get_ipset_type(set_name)
+    if current_type == IPSET_TYPE and not tracker.get('ipset_changed', True):
+        print 'List %s is unchanged' % (set_name,)
+        return
+
+    with open(os.devnull, 'w') as devnull:
+        # Left over if an earlier run failed
+        subprocess.call(['ipset', 'destroy', temporary_set_name], stderr=devnull)
+    with open(script) as f:
+        if subprocess.call(['ipset', 'restore'], stdin=f) != 0:
+            print 'Failed to load list %s' % (set_name,)
+            subprocess.call(['ipset', 'destroy', temporary_set_name])
+            # So the next run doesn't skip it as unchanged
+            os.remove(script)
+            return
+
+    if current_type is None:
+        subprocess.call(['ipset', 'rename', temporary_set_name, set_name])
+    elif current_type != IPSET_TYPE:
+        # Sets created by earlier versions of this script are iphash, and
+        # can't be swapped with hash:net. A set can't be destroyed while
+        # iptables uses it; the caller adds the rules back.
+        remove_iptables_references(set_name)
+        subprocess.call(['ipset', 'destroy', set_name])
+        subprocess.call(['ipset', 'rename', temporary_set_name, set_name])
+    else:
+        subprocess.call(['ipset', 'swap', temporary_set_name, set_name])
+        subprocess.call(['ipset', 'destroy', temporary_set_name])
 
 
 def modify_iptables(tracker, opt, chain, flags="dst", job='-j DROP'):
@@ -36,6 +36,10 @@ import zlib
 import copy
 import subprocess
 import traceback
+import bisect
+import time
+import hashlib
+import multiprocessing
 from pkg_resources import parse_version
 from multiprocessing.pool import ThreadPool
 from collections import defaultdict
@@ -148,6 +152,15 @@ WEBSITE_GENERATION_DIR = './website-out'
 EMAIL_RESPONDER_CONFIG_BUCKET_KEY = 'EmailResponder/conf.json'
 
 
+# Number of hosts for which compartmentalized data is rendered at once in deploy()
+DEPLOY_DATA_BATCH_SIZE = 40
+
+# Number of hosts on which users are counted at once, and how long the counts
+# are reused for (so a prune run doesn't count the same host twice)
+COUNT_USERS_THREAD_COUNT = 50
+COUNT_USERS_CACHE_SECONDS = 10*60
+
+
 # NOTE: update compartmentalize() functions when adding fields
 
 PropagationChannel = psi_utils.recordtype(
@@ -339,6 +352,9 @@ CLIENT_PLATFORM_ANDROID = 'Android'
 
 class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
+    transient_attributes = ('_PsiphonNetwork__handshake_index',
+                            '_PsiphonNetwork__user_counts')
+
     def __init__(self, initialize_plugins=True):
         super(PsiphonNetwork, self).__init__()
         # TODO: what is this __version for?
@@ -368,6 +384,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         self.__elastichosts_accounts = []
         self.__deploy_implementation_required_for_hosts = set()
         self.__deploy_data_required_for_all = False
+        self.__deployed_data_hashes = {}
+        self.__legacy_data_format_hosts = set()
         self.__deploy_builds_required_for_campaigns = {
             CLIENT_PLATFORM_WINDOWS: set(),
             CLIENT_PLATFORM_ANDROID: set()
@@ -395,7 +413,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         if initialize_plugins:
             self.initialize_plugins()
 
-    class_version = '0.37'
+    class_version = '0.38'
 
     def upgrade(self):
         if cmp(parse_version(self.version), parse_version('0.1')) < 0:
@@ -633,6 +651,17 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             self.__TCS_psiphond_config_values = {}
 
             self.version = '0.37'
+        if cmp(parse_version(self.version), parse_version('0.38')) < 0:
+            self.__deployed_data_hashes = {}
+            # Legacy hosts must get the implementation with psi_ops_serializer.py
+            # before they can read data in its format. Until then, they get
+            # jsonpickle data.
+            self.__legacy_data_format_hosts = set()
+            for host in self.__hosts.itervalues():
+                if not host.is_TCS:
+                    self.__legacy_data_format_hosts.add(host.id)
+                    self.__deploy_implementation_required_for_hosts.add(host.id)
+            self.version = '0.38'
 
     def initialize_plugins(self):
         for plugin in plugins:
@@ -1381,11 +1410,52 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         #self.save()
 
     def __count_users_on_host(self, host_id):
-        vpn_users = int(self.run_command_on_host(self.__hosts[host_id],
-                                                 'ifconfig | grep ppp | wc -l'))
-        ssh_users = int(self.run_command_on_host(self.__hosts[host_id],
-                                                 'ps ax | grep ssh | grep psiphon | wc -l')) / 2
-        return vpn_users + ssh_users
+        # VPN users each have a ppp interface, and SSH users two sshd processes.
+        # Both are counted by one command; "[p]siphon" keeps the grep, and the
+        # shell running the command, from matching themselves.
+        (vpn_users, ssh_processes) = self.run_command_on_host(self.__hosts[host_id],
+                'echo $(ifconfig | grep ppp | wc -l) $(ps ax | grep ssh | grep "[p]siphon" | wc -l)').split()
+        return int(vpn_users) + int(ssh_processes) / 2
+
+    def count_users_on_hosts(self, host_ids, max_age_in_seconds=COUNT_USERS_CACHE_SECONDS):
+        '''
+        Returns {host ID: user count}. Hosts are counted in parallel, and counts
+        made in the last max_age_in_seconds are reused. Hosts which can't be
+        counted are left out.
+        '''
+        if getattr(self, '_PsiphonNetwork__user_counts', None) is None:
+            self.__user_counts = {}
+
+        now = time.time()
+        user_counts = {}
+        uncounted_host_ids = []
+        for host_id in set(host_ids):
+            cached = self.__user_counts.get(host_id)
+            if cached and now - cached[0] < max_age_in_seconds:
+                user_counts[host_id] = cached[1]
+            else:
+                uncounted_host_ids.append(host_id)
+
+        def do_count_users_on_host(host_id):
+            try:
+                return host_id, self.__count_users_on_host(host_id)
+            except Exception as e:
+                print 'Failed to count users on host %s: %s' % (host_id, str(e))
+                return host_id, None
+
+        if uncounted_host_ids:
+            pool = ThreadPool(min(COUNT_USERS_THREAD_COUNT, len(uncounted_host_ids)))
+            try:
+                results = pool.map(do_count_users_on_host, uncounted_host_ids)
+            finally:
+                pool.close()
+            counted_time = time.time()
+            for host_id, user_count in results:
+                if user_count is not None:
+                    user_counts[host_id] = user_count
+                    self.__user_counts[host_id] = (counted_time, user_count)
+
+        return user_counts
 
     def __upgrade_host_datacenter_names(self):
         if self.__linode_account.api_key:
@@ -1399,8 +1469,12 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
     def __prune_servers(self, servers):
         number_removed = 0
         number_disabled = 0
+        users_on_hosts = self.count_users_on_hosts([server.host_id for server in servers])
         for server in servers:
-            users_on_host = self.__count_users_on_host(server.host_id)
+            users_on_host = users_on_hosts.get(server.host_id)
+            if users_on_host is None:
+                # Unreachable; leave it for the next prune
+                continue
             if users_on_host <= 10:
                 self.remove_host(server.host_id)
                 number_removed += 1
@@ -1530,10 +1604,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             if host.is_TCS:
                 server.capabilities['ssh-api-requests'] = True
 
-        psi_ops_deploy.deploy_data(
-                            host,
-                            self.__compartmentalize_data_for_host(host.id, host.is_TCS),
-                            self.__TCS_traffic_rules_set)
+        self.__deploy_data_to_host(host)
 
         for server in servers_on_host:
             self.test_server(server.id, ['handshake'])
@@ -1581,10 +1652,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         psi_ops_install.install_firewall_rules(host, servers, plugins, False) # No need to update the malware blacklist
         psi_ops_install.install_psi_limit_load(host, servers)
         psi_ops_deploy.deploy_implementation(host, servers, self.__discovery_strategy_value_hmac_key, plugins, self.__TCS_psiphond_config_values)
-        psi_ops_deploy.deploy_data(
-                            host,
-                            self.__compartmentalize_data_for_host(host.id, host.is_TCS),
-                            self.__TCS_traffic_rules_set)
+        self.__legacy_data_format_hosts.discard(host.id)
+        self.__deploy_data_to_host(host)
 
     def setup_server(self, host, servers):
         # Install Psiphon 3 and generate configuration values
@@ -1612,10 +1681,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # Deploy will upload web server source database data and client builds
         # (Only deploying for the new host, not broadcasting info yet...)
         psi_ops_deploy.deploy_implementation(host, servers, self.__discovery_strategy_value_hmac_key, plugins, self.__TCS_psiphond_config_values)
-        psi_ops_deploy.deploy_data(
-                            host,
-                            self.__compartmentalize_data_for_host(host.id, host.is_TCS),
-                            self.__TCS_traffic_rules_set)
+        self.__legacy_data_format_hosts.discard(host.id)
+        self.__deploy_data_to_host(host)
         psi_ops_deploy.deploy_geoip_database_autoupdates(host)
         psi_ops_deploy.deploy_routes(host)
         host.log('initial deployment')
@@ -1875,6 +1942,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # Clear flags that include this host id.  Update stats config.
         if host.id in self.__deploy_implementation_required_for_hosts:
             self.__deploy_implementation_required_for_hosts.remove(host.id)
+        self.__legacy_data_format_hosts.discard(host.id)
         self.__deploy_stats_config_required = True
         # NOTE: If host was currently discoverable or will be in the future,
         #       host data should be updated.
@@ -1889,14 +1957,12 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         servers = [server for server in self.__servers.itervalues() if server.host_id == host_id]
         psi_ops_install.install_host(host, servers, self.get_existing_server_ids(), plugins)
         psi_ops_deploy.deploy_implementation(host, servers, self.__discovery_strategy_value_hmac_key, plugins, self.__TCS_psiphond_config_values)
+        self.__legacy_data_format_hosts.discard(host.id)
         # New data might have been generated
         # NOTE that if the client version has been incremented but a full deploy has not yet been run,
         # this following psi_ops_deploy.deploy_data call is not safe.  Data will specify a new version
         # that is not yet available on servers (infinite download loop).
-        psi_ops_deploy.deploy_data(
-                            host,
-                            self.__compartmentalize_data_for_host(host.id, host.is_TCS),
-                            self.__TCS_traffic_rules_set)
+        self.__deploy_data_to_host(host)
         host.log('reinstall')
 
     def reinstall_hosts(self):
@@ -2196,6 +2262,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         hosts = [self.__hosts[host_id] for host_id in self.__deploy_implementation_required_for_hosts]
         psi_ops_deploy.deploy_implementation_to_hosts(hosts, self.__discovery_strategy_value_hmac_key, plugins, self.__TCS_psiphond_config_values)
+        self.__legacy_data_format_hosts.difference_update(host.id for host in hosts)
 
         if len(self.__deploy_implementation_required_for_hosts) > 0:
             self.__deploy_implementation_required_for_hosts.clear()
@@ -2345,10 +2412,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # Host data
 
         if self.__deploy_data_required_for_all:
-            psi_ops_deploy.deploy_data_to_hosts(
-                self.get_hosts(),
-                self.__compartmentalize_data_for_host,
-                self.__TCS_traffic_rules_set)
+            self.__deploy_data_to_all_hosts()
             self.__deploy_data_required_for_all = False
             self.save()
 
@@ -2422,6 +2486,9 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         psi_routes.make_routes()
         psi_ops_deploy.deploy_routes_to_hosts(self.__hosts.values())
 
+    def deploy_host_probe(self):
+        psi_ops_deploy.deploy_host_probe_to_hosts(self.__hosts.values())
+
     def update_external_signed_routes(self):
         psi_routes.make_signed_routes(
                 self.get_routes_signing_key_pair().pem_key_pair,
@@ -2585,10 +2652,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         host = filter(lambda x: x.id == server.host_id, self.__hosts.itervalues())[0]
         servers = [server for server in self.__servers.itervalues() if server.host_id == host.id]
         psi_ops_deploy.deploy_implementation(host, servers, self.__discovery_strategy_value_hmac_key, plugins, self.__TCS_psiphond_config_values)
-        psi_ops_deploy.deploy_data(
-            host,
-            self.__compartmentalize_data_for_host(host.id, host.is_TCS),
-            self.__TCS_traffic_rules_set)
+        self.__legacy_data_format_hosts.discard(host.id)
+        self.__deploy_data_to_host(host)
 
     def deploy_implementation_and_data_for_propagation_channel(self, propagation_channel_name):
         propagation_channel = self.get_propagation_channel_by_name(propagation_channel_name)
@@ -2596,6 +2661,83 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         for server in servers:
             self.deploy_implementation_and_data_for_host_with_server(server.id)
 
+    def __get_deployed_data_hash(self, host, host_data):
+        data_hash = hashlib.sha256(host_data)
+        if host.is_TCS:
+            # Traffic rules are deployed along with the data
+            data_hash.update(str(self.__TCS_traffic_rules_set))
+        return data_hash.hexdigest()
+
+    def __deploy_data_to_host(self, host):
+        host_data = self.__compartmentalize_data_for_host(host.id, host.is_TCS)
+        servers = [server for server in self.__servers.itervalues() if server.host_id == host.id]
+        psi_ops_deploy.deploy_data(host, host_data, self.__TCS_traffic_rules_set, servers)
+        self.__deployed_data_hashes[host.id] = self.__get_deployed_data_hash(host, host_data)
+
+    def __deploy_data_to_all_hosts(self):
+        # The host-independent parts of the compartmentalized data are computed
+        # once; per-host data is rendered in a process pool, as that is CPU bound.
+        # Hosts whose data hasn't changed since it was last deployed are skipped.
+        # Hosts are processed in batches to bound the amount of rendered data
+        # held in memory.
+
+        hosts = self.get_hosts()
+
+        for host_id in self.__deployed_data_hashes.keys():
+            if host_id not in self.__hosts:
+                del self.__deployed_data_hashes[host_id]
+
+        common_data = self.__get_compartmentalized_common_data(datetime.datetime.now())
+
+        servers_by_host = {}
+        for server in self.__servers.itervalues():
+            servers_by_host.setdefault(server.host_id, []).append(server)
+
+        pool = multiprocessing.Pool(
+                    initializer=_initialize_compartmentalized_data_worker,
+                    initargs=(common_data,))
+        deploy_error = None
+        try:
+            for index in range(0, len(hosts), DEPLOY_DATA_BATCH_SIZE):
+                batch = hosts[index:index + DEPLOY_DATA_BATCH_SIZE]
+                rendered_data = {}
+                rendered_data_hashes = {}
+                for host_id, host_data in pool.imap_unordered(
+                        _render_compartmentalized_data_for_host,
+                        [(batch_host.id, batch_host.is_TCS, batch_host.id in self.__legacy_data_format_hosts)
+                         for batch_host in batch]):
+                    host = self.__hosts[host_id]
+                    data_hash = self.__get_deployed_data_hash(host, host_data)
+                    if self.__deployed_data_hashes.get(host_id) == data_hash:
+                        continue
+                    rendered_data[host_id] = host_data
+                    rendered_data_hashes[host_id] = data_hash
+
+                print 'deploy data: %d of %d hosts in batch unchanged' % (
+                        len(batch) - len(rendered_data), len(batch))
+
+                def deployed(host):
+                    self.__deployed_data_hashes[host.id] = rendered_data_hashes[host.id]
+
+                try:
+                    psi_ops_deploy.deploy_data_to_hosts(
+                        [batch_host for batch_host in batch if batch_host.id in rendered_data],
+                        lambda host_id, is_TCS: rendered_data[host_id],
+                        self.__TCS_traffic_rules_set,
+                        deployed,
+                        servers_by_host)
+                except Exception as e:
+                    # Continue with the remaining batches; failed hosts are
+                    # retried on the next deploy
+                    if not deploy_error:
+                        deploy_error = e
+        finally:
+            pool.close()
+            pool.join()
+
+        if deploy_error:
+            raise deploy_error
+
     def set_aws_account(self, access_id, secret_key):
         assert(self.is_locked)
         psi_utils.update_recordtype(
@@ -2886,6 +3028,85 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             return last_version
         return None
 
+    def build_handshake_index(self):
+        # Precompute the lookups used by handshake() so that the cost of a
+        # handshake doesn't grow with the number of servers in the network.
+        # The index is a snapshot of the current data: the web server builds
+        # it when it loads the network; rebuild it after modifying the network.
+        servers = list(self.__servers.itervalues())
+
+        servers_by_internal_ip_address = {}
+        for server in servers:
+            # Same result as a linear scan: the first server with the address
+            servers_by_internal_ip_address.setdefault(server.internal_ip_address, server)
+
+        # The set of discoverable servers only changes at discovery date range
+        # boundaries, so candidate lists are cached per interval between boundaries
+        discovery_date_boundaries = set()
+        for server in servers:
+            if server.discovery_date_range is not None:
+                discovery_date_boundaries.update(server.discovery_date_range)
+
+        page_view_regexes = {}
+        https_request_regexes = {}
+        for sponsor in self.__sponsors.itervalues():
+            page_view_regexes[sponsor.id] = [
+                {'regex': sponsor_regex.regex, 'replace': sponsor_regex.replace}
+                for sponsor_regex in sponsor.page_view_regexes]
+            https_request_regexes[sponsor.id] = [
+                {'regex': sponsor_regex.regex, 'replace': sponsor_regex.replace}
+                for sponsor_regex in sponsor.https_request_regexes]
+
+        self.__handshake_index = {
+            'servers': servers,
+            'servers_by_internal_ip_address': servers_by_internal_ip_address,
+            'discovery_date_boundaries': sorted(discovery_date_boundaries),
+            'discovery_candidate_servers': {},
+            'encoded_server_entries': {},
+            'sponsor_home_pages': {},
+            'page_view_regexes': page_view_regexes,
+            'https_request_regexes': https_request_regexes
+        }
+
+    def __get_handshake_index(self):
+        if getattr(self, '_PsiphonNetwork__handshake_index', None) is None:
+            self.build_handshake_index()
+        return self.__handshake_index
+
+    def __get_indexed_discovery_candidate_servers(self, index, discovery_date):
+        interval = bisect.bisect_right(index['discovery_date_boundaries'], discovery_date)
+        candidate_servers = index['discovery_candidate_servers'].get(interval)
+        if candidate_servers is None:
+            candidate_servers = [server for server in index['servers']
+                                 if server.discovery_date_range is not None and
+                                 server.discovery_date_range[0] <= discovery_date < server.discovery_date_range[1]]
+            index['discovery_candidate_servers'][interval] = candidate_servers
+        return candidate_servers
+
+    def __get_indexed_encoded_server_entry(self, index, server):
+        encoded_server_entry = index['encoded_server_entries'].get(server.id)
+        if encoded_server_entry is None:
+            encoded_server_entry = self.__get_encoded_server_entry(server)
+            # Entries with shuffled meek fronting addresses or hosts are
+            # encoded for each request so clients still get a random selection
+            host = self.__hosts[server.host_id]
+            if not (host.alternate_meek_server_fronting_hosts or
+                    (host.meek_server_fronting_domain and
+                     self.__alternate_meek_fronting_addresses.get(host.meek_server_fronting_domain))):
+                index['encoded_server_entries'][server.id] = encoded_server_entry
+        return encoded_server_entry
+
+    def __get_indexed_sponsor_home_pages(self, index, sponsor_id, region, client_platform):
+        # Only cache known sponsors, as sponsor_id is a client-supplied value
+        if sponsor_id not in self.__sponsors:
+            return []
+        key = (sponsor_id, region, client_platform)
+        home_pages = index['sponsor_home_pages'].get(key)
+        if home_pages is None:
+            home_pages = self.__get_sponsor_home_pages(sponsor_id, region, client_platform)
+            index['sponsor_home_pages'][key] = home_pages
+        return home_pages
+
     def handshake(self, server_ip_address, client_ip_address_strategy_value,
                   client_region, propagation_channel_id, sponsor_id,
                   client_platform_string, client_version, event_logger=None):
@@ -2896,6 +3117,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         config = {}
 
+        index = self.__get_handshake_index()
+
         # Match a client platform to client_platform_string
         platform = CLIENT_PLATFORM_WINDOWS
         if CLIENT_PLATFORM_ANDROID.lower() in client_platform_string.lower():
@@ -2903,7 +3126,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         # Randomly choose one landing page from a set of landing pages
         # to give the client to open when connection established
-        homepages = self.__get_sponsor_home_pages(sponsor_id, client_region, platform)
+        homepages = self.__get_indexed_sponsor_home_pages(index, sponsor_id, client_region, platform)
         config['homepages'] = [random.choice(homepages)] if homepages else []
 
         # Tell client if an upgrade is available
@@ -2913,11 +3136,15 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # NOTE: Clients are expecting at least an empty list
         config['encoded_server_list'] = []
         if client_ip_address_strategy_value:
-            config['encoded_server_list'], _ = \
-                        self.__get_encoded_server_list(
-                                                    propagation_channel_id,
-                                                    client_ip_address_strategy_value,
-                                                    event_logger=event_logger)
+            # Same selection as __get_encoded_server_list, using the index
+            candidate_servers = self.__get_indexed_discovery_candidate_servers(
+                                                    index, datetime.datetime.now())
+            servers = psi_ops_discovery.select_servers(candidate_servers, client_ip_address_strategy_value)
+            if event_logger:
+                for server in servers:
+                    event_logger(server.ip_address)
+            config['encoded_server_list'] = [self.__get_indexed_encoded_server_entry(index, server)
+                                             for server in servers]
 
         # VPN relay protocol info
         # Note: The VPN PSK will be added in higher up the call stack
@@ -2927,8 +3154,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # SSH Session ID is a randomly generated unique ID used for
         # client-side session duration reporting
         #
-        server = next(server for server in self.__servers.itervalues()
-                      if server.internal_ip_address == server_ip_address)
+        server = index['servers_by_internal_ip_address'][server_ip_address]
 
         config['ssh_username'] = server.ssh_username
         config['ssh_password'] = server.ssh_password
@@ -2945,19 +3171,9 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             config['ssh_obfuscated_key'] = server.ssh_obfuscated_key
 
         # Give client a set of regexes indicating which pages should have individual stats
-        config['page_view_regexes'] = []
-        for sponsor_regex in self._get_sponsor_page_view_regexes(sponsor_id):
-            config['page_view_regexes'].append({
-                                                'regex': sponsor_regex.regex,
-                                                'replace': sponsor_regex.replace
-                                                })
-
-        config['https_request_regexes'] = []
-        for sponsor_regex in self._get_sponsor_https_request_regexes(sponsor_id):
-            config['https_request_regexes'].append({
-                                                'regex': sponsor_regex.regex,
-                                                'replace': sponsor_regex.replace
-                                                })
+        config['page_view_regexes'] = list(index['page_view_regexes'].get(sponsor_id, []))
+
+        config['https_request_regexes'] = list(index['https_request_regexes'].get(sponsor_id, []))
 
         # If there are speed test URLs, select one at random and return it
         if self.__speed_test_urls:
@@ -2985,6 +3201,9 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
     def get_servers(self):
         return list(self.__servers.itervalues())
 
+    def get_deleted_servers(self):
+        return list(self.__deleted_servers.itervalues())
+
     def get_propagation_channels(self):
         return list(self.__propagation_channels.itervalues())
 
@@ -2993,21 +3212,31 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
     def __compartmentalize_data_for_host(self, host_id, is_TCS, discovery_date=datetime.datetime.now()):
         # Create a compartmentalized database with only the information needed by a particular host
+        return PsiphonNetwork.render_compartmentalized_data(
+                    self.__get_compartmentalized_common_data(discovery_date),
+                    host_id,
+                    is_TCS,
+                    host_id in self.__legacy_data_format_hosts)
+
+    def __get_compartmentalized_common_data(self, discovery_date):
+        # The parts of the compartmentalized databases which are the same for every host:
         # - all propagation channels because any client may connect to servers on this host
         # - host data
         #   only region info is required for discovery
         # - servers data
-        #   omit discovery servers not on this host whose discovery time period has elapsed
-        #   also, omit propagation servers not on this host
-        #   (not on this host --> because servers on this host still need to run, even if not discoverable)
+        #   discovery servers whose discovery time period hasn't elapsed are sent to all hosts;
+        #   other servers are sent only to their own host
+        #   (because servers on a host still need to run, even if not discoverable)
         # - send home pages for all sponsors, but omit names, banners, campaigns
         # - send versions info for upgrades
-
-        if is_TCS:
-            return self.__compartmentalize_data_for_tcs(host_id, discovery_date)
+        #
+        # Rendered for a particular host, legacy or TCS, by render_compartmentalized_data()
 
         copy = PsiphonNetwork(initialize_plugins=False)
 
+        # Omit: the new copy's random key; hosts get the key with the implementation
+        copy.__discovery_strategy_value_hmac_key = ''
+
         for propagation_channel in self.__propagation_channels.itervalues():
             copy.__propagation_channels[propagation_channel.id] = PropagationChannel(
                                                                     propagation_channel.id,
@@ -3042,34 +3271,36 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                         host.meek_cookie_encryption_public_key,
                                         '')  # Omit: meek_cookie_encryption_private_key isn't needed
 
+        discoverable_servers = []
+        servers_by_host = defaultdict(list)
         for server in self.__servers.itervalues():
-            if ((server.discovery_date_range and server.host_id != host_id and server.discovery_date_range[1] <= discovery_date) or
-                (not server.discovery_date_range and server.host_id != host_id)):
-                continue
-
-            copy.__servers[server.id] = Server(
-                                                server.id,
-                                                server.host_id,
-                                                server.ip_address,
-                                                server.egress_ip_address,
-                                                server.internal_ip_address,
-                                                server.propagation_channel_id,
-                                                server.is_embedded,
-                                                server.is_permanent,
-                                                server.discovery_date_range,
-                                                server.capabilities,
-                                                server.web_server_port,
-                                                server.web_server_secret,
-                                                server.web_server_certificate,
-                                                server.web_server_private_key,
-                                                server.ssh_port,
-                                                server.ssh_username,
-                                                server.ssh_password,
-                                                server.ssh_host_key,
-                                                None,
-                                                server.ssh_obfuscated_port,
-                                                server.ssh_obfuscated_key,
-                                                server.alternate_ssh_obfuscated_ports)
+            copy_server = Server(
+                                server.id,
+                                server.host_id,
+                                server.ip_address,
+                                server.egress_ip_address,
+                                server.internal_ip_address,
+                                server.propagation_channel_id,
+                                server.is_embedded,
+                                server.is_permanent,
+                                server.discovery_date_range,
+                                server.capabilities,
+                                server.web_server_port,
+                                server.web_server_secret,
+                                server.web_server_certificate,
+                                server.web_server_private_key,
+                                server.ssh_port,
+                                server.ssh_username,
+                                server.ssh_password,
+                                server.ssh_host_key,
+                                None,
+                                server.ssh_obfuscated_port,
+                                server.ssh_obfuscated_key,
+                                server.alternate_ssh_obfuscated_ports)
+            if server.discovery_date_range and server.discovery_date_range[1] > discovery_date:
+                discoverable_servers.append(copy_server)
+            else:
+                servers_by_host[server.host_id].append(copy_server)
 
         for sponsor in self.__sponsors.itervalues():
             sponsor_data = sponsor
@@ -3121,158 +3352,70 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                     speed_test_url.server_port,
                     speed_test_url.request_path))
 
-        return jsonpickle.encode(copy)
+        # The copies are new records, logged as created now; clear those logs so
+        # the data rendered for a host only changes when the network does
+        _clear_record_logs(copy.__dict__)
+        _clear_record_logs(discoverable_servers)
+        _clear_record_logs(servers_by_host)
 
-    def __json_serializer(self, obj):
-        # JSON serializer for datetime objects
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        if isinstance(obj, set):
-            return list(obj)
-        else:
-            # Handle psi_utils.recordtype() object
-            # Host, Server, SponsorHomePage, ...
-            return obj.todict()
+        # tunnel-core-server gets the same data in plain JSON, without speed test URLs
+        TCS_data = {
+            "alternate_meek_fronting_addresses": self.__alternate_meek_fronting_addresses,
+            "alternate_meek_fronting_addresses_regex": self.__alternate_meek_fronting_addresses_regex,
+            "client_versions": copy.__client_versions,
+            "hosts": dict((host.id, host.todict()) for host in copy.__hosts.itervalues()),
+            "sponsors": dict((sponsor.id, sponsor.todict()) for sponsor in copy.__sponsors.itervalues()),
+            "meek_fronting_disable_SNI": self.__meek_fronting_disable_SNI
+        }
 
-    def __compartmentalize_data_for_tcs(self, host_id, discovery_date=datetime.datetime.now()):
-        # Create a compartmentalized database for tunnel-core-server with only the information needed by a particular host
-        # - all propagation channels because any client may connect to servers on this host
-        # - host data
-        #   only region info is required for discovery
-        # - servers data
-        #   omit discovery servers not on this host whose discovery time period has elapsed
-        #   also, omit propagation servers not on this host
-        #   (not on this host --> because servers on this host still need to run, even if not discoverable)
-        # - send home pages for all sponsors, but omit names, banners, campaigns
-        # - send versions info for upgrades
+        return {
+            'network': copy,
+            'TCS_data': TCS_data,
+            'discoverable_servers': discoverable_servers,
+            'servers_by_host': servers_by_host
+        }
 
-        copy = PsiphonNetwork(initialize_plugins=False)
+    @staticmethod
+    def render_compartmentalized_data(common_data, host_id, is_TCS, legacy_data_format=False):
+        # NOTE: modifies common_data['network'], so common_data must not be shared between threads
 
-        for propagation_channel in self.__propagation_channels.itervalues():
-            copy.__propagation_channels[propagation_channel.id] = PropagationChannel(
-                                                                    propagation_channel.id,
-                                                                    '',  # Omit name
-                                                                    '',  # Omit mechanism type
-                                                                    '',  # Omit propagator_managed_upgrades
-                                                                    '',  # Omit new server counts
-                                                                    '',  # Omit new server counts
-                                                                    '',  # Omit server ages
-                                                                    '')  # Omit server ages
+        servers = common_data['discoverable_servers'] + common_data['servers_by_host'].get(host_id, [])
 
-        for host in self.__hosts.itervalues():
-            copy.__hosts[host.id] = Host(
-                                        host.id,
-                                        '',  # Omit: is_TCS isn't needed
-                                        '',  # Omit: provider isn't needed
-                                        '',  # Omit: provider_id isn't needed
-                                        '',  # Omit: ip_address isn't needed
-                                        '',  # Omit: ssh_port isn't needed
-                                        '',  # Omit: root ssh_username isn't needed
-                                        '',  # Omit: root ssh_password isn't needed
-                                        '',  # Omit: ssh_host_key isn't needed
-                                        '',  # Omit: stats_ssh_username isn't needed
-                                        '',  # Omit: stats_ssh_password isn't needed
-                                        '',  # Omit: datacenter_name isn't needed
-                                        host.region,
-                                        host.meek_server_port,
-                                        host.meek_server_obfuscated_key,
-                                        host.meek_server_fronting_domain,
-                                        host.meek_server_fronting_host,
-                                        [],  # Omit: alternate_meek_server_fronting_hosts isn't needed
-                                        host.meek_cookie_encryption_public_key,
-                                        '').todict()  # Omit: meek_cookie_encryption_private_key isn't needed
+        if not is_TCS:
+            copy = common_data['network']
+            copy.__servers = dict((server.id, server) for server in servers)
+            if legacy_data_format:
+                # The host's implementation predates psi_ops_serializer
+                return jsonpickle.encode(copy)
+            return copy.encode()
 
         # Store servers as array instead of map as a method of preprocessing for
         # tunnel-core-server
         server_list = []
-        for server in self.__servers.itervalues():
-            if ((server.discovery_date_range and server.host_id != host_id and server.discovery_date_range[1] <= discovery_date) or
-                (not server.discovery_date_range and server.host_id != host_id)):
-                continue
-
-            s = Server(
-                                                server.id,
-                                                server.host_id,
-                                                server.ip_address,
-                                                server.egress_ip_address,
-                                                server.internal_ip_address,
-                                                server.propagation_channel_id,
-                                                server.is_embedded,
-                                                server.is_permanent,
-                                                server.discovery_date_range,
-                                                server.capabilities,
-                                                server.web_server_port,
-                                                server.web_server_secret,
-                                                server.web_server_certificate,
-                                                server.web_server_private_key,
-                                                str(server.ssh_port), # Some ports are stored as ints, catch this for tunnel-core-server
-                                                server.ssh_username,
-                                                server.ssh_password,
-                                                server.ssh_host_key,
-                                                None,
-                                                int(server.ssh_obfuscated_port), # Some ports are stored as strings, catch this for tunnel-core-server
-                                                server.ssh_obfuscated_key,
-                                                server.alternate_ssh_obfuscated_ports).todict()
+        for server in servers:
+            s = server.todict()
+            s['ssh_port'] = str(server.ssh_port) # Some ports are stored as ints, catch this for tunnel-core-server
+            s['ssh_obfuscated_port'] = int(server.ssh_obfuscated_port) # Some ports are stored as strings, catch this for tunnel-core-server
             server_list.append(s)
 
-        for sponsor in self.__sponsors.itervalues():
-            sponsor_data = sponsor
-            if sponsor.use_data_from_sponsor_id:
-                sponsor_data = self.__sponsors[sponsor.use_data_from_sponsor_id]
-            copy_sponsor = Sponsor(
-                                sponsor.id,
-                                '',  # Omit name
-                                '',  # Omit banner
-                                None,  # Omit website_banner
-                                None,  # Omit website_banner_link
-                                {},
-                                {},
-                                [],  # Omit campaigns
-                                [],
-                                [])
-            for region, home_pages in sponsor_data.home_pages.iteritems():
-                copy_sponsor.home_pages[region] = []
-                for home_page in home_pages:
-                    copy_sponsor.home_pages[region].append(SponsorHomePage(
-                                                             home_page.region,
-                                                             home_page.url))
-            for region, mobile_home_pages in sponsor_data.mobile_home_pages.iteritems():
-                copy_sponsor.mobile_home_pages[region] = []
-                for mobile_home_page in mobile_home_pages:
-                    copy_sponsor.mobile_home_pages[region].append(SponsorHomePage(
-                                                             mobile_home_page.region,
-                                                             mobile_home_page.url))
-            for page_view_regex in sponsor_data.page_view_regexes:
-                copy_sponsor.page_view_regexes.append(SponsorRegex(
-                                                             page_view_regex.regex,
-                                                             page_view_regex.replace))
-            for https_request_regex in sponsor_data.https_request_regexes:
-                copy_sponsor.https_request_regexes.append(SponsorRegex(
-                                                             https_request_regex.regex,
-                                                             https_request_regex.replace))
-            copy.__sponsors[copy_sponsor.id] = copy_sponsor.todict()
-
-        for platform in self.__client_versions.iterkeys():
-            for client_version in self.__client_versions[platform]:
-                copy.__client_versions[platform].append(ClientVersion(
-                                                client_version.version,
-                                                ''))  # Omit description
-
         # Alphabetize by host_id
         server_list.sort(key=lambda k: k['host_id'])
 
-        print copy.__alternate_meek_fronting_addresses
-
-        return json.dumps({
-            "alternate_meek_fronting_addresses": self.__alternate_meek_fronting_addresses,
-            "alternate_meek_fronting_addresses_regex": self.__alternate_meek_fronting_addresses_regex,
-            "client_versions": copy.__client_versions,
-            "hosts": copy.__hosts,
-            "servers": server_list,
-            "sponsors": copy.__sponsors,
-            "meek_fronting_disable_SNI": self.__meek_fronting_disable_SNI
-        }, default=self.__json_serializer)
+        TCS_data = dict(common_data['TCS_data'])
+        TCS_data["servers"] = server_list
+        return json.dumps(TCS_data, default=PsiphonNetwork.__json_serializer)
 
+    @staticmethod
+    def __json_serializer(obj):
+        # JSON serializer for datetime objects
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        if isinstance(obj, set):
+            return list(obj)
+        else:
+            # Handle psi_utils.recordtype() object
+            # Host, Server, SponsorHomePage, ...
+            return obj.todict()
 
     def __compartmentalize_data_for_stats_server(self):
         # The stats server needs to be able to connect to all hosts and needs
@@ -3355,17 +3498,28 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                         [],     # omit page_view_regexes
                                         [])     # omit https_request_regexes
 
+        # NOTE: stats server scripts (psi_sync_logs, etc.) parse this file as plain JSON,
+        # so it stays in the jsonpickle format
         return jsonpickle.encode(copy)
 
     def run_command_on_host(self, host, command):
         if type(host) == str:
             host = self.__hosts[host]
-        ssh = psi_ssh.SSH(
+        with psi_ssh.session(
                 host.ip_address, host.ssh_port,
                 host.ssh_username, host.ssh_password,
-                host.ssh_host_key)
+                host.ssh_host_key) as ssh:
+            return ssh.exec_command(command)
 
-        return ssh.exec_command(command)
+    def run_commands_on_host(self, host, commands):
+        # The commands run at the same time over one connection
+        if type(host) == str:
+            host = self.__hosts[host]
+        with psi_ssh.session(
+                host.ip_address, host.ssh_port,
+                host.ssh_username, host.ssh_password,
+                host.ssh_host_key) as ssh:
+            return ssh.exec_commands(commands)
 
     def run_command_on_hosts(self, command):
 
@@ -3376,20 +3530,18 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         psi_ops_deploy.run_in_parallel(20, do_run_command_on_host, self.__hosts.itervalues())
 
     def copy_file_from_host(self, host, remote_source_filename, local_destination_filename):
-        ssh = psi_ssh.SSH(
+        with psi_ssh.session(
                 host.ip_address, host.ssh_port,
                 host.ssh_username, host.ssh_password,
-                host.ssh_host_key)
-
-        ssh.get_file(remote_source_filename, local_destination_filename)
+                host.ssh_host_key) as ssh:
+            ssh.get_file(remote_source_filename, local_destination_filename)
 
     def copy_file_to_host(self, host, source_filename, dest_filename):
-        ssh = psi_ssh.SSH(
+        with psi_ssh.session(
                 host.ip_address, host.ssh_port,
                 host.ssh_username, host.ssh_password,
-                host.ssh_host_key)
-
-        ssh.put_file(source_filename, dest_filename)
+                host.ssh_host_key) as ssh:
+            ssh.put_file(source_filename, dest_filename)
 
     def copy_file_to_hosts(self, source_filename, dest_filename):
 
@@ -3526,12 +3678,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         self.__test_servers(servers, test_cases)
 
     def server_distribution(self):
-        users_on_host = {}
-        total_users = 0
-        for host in self.get_hosts():
-            user_count = self.__count_users_on_host(host.id)
-            total_users += user_count
-            users_on_host[host.id] = user_count
+        users_on_host = self.count_users_on_hosts([host.id for host in self.get_hosts()])
+        total_users = sum(users_on_host.itervalues())
         sorted_users_on_host = sorted(users_on_host.iteritems(), key=operator.itemgetter(1))
         print 'Total users: %d\n' % (total_users,)
         for host_user_count in sorted_users_on_host:
@@ -3543,6 +3691,35 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         super(PsiphonNetwork, self).save()
 
 
+def _clear_record_logs(value):
+    if isinstance(value, dict):
+        for item in value.itervalues():
+            _clear_record_logs(item)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            _clear_record_logs(item)
+    elif hasattr(value, 'get_logs') and value.get_logs() is not None:
+        value.logs = []
+        for field in value.__slots__:
+            _clear_record_logs(getattr(value, field))
+
+
+# Process pool workers for PsiphonNetwork.__deploy_data_to_all_hosts()
+
+_compartmentalized_common_data = None
+
+
+def _initialize_compartmentalized_data_worker(common_data):
+    global _compartmentalized_common_data
+    _compartmentalized_common_data = common_data
+
+
+def _render_compartmentalized_data_for_host(host_args):
+    host_id, is_TCS, legacy_data_format = host_args
+    return host_id, PsiphonNetwork.render_compartmentalized_data(
+                        _compartmentalized_common_data, host_id, is_TCS, legacy_data_format)
+
+
 def unit_test():
     psinet = PsiphonNetwork()
     psinet.add_propagation_channel('email-channel', ['email-autoresponder'])
@@ -3558,6 +3735,46 @@ def unit_test():
     psinet.show_status(verbose=True)
 
 
+def benchmark_handshake(server_counts=(100, 1000, 10000), iterations=1000):
+    # Time handshake() against synthetic networks of increasing size. With the
+    # handshake index, time per handshake should stay flat as the network grows.
+    now = datetime.datetime.now()
+    for server_count in server_counts:
+        psinet = PsiphonNetwork(initialize_plugins=False)
+        psinet.is_locked = True
+        psinet.add_propagation_channel('channel', ['email-autoresponder'])
+        psinet.add_sponsor('sponsor')
+        psinet.set_sponsor_home_page('sponsor', 'None', 'http://example.com/?client_region=XX')
+        psinet.set_sponsor_page_view_regex('sponsor', r'^http://example\.com', r'$&')
+        propagation_channel_id = psinet.get_propagation_channel_by_name('channel').id
+        sponsor_id = psinet.get_sponsor_by_name('sponsor').id
+        for i in xrange(server_count):
+            ip_address = '10.%d.%d.%d' % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+            # Spread discovery date ranges over several days, as in a real network
+            start = now + datetime.timedelta(days=(i % 10) - 5)
+            psinet.import_host(str(i), False, 'linode', None, ip_address, '22', 'root', 'password',
+                               'ssh-rsa ' + binascii.hexlify(os.urandom(16)), 'stats', 'password')
+            psinet.import_server(str(i), str(i), ip_address, ip_address, ip_address,
+                                 propagation_channel_id, False, False, (start, start + datetime.timedelta(days=3)),
+                                 ServerCapabilities(), '8080', binascii.hexlify(os.urandom(32)),
+                                 binascii.hexlify(os.urandom(64)), binascii.hexlify(os.urandom(64)),
+                                 '22', 'user', 'password', 'ssh-rsa ' + binascii.hexlify(os.urandom(16)))
+        psinet.is_locked = False
+
+        start_time = time.time()
+        psinet.build_handshake_index()
+        index_time = time.time() - start_time
+
+        start_time = time.time()
+        for i in xrange(iterations):
+            psinet.handshake('10.0.0.0', i % 256, 'CA', propagation_channel_id, sponsor_id,
+                             'Android_4.0.4', '1', event_logger=lambda ip_address: None)
+        handshake_time = time.time() - start_time
+
+        print 'servers: %6d  index build: %8.2f ms  handshake: %8.2f us' % (
+                server_count, index_time * 1000, handshake_time / iterations * 1000000)
+
+
 def create():
     # Create a new network object and persist it
     psinet = PsiphonNetwork()
@@ -3642,8 +3859,12 @@ if __name__ == "__main__":
                       help="prune all propagation channels")
     parser.add_option("-n", "--new-servers", dest="channel", action="store", type="string",
                       help="create new servers for this propagation channel")
+    parser.add_option("-b", "--benchmark-handshake", dest="benchmarkhandshake", action="store_true",
+                      help="time handshakes against synthetic networks of increasing size")
     (options, _) = parser.parse_args()
-    if options.channel:
+    if options.benchmarkhandshake:
+        benchmark_handshake()
+    elif options.channel:
         replace_propagation_channel_servers(options.channel)
     elif options.prune:
         prune_all_propagation_channels()
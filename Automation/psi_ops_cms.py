@@ -23,6 +23,7 @@ import subprocess
 import shlex
 import tempfile
 import jsonpickle
+import psi_ops_serializer
 
 
 #==============================================================================
@@ -148,6 +149,10 @@ class PersistentObject(object):
 
     class_version = '0.0'
 
+    # In-memory attributes, such as lookup indexes, which are rebuilt
+    # after loading and are not written out with the object
+    transient_attributes = ()
+
     def __init__(self):
         self.version = self.__class__.class_version
         self.is_locked = False
@@ -157,9 +162,28 @@ class PersistentObject(object):
             unlock_document()
             self.is_locked = False
 
+    def __getattr__(self, name):
+        # Only called for attributes which aren't set: when loaded lazily,
+        # sections are decoded on first use
+        lazy_sections = self.__dict__.get('_lazy_sections')
+        if lazy_sections is None or name not in lazy_sections:
+            raise AttributeError(name)
+        return lazy_sections.load(self, name)
+
+    def load_lazy_sections(self):
+        lazy_sections = self.__dict__.get('_lazy_sections')
+        if lazy_sections:
+            for name in lazy_sections.names():
+                lazy_sections.load(self, name)
+            del self.__dict__['_lazy_sections']
+
+    def encode(self):
+        self.load_lazy_sections()
+        return psi_ops_serializer.encode(self, exclude_attributes=self.transient_attributes)
+
     def save_to_file(self, filename):
         with open(filename, 'w') as file:
-            file.write(jsonpickle.encode(self))
+            file.write(self.encode())
 
     def save(self):
         if not os.path.isfile('psi_data_config.py'):
@@ -170,16 +194,24 @@ class PersistentObject(object):
         self.is_locked = None
         try:
             with tempfile.NamedTemporaryFile(delete=False) as file:
-                file.write(jsonpickle.encode(self))
+                file.write(self.encode())
         finally:
             self.is_locked = is_locked
         import_document(file.name)
         os.remove(file.name)
 
     @staticmethod
-    def load_from_file(filename):
-        with open(filename) as file:
-            obj = jsonpickle.decode(file.read())
+    def load_from_file(filename, lazy=False):
+        # Reads both the current format and legacy jsonpickle files
+        with open(filename, 'rb') as file:
+            if psi_ops_serializer.is_serialized(file.read(64)):
+                file.seek(0)
+                obj, lazy_sections = psi_ops_serializer.decode(file, lazy)
+                if lazy_sections:
+                    obj.__dict__['_lazy_sections'] = lazy_sections
+            else:
+                file.seek(0)
+                obj = jsonpickle.decode(file.read())
             if not hasattr(obj, 'version'):
                 obj.version = '0.0'
             if obj.version != obj.class_version:
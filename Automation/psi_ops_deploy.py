@@ -18,6 +18,7 @@
 #
 
 import re
+import hashlib
 import tempfile
 import os
 import posixpath
@@ -43,6 +44,7 @@ SOURCE_FILES = [
      ['psi_ops.py',
       'psi_ops_discovery.py',
       'psi_ops_cms.py',
+      'psi_ops_serializer.py',
       'psi_utils.py'
      ]),
 
@@ -52,6 +54,7 @@ SOURCE_FILES = [
       'psi_web.py',
       'psi_auth.py',
       'psi_geoip.py',
+      'psi_session_db.py',
       'pam.py',
       'psi-check-services',
       'psi_web_patch.py'
@@ -88,6 +91,11 @@ TCS_UNFRONTED_MEEK_HTTPS_OSSH_DOCKER_PORT = 1031
 TCS_PSIPHOND_HOT_RELOAD_SIGNAL_COMMAND = 'systemctl kill --signal=USR1 psiphond'
 TCS_PSIPHOND_START_COMMAND = '/opt/psiphon/psiphond_safe_start.sh'
 
+#==== Host Probe ==============================================================
+
+# Run by load.py on legacy and TCS hosts
+HOST_PROBE_FILE_NAME = '/usr/local/bin/psi_host_probe.py'
+
 
 #==============================================================================
 
@@ -117,17 +125,17 @@ def deploy_implementation(host, servers, discovery_strategy_value_hmac_key, plug
 
     print 'deploy implementation to host %s%s...' % (host.id, " (TCS) " if host.is_TCS else "", )
 
-    ssh = psi_ssh.SSH(
+    with psi_ssh.session(
                     host.ip_address, host.ssh_port,
                     host.ssh_username, host.ssh_password,
-                    host.ssh_host_key)
+                    host.ssh_host_key) as ssh:
 
-    if host.is_TCS:
-        deploy_TCS_implementation(ssh, host, servers, TCS_psiphond_config_values)
-    else:
-        deploy_legacy_implementation(ssh, host, discovery_strategy_value_hmac_key, plugins)
+        if host.is_TCS:
+            deploy_TCS_implementation(ssh, host, servers, TCS_psiphond_config_values)
+        else:
+            deploy_legacy_implementation(ssh, host, discovery_strategy_value_hmac_key, plugins)
 
-    ssh.close()
+        deploy_host_probe_with_ssh(ssh)
 
 
 def deploy_legacy_implementation(ssh, host, discovery_strategy_value_hmac_key, plugins):
@@ -381,58 +389,75 @@ def deploy_implementation_to_hosts(hosts, discovery_strategy_value_hmac_key, plu
     run_in_parallel(20, do_deploy_implementation, hosts)
 
 
-def deploy_data(host, host_data, TCS_traffic_rules_set):
+def deploy_data(host, host_data, TCS_traffic_rules_set, servers=None):
 
     print 'deploy data to host %s%s...' % (host.id, " (TCS) " if host.is_TCS else "", )
 
-    ssh = psi_ssh.SSH(
+    with psi_ssh.session(
                     host.ip_address, host.ssh_port,
                     host.ssh_username, host.ssh_password,
-                    host.ssh_host_key)
+                    host.ssh_host_key) as ssh:
 
-    if host.is_TCS:
-        deploy_TCS_data(ssh, host, host_data, TCS_traffic_rules_set)
-    else:
-        deploy_legacy_data(ssh, host, host_data)
-
-    ssh.close()
+        if host.is_TCS:
+            deploy_TCS_data(ssh, host, host_data, TCS_traffic_rules_set)
+        else:
+            deploy_legacy_data(ssh, host, host_data, servers)
 
 
-def deploy_legacy_data(ssh, host, host_data):
+def get_web_servers_signature(servers):
+    # Identifies the web servers psi_web runs for these servers: see
+    # psi_web.get_servers. psi_web only starts web servers when it starts.
+    web_servers = sorted(
+        [server.internal_ip_address,
+         server.web_server_port,
+         server.web_server_secret,
+         server.web_server_certificate,
+         server.web_server_private_key,
+         server.capabilities,
+         server.host_id]
+        for server in servers)
+    return hashlib.sha256(json.dumps(web_servers, sort_keys=True)).hexdigest()
 
-    # Stop server, if running, before replacing data file (command may fail)
-    # Disable restarting the server through psi-check-services first
 
-    ssh.exec_command('touch %s' % (psi_config.HOST_SERVER_STOPPED_LOCK_FILE,))
-    remote_init_file_path = posixpath.join(psi_config.HOST_INIT_DIR, 'psiphonv')
-    ssh.exec_command('%s stop' % (remote_init_file_path,))
+def deploy_legacy_data(ssh, host, host_data, servers=None):
 
     # Copy data file
     # We upload a compartmentalized version of the master file
     # containing only the propagation channel IDs and confidential server
     # information required by each host.
+    # The file is uploaded under a temporary name and renamed into place, so
+    # psi_web never sees a partially written data file.
 
+    remote_temp_data_file_name = psi_config.DATA_FILE_NAME + '.new'
     file = tempfile.NamedTemporaryFile(delete=False)
     try:
         file.write(host_data)
         file.close()
         ssh.exec_command('mkdir -p %s' % (
                 posixpath.split(psi_config.DATA_FILE_NAME)[0],))
-        ssh.put_file(file.name, psi_config.DATA_FILE_NAME)
+        ssh.put_file(file.name, remote_temp_data_file_name)
+        ssh.exec_command('mv -f %s %s' % (remote_temp_data_file_name, psi_config.DATA_FILE_NAME))
     finally:
         try:
             os.remove(file.name)
         except:
             pass
 
-    # Restart server after data file updated
-
-    ssh.exec_command('%s restart' % (remote_init_file_path,))
-
-    # Allow psi-check-services to restart the server now that data has been successfully copied
-    # and the server is running again
+    # The running server reloads the data file without dropping connections,
+    # but it must be restarted to add or change web servers. The web servers
+    # the host was last started with are recorded next to the data file; if
+    # they aren't known, restart.
+    # Fall back to a restart for hosts with an older init script
 
-    ssh.exec_command('rm %s' % (psi_config.HOST_SERVER_STOPPED_LOCK_FILE,))
+    remote_init_file_path = posixpath.join(psi_config.HOST_INIT_DIR, 'psiphonv')
+    remote_web_servers_file_name = psi_config.DATA_FILE_NAME + '.web_servers'
+    web_servers_signature = get_web_servers_signature(servers) if servers is not None else None
+    if (web_servers_signature and
+            ssh.exec_command('cat %s 2>/dev/null' % (remote_web_servers_file_name,)).strip() != web_servers_signature):
+        ssh.exec_command('%s restart && echo %s > %s' % (
+                remote_init_file_path, web_servers_signature, remote_web_servers_file_name))
+    else:
+        ssh.exec_command('%s reload || %s restart' % (remote_init_file_path, remote_init_file_path))
 
 
 def deploy_TCS_data(ssh, host, host_data, TCS_traffic_rules_set):
@@ -474,17 +499,21 @@ def put_file_with_content(ssh, content, destination_path):
             pass
 
 
-def deploy_data_to_hosts(hosts, data_generator, TCS_traffic_rules_set):
+def deploy_data_to_hosts(hosts, data_generator, TCS_traffic_rules_set, deployed_callback=None,
+                         servers_by_host=None):
 
     @retry_decorator_returning_exception
     def do_deploy_data(host_and_data_generator):
         host = host_and_data_generator[0]
         host_data = host_and_data_generator[1](host.id, host.is_TCS)
         try:
-            deploy_data(host, host_data, TCS_traffic_rules_set)
+            deploy_data(host, host_data, TCS_traffic_rules_set,
+                        servers_by_host.get(host.id, []) if servers_by_host is not None else None)
         except:
             print 'Error deploying data to host %s' % (host.id,)
             raise
+        if deployed_callback:
+            deployed_callback(host)
 
     run_in_parallel(40, do_deploy_data, [(host, data_generator) for host in hosts])
 
@@ -497,19 +526,17 @@ def deploy_build(host, build_filename):
 
     print 'deploy %s build to host %s...' % (build_filename, host.id,)
 
-    ssh = psi_ssh.SSH(
+    with psi_ssh.session(
                     host.ip_address, host.ssh_port,
                     host.ssh_username, host.ssh_password,
-                    host.ssh_host_key)
+                    host.ssh_host_key) as ssh:
 
-    ssh.exec_command('mkdir -p %s' % (psi_config.UPGRADE_DOWNLOAD_PATH,))
+        ssh.exec_command('mkdir -p %s' % (psi_config.UPGRADE_DOWNLOAD_PATH,))
 
-    ssh.put_file(
-        build_filename,
-        posixpath.join(psi_config.UPGRADE_DOWNLOAD_PATH,
-                       os.path.split(build_filename)[1]))
-
-    ssh.close()
+        ssh.put_file(
+            build_filename,
+            posixpath.join(psi_config.UPGRADE_DOWNLOAD_PATH,
+                           os.path.split(build_filename)[1]))
 
 
 def deploy_build_to_hosts(hosts, build_filename):
@@ -533,19 +560,18 @@ def deploy_routes(host):
 
     print 'deploy routes to host %s...' % (host.id,)
 
-    ssh = psi_ssh.SSH(
+    with psi_ssh.session(
                     host.ip_address, host.ssh_port,
                     host.ssh_username, host.ssh_password,
-                    host.ssh_host_key)
-    ssh.exec_command('mkdir -p %s' % (psi_config.ROUTES_PATH,))
+                    host.ssh_host_key) as ssh:
+        ssh.exec_command('mkdir -p %s' % (psi_config.ROUTES_PATH,))
 
-    target_filename = posixpath.join(
-                            psi_config.ROUTES_PATH,
-                            os.path.split(psi_routes.GEO_ROUTES_ARCHIVE_PATH)[1])
+        target_filename = posixpath.join(
+                                psi_config.ROUTES_PATH,
+                                os.path.split(psi_routes.GEO_ROUTES_ARCHIVE_PATH)[1])
 
-    ssh.put_file(psi_routes.GEO_ROUTES_ARCHIVE_PATH, target_filename)
-    ssh.exec_command('tar xz -C %s -f %s' % (psi_config.ROUTES_PATH, target_filename))
-    ssh.close()
+        ssh.put_file(psi_routes.GEO_ROUTES_ARCHIVE_PATH, target_filename)
+        ssh.exec_command('tar xz -C %s -f %s' % (psi_config.ROUTES_PATH, target_filename))
 
     host.log('deploy routes')
 
@@ -563,6 +589,37 @@ def deploy_routes_to_hosts(hosts):
     run_in_parallel(10, do_deploy_routes, hosts)
 
 
+def deploy_host_probe_with_ssh(ssh):
+
+    ssh.put_file(os.path.join(os.path.abspath('..'), 'Server', 'psi_host_probe.py'),
+                 HOST_PROBE_FILE_NAME)
+    ssh.exec_command('chmod +x %s' % (HOST_PROBE_FILE_NAME,))
+
+
+def deploy_host_probe(host):
+
+    print 'deploy host probe to host %s...' % (host.id,)
+
+    with psi_ssh.session(
+                    host.ip_address, host.ssh_port,
+                    host.ssh_username, host.ssh_password,
+                    host.ssh_host_key) as ssh:
+        deploy_host_probe_with_ssh(ssh)
+
+
+def deploy_host_probe_to_hosts(hosts):
+
+    @retry_decorator_returning_exception
+    def do_deploy_host_probe(host):
+        try:
+            deploy_host_probe(host)
+        except:
+            print 'Error deploying host probe to host %s' % (host.id,)
+            raise
+
+    run_in_parallel(20, do_deploy_host_probe, hosts)
+
+
 def deploy_geoip_database_autoupdates(host):
 
     geo_ip_config_file = 'GeoIP.conf'
@@ -570,40 +627,39 @@ def deploy_geoip_database_autoupdates(host):
 
         print 'deploy geoip database autoupdates to host %s...' % (host.id)
 
-        ssh = psi_ssh.SSH(
+        with psi_ssh.session(
                 host.ip_address, host.ssh_port,
                 host.ssh_username, host.ssh_password,
-                host.ssh_host_key)
+                host.ssh_host_key) as ssh:
 
-        ssh.put_file(os.path.join(os.path.abspath('.'), geo_ip_config_file),
-                     posixpath.join('/usr/local/etc/', geo_ip_config_file))
+            ssh.put_file(os.path.join(os.path.abspath('.'), geo_ip_config_file),
+                         posixpath.join('/usr/local/etc/', geo_ip_config_file))
 
-        # Set up weekly updates
-        cron_filename = '/etc/cron.weekly/update-geoip-db'
+            # Set up weekly updates
+            cron_filename = '/etc/cron.weekly/update-geoip-db'
 
-        cron_file_contents = None
+            cron_file_contents = None
 
-        # For TCS, use hot reload and don't restart service
-        if host.is_TCS:
+            # For TCS, use hot reload and don't restart service
+            if host.is_TCS:
 
-            cron_file_contents = textwrap.dedent('''#!/bin/sh
+                cron_file_contents = textwrap.dedent('''#!/bin/sh
 
                 /usr/local/bin/geoipupdate
                 %s''' % (TCS_PSIPHOND_HOT_RELOAD_SIGNAL_COMMAND,))
 
-        else:
+            else:
 
-            cron_file_contents = textwrap.dedent('''#!/bin/sh
+                cron_file_contents = textwrap.dedent('''#!/bin/sh
 
                     /usr/local/bin/geoipupdate
                     %s restart''' % (posixpath.join(psi_config.HOST_INIT_DIR, 'psiphonv'),))
 
-        ssh.exec_command('echo "%s" > %s' % (cron_file_contents, cron_filename))
-        ssh.exec_command('chmod +x %s' % (cron_filename,))
+            ssh.exec_command('echo "%s" > %s' % (cron_file_contents, cron_filename))
+            ssh.exec_command('chmod +x %s' % (cron_filename,))
 
-        # Run the first update
-        ssh.exec_command(cron_filename)
-        ssh.close()
+            # Run the first update
+            ssh.exec_command(cron_filename)
 
         host.log('deploy geoip autoupdates')
 
@@ -40,8 +40,13 @@ def _calculate_bucket_count(length):
 
 # http://stackoverflow.com/questions/2659900/python-slicing-a-list-into-n-nearly-equal-length-partitions
 def _partition(lst, n):
+    return [ _get_partition(lst, n, i) for i in xrange(n) ]
+
+
+def _get_partition(lst, n, i):
+    # The i-th of the n partitions made by _partition, without building the others
     division = len(lst) / float(n)
-    return [ lst[int(round(division * i)): int(round(division * (i + 1)))] for i in xrange(n) ]
+    return lst[int(round(division * i)): int(round(division * (i + 1)))]
 
 
 def calculate_ip_address_strategy_value(ip_address):
@@ -90,8 +95,9 @@ def select_servers(servers, ip_address_strategy_value, time_in_seconds=None):
     
     bucket_count = _calculate_bucket_count(len(servers))
 
-    buckets = _partition(servers, bucket_count)
-    bucket = buckets[int(ip_address_strategy_value) % len(buckets)]
+    # Only the selected bucket is sliced out, so selection cost doesn't grow
+    # with the number of servers
+    bucket = _get_partition(servers, bucket_count, int(ip_address_strategy_value) % bucket_count)
     server = bucket[time_strategy_value % len(bucket)]
 
     return [server]
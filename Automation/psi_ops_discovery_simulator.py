@@ -0,0 +1,265 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, Psiphon Inc.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+
+Discovery strategy simulator.
+
+Computes psi_ops_discovery.select_servers selections for large grids of client
+IP addresses and times in batch, and reports how evenly the selections are
+spread over the discovery servers and how many servers a client network can
+enumerate. Run the benchmark suite before and after changing
+_calculate_bucket_count or TIME_GRANULARITY to compare them:
+
+  python psi_ops_discovery_simulator.py [--time-granularity SECONDS]
+
+Selection only depends on the strategy value of the client's /24, a byte,
+and on the time truncated to TIME_GRANULARITY. So instead of enumerating
+every (IP address, time) pair, the simulator counts the IP addresses for each
+strategy value and the times for each time value, and weights the selections
+for each (strategy value, time value) pair by those counts.
+
+'''
+
+import time
+import socket
+import struct
+import random
+import argparse
+import numpy
+
+import psi_ops_discovery
+
+
+STRATEGY_VALUE_COUNT = 256
+
+# Maximum number of time values to compute selections for at once; bounds
+# memory use to about STRATEGY_VALUE_COUNT * TIME_VALUE_CHUNK_SIZE * 24 bytes
+TIME_VALUE_CHUNK_SIZE = 65536
+
+
+def ip_address_to_int(ip_address):
+    return struct.unpack('!I', socket.inet_aton(ip_address))[0]
+
+
+def int_to_ip_address(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def ip_address_network(ip_address, prefix_length):
+    # All IP addresses in the network, as an array of integers
+    first = ip_address_to_int(ip_address) & ~((1 << (32 - prefix_length)) - 1) & 0xFFFFFFFF
+    return numpy.arange(first, first + (1 << (32 - prefix_length)), dtype=numpy.uint32)
+
+
+def time_range(start, stop, step):
+    return numpy.arange(start, stop, step, dtype=numpy.int64)
+
+
+def calculate_ip_address_strategy_values(ip_addresses):
+    # The strategy value only depends on the first 3 octets, so the HMAC is
+    # calculated once per /24
+    prefixes, inverse = numpy.unique(numpy.asarray(ip_addresses, dtype=numpy.uint32) >> 8,
+                                     return_inverse=True)
+    values = numpy.array(
+                [psi_ops_discovery.calculate_ip_address_strategy_value(int_to_ip_address(int(prefix) << 8))
+                 for prefix in prefixes],
+                dtype=numpy.int64)
+    return values[inverse]
+
+
+def get_bucket_layout(server_count, bucket_count_function=None):
+    # Returns (bucket starts, bucket lengths), as indexes into the server list.
+    # Uses psi_ops_discovery._get_partition itself: its rounding differs from
+    # numpy.round for halves.
+    if bucket_count_function is None:
+        bucket_count_function = psi_ops_discovery._calculate_bucket_count
+    bucket_count = bucket_count_function(server_count)
+    indexes = range(server_count)
+    starts = []
+    lengths = []
+    for i in range(bucket_count):
+        bucket = psi_ops_discovery._get_partition(indexes, bucket_count, i)
+        starts.append(bucket[0] if bucket else 0)
+        lengths.append(len(bucket))
+    return numpy.array(starts, dtype=numpy.int64), numpy.array(lengths, dtype=numpy.int64)
+
+
+class SimulationResult(object):
+
+    def __init__(self, server_count, bucket_count, load, network_exposure, selection_count):
+        # load: number of selections of each server
+        # network_exposure: number of distinct servers selected for each /24
+        #     in the grid, over all of the times
+        self.server_count = server_count
+        self.bucket_count = bucket_count
+        self.load = load
+        self.network_exposure = network_exposure
+        self.selection_count = selection_count
+
+    def gini(self):
+        # 0 when every server is selected equally often
+        load = numpy.sort(self.load).astype(numpy.float64)
+        total = load.sum()
+        if total == 0:
+            return 0.0
+        n = len(load)
+        return float((2.0 * numpy.sum(numpy.arange(1, n + 1) * load)) / (n * total) - (n + 1.0) / n)
+
+    def max_min_ratio(self):
+        minimum = self.load.min()
+        if minimum == 0:
+            return float('inf')
+        return float(self.load.max()) / minimum
+
+    def exposed_server_count(self):
+        # Servers which any client in the grid can discover
+        return int(numpy.count_nonzero(self.load))
+
+
+def simulate_select_servers(server_count, ip_addresses, times,
+                            time_granularity=None, bucket_count_function=None):
+
+    # Equivalent to calling select_servers(servers, strategy value, time) for
+    # every IP address and time, with len(servers) == server_count
+
+    if time_granularity is None:
+        time_granularity = psi_ops_discovery.TIME_GRANULARITY
+
+    starts, lengths = get_bucket_layout(server_count, bucket_count_function)
+    bucket_count = len(starts)
+
+    network_strategy_values = calculate_ip_address_strategy_values(
+                                    numpy.unique(numpy.asarray(ip_addresses, dtype=numpy.uint32) >> 8) << 8)
+    ip_address_counts = numpy.bincount(calculate_ip_address_strategy_values(ip_addresses),
+                                       minlength=STRATEGY_VALUE_COUNT)
+    time_values, time_value_counts = numpy.unique(numpy.asarray(times, dtype=numpy.int64) // time_granularity,
+                                                  return_counts=True)
+
+    # Bucket start and length for each strategy value
+    strategy_value_buckets = numpy.arange(STRATEGY_VALUE_COUNT) % bucket_count
+    strategy_value_starts = starts[strategy_value_buckets][:, numpy.newaxis]
+    strategy_value_lengths = lengths[strategy_value_buckets][:, numpy.newaxis]
+
+    load = numpy.zeros(server_count, dtype=numpy.int64)
+    for chunk_start in xrange(0, len(time_values), TIME_VALUE_CHUNK_SIZE):
+        chunk_time_values = time_values[chunk_start:chunk_start + TIME_VALUE_CHUNK_SIZE]
+        chunk_time_value_counts = time_value_counts[chunk_start:chunk_start + TIME_VALUE_CHUNK_SIZE]
+        server_indexes = strategy_value_starts + chunk_time_values[numpy.newaxis, :] % strategy_value_lengths
+        weights = ip_address_counts[:, numpy.newaxis] * chunk_time_value_counts[numpy.newaxis, :]
+        load += numpy.bincount(server_indexes.ravel(), weights=weights.ravel(),
+                               minlength=server_count).astype(numpy.int64)
+
+    # A /24 is always in the same bucket, and over time sees as many of the
+    # bucket's servers as there are distinct time values modulo its length
+    distinct_items = dict((length, len(numpy.unique(time_values % length)))
+                          for length in set(lengths.tolist()))
+    network_exposure = numpy.array(
+                [distinct_items[length] for length in lengths[network_strategy_values % bucket_count].tolist()],
+                dtype=numpy.int64)
+
+    return SimulationResult(server_count, bucket_count, load, network_exposure,
+                            len(ip_addresses) * len(times))
+
+
+def _select_servers_loop(server_count, ip_addresses, times):
+    # Reference implementation: calls select_servers for each IP address and time
+    servers = range(server_count)
+    load = numpy.zeros(server_count, dtype=numpy.int64)
+    for ip_address in ip_addresses:
+        ip_address_strategy_value = psi_ops_discovery.calculate_ip_address_strategy_value(
+                                        int_to_ip_address(int(ip_address)))
+        for time_in_seconds in times:
+            load[psi_ops_discovery.select_servers(
+                    servers, ip_address_strategy_value, int(time_in_seconds))[0]] += 1
+    return load
+
+
+def _check(start_time):
+    # The simulator must match select_servers exactly
+    ip_addresses = ip_address_network('192.168.0.0', 22)
+    times = time_range(start_time, start_time + 60*60*24, 60*10)
+    for server_count in [1, 2, 3, 7, 30, 200]:
+        loop_start_time = time.time()
+        expected = _select_servers_loop(server_count, ip_addresses, times)
+        loop_elapsed = time.time() - loop_start_time
+        simulation_start_time = time.time()
+        result = simulate_select_servers(server_count, ip_addresses, times)
+        simulation_elapsed = time.time() - simulation_start_time
+        if not numpy.array_equal(expected, result.load):
+            raise Exception('simulation differs from select_servers with %d servers' % (server_count,))
+        print 'check %4d servers: %d selections, select_servers %.3f s, simulation %.3f s' % (
+                server_count, result.selection_count, loop_elapsed, simulation_elapsed)
+
+
+def _benchmark(time_granularity=None):
+
+    # Fixed start time so runs are comparable
+    start_time = 1451606400
+    minute = 60
+    hour = 60*60
+    day = 60*60*24
+    week = 7*day
+
+    random.seed(0)
+    random_networks = numpy.concatenate(
+        [ip_address_network('%d.%d.%d.0' % (random.randint(1, 223), random.randint(0, 255), random.randint(0, 255)), 24)
+         for _ in range(1024)])
+
+    scenarios = [
+        ('A /24, every minute for 24 hours',
+         ip_address_network('192.168.1.0', 24),
+         time_range(start_time, start_time + day, minute)),
+        ('A /16, every minute for a week',
+         ip_address_network('10.1.0.0', 16),
+         time_range(start_time, start_time + week, minute)),
+        ('1024 random /24s, every minute for a week',
+         random_networks,
+         time_range(start_time, start_time + week, minute)),
+        ('A /24, every hour for 30 days',
+         ip_address_network('192.168.1.0', 24),
+         time_range(start_time, start_time + 30*day, hour)),
+    ]
+
+    _check(start_time)
+
+    for (scenario_name, ip_addresses, times) in scenarios:
+        print '\n' + scenario_name + '\n'
+        for server_count in [30, 200, 2000]:
+            simulation_start_time = time.time()
+            result = simulate_select_servers(server_count, ip_addresses, times, time_granularity)
+            elapsed = time.time() - simulation_start_time
+            print 'servers: %d, bucket count: %d, selections: %d, elapsed: %.3f s' % (
+                    server_count, result.bucket_count, result.selection_count, elapsed)
+            print '  load: min %d, mean %.1f, max %d, max/min %.2f, gini %.3f' % (
+                    result.load.min(), result.load.mean(), result.load.max(),
+                    result.max_min_ratio(), result.gini())
+            print '  servers discoverable per /24: mean %.1f, max %d (%.1f%%)' % (
+                    result.network_exposure.mean(), result.network_exposure.max(),
+                    100.0 * result.network_exposure.max() / server_count)
+            print '  servers discoverable by the whole grid: %d (%.1f%%)' % (
+                    result.exposed_server_count(), 100.0 * result.exposed_server_count() / server_count)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate discovery server selection')
+    parser.add_argument('--time-granularity', type=int,
+                        help='simulate a different psi_ops_discovery.TIME_GRANULARITY (seconds)')
+    args = parser.parse_args()
+    _benchmark(args.time_granularity)
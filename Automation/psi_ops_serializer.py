@@ -0,0 +1,310 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, Psiphon Inc.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+
+Schema-aware serialization for PersistentObject databases.
+
+File layout:
+
+  <header JSON>\n<section JSON><section JSON>...
+
+The header names the object class, lists the fields of each recordtype class
+used in the file (the schema), and gives the byte offset and length of each
+section. There is one section per object attribute, so a section can be
+decoded on its own; with lazy loading the file is memory-mapped and sections
+are decoded on first use.
+
+Values are plain JSON, except for these tagged single-key objects:
+
+  {"py/r": [<schema index>, <field value>, ...]}    recordtype instance
+  {"py/dt": [year, month, day, hour, minute, second, microsecond]}
+  {"py/date": [year, month, day]}
+  {"py/tuple": [...]}
+  {"py/set": [...]}
+  {"py/dd": [<default factory name>, [[key, value], ...]]}   defaultdict
+  {"py/dict": [[key, value], ...]}     dict with non-string or "py/" keys
+  {"py/jsonpickle": "<jsonpickle>"}    any other object
+
+Decoding tagged values is done in json's object_hook, so only dicts are
+visited in Python. Records are restored by field name when the file schema
+doesn't match the current class: missing fields are set to None and the
+object's upgrade() is expected to fill them in.
+
+'''
+
+import sys
+import os
+import json
+import mmap
+import datetime
+import threading
+import collections
+import importlib
+import jsonpickle
+
+
+FORMAT_NAME = 'psi_ops'
+FORMAT_VERSION = 1
+
+_DEFAULT_FACTORIES = {
+    'set': set,
+    'list': list,
+    'dict': dict,
+    'str': str,
+    'int': int,
+    'bool': bool
+}
+
+
+def _is_recordtype(obj):
+    # psi_utils.recordtype classes have slots and implement __getstate__/__setstate__
+    cls = type(obj)
+    return hasattr(cls, '__slots__') and hasattr(cls, 'todict') and hasattr(cls, '__setstate__')
+
+
+def _class_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def _load_class(name):
+    module_name, class_name = name.rsplit('.', 1)
+    # Classes may have been defined in a module run as a script
+    if module_name == '__main__' and not hasattr(sys.modules['__main__'], class_name):
+        module_name = 'psi_ops'
+    module = sys.modules.get(module_name) or importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+class _Encoder(object):
+
+    def __init__(self):
+        self.schema = []
+        self.schema_index = {}
+
+    def encode(self, value):
+        if value is None or isinstance(value, (bool, int, long, float, basestring)):
+            return value
+        value_type = type(value)
+        if value_type is list:
+            return [self.encode(item) for item in value]
+        if value_type is dict:
+            if all(isinstance(key, basestring) and not key.startswith('py/') for key in value):
+                return dict((key, self.encode(item)) for key, item in value.iteritems())
+            return {'py/dict': [[self.encode(key), self.encode(item)] for key, item in value.iteritems()]}
+        if value_type is tuple:
+            return {'py/tuple': [self.encode(item) for item in value]}
+        if value_type in (set, frozenset):
+            return {'py/set': [self.encode(item) for item in value]}
+        if value_type is datetime.datetime and value.tzinfo is None:
+            return {'py/dt': [value.year, value.month, value.day,
+                              value.hour, value.minute, value.second, value.microsecond]}
+        if value_type is datetime.date:
+            return {'py/date': [value.year, value.month, value.day]}
+        if (value_type is collections.defaultdict and
+                value.default_factory in _DEFAULT_FACTORIES.values()):
+            return {'py/dd': [value.default_factory.__name__,
+                              [[self.encode(key), self.encode(item)] for key, item in value.iteritems()]]}
+        if _is_recordtype(value):
+            return {'py/r': [self.__get_schema_index(value_type)] +
+                            [self.encode(item) for item in value.__getstate__()]}
+        return {'py/jsonpickle': jsonpickle.encode(value)}
+
+    def __get_schema_index(self, cls):
+        index = self.schema_index.get(cls)
+        if index is None:
+            index = len(self.schema)
+            self.schema.append([_class_name(cls), list(cls.__slots__)])
+            self.schema_index[cls] = index
+        return index
+
+
+class _Decoder(object):
+
+    def __init__(self, schema):
+        # For each schema entry: (class, None) when the file's fields match
+        # the class, else (class, [(field name, position in file)...])
+        self.records = []
+        for class_name, fields in schema:
+            cls = _load_class(class_name)
+            if list(cls.__slots__) == fields:
+                self.records.append((cls, None))
+            else:
+                positions = dict((field, position) for position, field in enumerate(fields))
+                self.records.append((cls, [(field, positions.get(field)) for field in cls.__slots__]))
+        self.tags = {
+            'py/r': self.__decode_record,
+            'py/dt': lambda value: datetime.datetime(*value),
+            'py/date': lambda value: datetime.date(*value),
+            'py/tuple': tuple,
+            'py/set': set,
+            'py/dd': lambda value: collections.defaultdict(_DEFAULT_FACTORIES[value[0]], value[1]),
+            'py/dict': dict,
+            'py/jsonpickle': jsonpickle.decode
+        }
+
+    def object_hook(self, value):
+        if len(value) == 1:
+            key = next(iter(value))
+            if key.startswith('py/'):
+                return self.tags[key](value[key])
+        return value
+
+    def __decode_record(self, value):
+        cls, field_positions = self.records[value[0]]
+        obj = cls.__new__(cls)
+        if field_positions is None:
+            obj.__setstate__(tuple(value[1:]))
+        else:
+            for field, position in field_positions:
+                setattr(obj, field, value[position + 1] if position is not None else None)
+        return obj
+
+    def decode(self, text):
+        return json.loads(text, object_hook=self.object_hook)
+
+
+def is_serialized(data):
+    # True for data in this format; False for legacy jsonpickle data
+    return data.startswith('{"format": "%s"' % (FORMAT_NAME,))
+
+
+def encode(obj, exclude_attributes=()):
+    encoder = _Encoder()
+    sections = []
+    offset = 0
+    for name, value in obj.__dict__.iteritems():
+        if name in exclude_attributes:
+            continue
+        section = json.dumps(encoder.encode(value), separators=(',', ':'))
+        sections.append((name, offset, len(section), section))
+        offset += len(section)
+    # Field order matters: is_serialized() checks the start of the header
+    header = '{"format": "%s", "format_version": %d, "class": %s, "schema": %s, "sections": %s}' % (
+                FORMAT_NAME,
+                FORMAT_VERSION,
+                json.dumps(_class_name(type(obj))),
+                json.dumps(encoder.schema),
+                json.dumps([[name, section_offset, length] for (name, section_offset, length, _) in sections]))
+    return header + '\n' + ''.join(section for (_, _, _, section) in sections)
+
+
+class LazySections(object):
+
+    # Memory-mapped sections of a file which haven't been decoded yet
+
+    def __init__(self, file, decoder, body_offset, sections):
+        self.lock = threading.Lock()
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.decoder = decoder
+        self.body_offset = body_offset
+        self.sections = sections
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def names(self):
+        with self.lock:
+            return self.sections.keys()
+
+    def load(self, obj, name):
+        # Decodes the section into obj's attribute, unless another thread
+        # already has
+        with self.lock:
+            if name not in self.sections:
+                return obj.__dict__[name]
+            offset, length = self.sections.pop(name)
+            start = self.body_offset + offset
+            value = self.decoder.decode(self.map[start:start + length])
+            obj.__dict__[name] = value
+            if not self.sections:
+                self.map.close()
+            return value
+
+
+def decode(file, lazy=False):
+    # Returns (object, LazySections or None). The caller is responsible for
+    # loading lazy sections on attribute access (see PersistentObject).
+    header_line = file.readline()
+    header = json.loads(header_line)
+    if header['format'] != FORMAT_NAME or header['format_version'] > FORMAT_VERSION:
+        raise ValueError('unsupported data format %s %s' % (header['format'], header['format_version']))
+    decoder = _Decoder(header['schema'])
+    cls = _load_class(header['class'])
+    obj = cls.__new__(cls)
+    body_offset = len(header_line)
+    if lazy:
+        sections = dict((name, (offset, length)) for (name, offset, length) in header['sections'])
+        return obj, LazySections(file, decoder, body_offset, sections)
+    body = file.read()
+    for name, offset, length in header['sections']:
+        obj.__dict__[name] = decoder.decode(body[offset:offset + length])
+    return obj, None
+
+
+# ===== Benchmark =====
+
+def _measure_load(filename, mode):
+    # Runs in a fresh process so peak RSS reflects only this load
+    import resource
+    import time
+    import psi_ops
+    start_time = time.time()
+    psinet = psi_ops.PsiphonNetwork.load_from_file(filename, lazy=(mode == 'lazy'))
+    if mode == 'lazy':
+        # What psi_web needs for handshakes
+        psinet.build_handshake_index()
+    elapsed = time.time() - start_time
+    print '%s %f %d' % (mode, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _benchmark(filename):
+    # Compare load time and peak RSS of a jsonpickle data file with the same
+    # data in this format, loaded fully and lazily
+    import subprocess
+    import tempfile
+    import psi_ops
+    psinet = psi_ops.PsiphonNetwork.load_from_file(filename)
+    with tempfile.NamedTemporaryFile(delete=False) as file:
+        file.write(jsonpickle.encode(psinet))
+        jsonpickle_filename = file.name
+    with tempfile.NamedTemporaryFile(delete=False) as file:
+        file.write(psinet.encode())
+        serialized_filename = file.name
+    try:
+        print 'jsonpickle size: %d bytes, serialized size: %d bytes' % (
+                os.path.getsize(jsonpickle_filename), os.path.getsize(serialized_filename))
+        for mode, mode_filename in [('jsonpickle', jsonpickle_filename),
+                                    ('full', serialized_filename),
+                                    ('lazy', serialized_filename)]:
+            output = subprocess.check_output(
+                        [sys.executable, __file__, '--measure', mode, mode_filename])
+            mode, elapsed, max_rss = output.strip().split('\n')[-1].split()
+            print '%-12s load: %8.3f s  peak RSS: %8d KB' % (mode, float(elapsed), int(max_rss))
+    finally:
+        os.remove(jsonpickle_filename)
+        os.remove(serialized_filename)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        _measure_load(sys.argv[3], sys.argv[2])
+    else:
+        import psi_ops_cms
+        _benchmark(sys.argv[1] if len(sys.argv) > 1 else psi_ops_cms.PSI_OPS_DB_FILENAME)
@@ -19,8 +19,12 @@
 
 import os
 import re
+import hashlib
+import cStringIO
 import textwrap
 import gzip
+import shutil
+import tempfile
 import csv
 import datetime
 import collections
@@ -29,6 +33,7 @@ import traceback
 import psycopg2
 import sys
 import multiprocessing
+import Queue
 import argparse
 import iso8601
 
@@ -43,6 +48,24 @@ PSI_OPS_DB_FILENAME = os.path.join(os.path.abspath('.'), 'psi_ops_stats.dat')
 
 TESTING_PROPAGATION_CHANNEL_NAME = 'Testing'
 
+# Log entries buffered per event type before a bulk insert (see BulkWriter)
+BULK_INSERT_BATCH_SIZE = 100000
+
+# Log file checkpoints identify a log by the MD5 of up to this many bytes at
+# its start
+FINGERPRINT_SIZE = 4096
+
+# Parsed log entries are sent from the parser processes to the writer in
+# batches of this many entries, with at most PARSED_ENTRIES_QUEUE_SIZE batches
+# in flight
+PARSED_ENTRIES_BATCH_SIZE = 10000
+PARSED_ENTRIES_QUEUE_SIZE = 16
+
+# When no parser process has sent anything for this long, check for parser
+# processes which have died (e.g., killed when out of memory) without
+# reporting their log file as done
+PARSER_IDLE_CHECK_SECONDS = 60
+
 
 # Stats database schema consists of one table per event type. The tables
 # have a column per log line field.
@@ -395,6 +418,14 @@ LOG_EVENT_TYPE_SCHEMA = {
     }
 
 
+EVENT_COLUMNS = {}
+
+for event_type, event_fields in LOG_EVENT_TYPE_SCHEMA.iteritems():
+    EVENT_COLUMNS[event_type] = LOG_ENTRY_COMMON_FIELDS + event_fields
+    assert(event_fields[0] == 'server_id' or 'server_id' not in event_fields)
+    assert(len(LOG_ENTRY_COMMON_FIELDS) == 2)
+
+
 def iso8601_to_utc(timestamp):
     localized_datetime = datetime.datetime.strptime(timestamp[:26], '%Y-%m-%dT%H:%M:%S.%f')
     # NOTE: strptime slow! Consider replacing with robust version of following.
@@ -421,66 +452,402 @@ def fix_timestamp(timestamp):
             pass
     return timestamp
 
-def process_stats(host, servers, db_cur, psinet, minimal, error_file=None):
+def get_row_hash(field_values):
+    # Identifies a log entry in its event table. Unlike the unique constraints
+    # on all columns, this also matches entries with NULL values.
+    return hashlib.md5(u'\x1f'.join(
+        u'\\N' if value is None else value for value in field_values).encode('utf-8')).hexdigest()
 
-    print 'process stats from host %s...' % (host.id,)
 
-    server_ip_address_to_id = {}
-    for server in servers:
-        server_ip_address_to_id[server.internal_ip_address] = server.id
+def copy_escape(value):
+    # Format a value for COPY FROM text input
+    if value is None:
+        return '\\N'
+    return value.encode('utf-8').replace(
+        '\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
 
-    line_re = re.compile(LOG_LINE_PATTERN)
 
-    # Download each log file from the host, parse each line and insert
-    # log entries into database.
+# Log file checkpoints, see processed_log_files in psi_process_stats.sql
 
-    directory = os.path.join(LOCAL_LOG_ROOT, host.id)
-    if not os.path.exists(directory):
-        return
+LogFileCheckpoint = collections.namedtuple(
+    'LogFileCheckpoint',
+    'filename inode size byte_offset fingerprint fingerprint_size')
 
-    # Only process logs lines after last timestamp processed. This gives a
-    # significant performance boost.
 
-    db_cur[None].execute(
-        'select last_timestamp from processed_logs where host_id = %s',
-        [host.id])
-    last_timestamp = db_cur[None].fetchone()
-    if last_timestamp:
-        last_timestamp = last_timestamp[0]
-    next_last_timestamp = None
+def open_log_file(path):
+    if path.endswith('.gz'):
+        # Older log file archives are in gzip format. Offsets and fingerprints
+        # are in the uncompressed log.
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def get_log_file_fingerprint(file, size):
+    file.seek(0)
+    return hashlib.md5(file.read(size)).hexdigest()
+
+
+class LogFileParser(object):
+
+    # Parses, validates and normalizes the new entries in a host log file:
+    # the lines after the host's checkpoint for the file, if any. After
+    # entries() is consumed, checkpoint is the file's new checkpoint and
+    # next_last_timestamp is the latest timestamp seen.
+    #
+    # last_timestamp is only used for hosts which don't have checkpoints yet.
 
-    # Prepare some loop invariant formatted strings. Gives a significant
-    # performance boots vs. formatting per log line.
+    def __init__(self, host_id, path, checkpoints, last_timestamp, server_ip_address_to_id,
+                 excluded_propagation_channel_ids, minimal, error_file=None):
+        self.host_id = host_id
+        self.path = path
+        self.checkpoints = checkpoints
+        self.last_timestamp = last_timestamp
+        self.server_ip_address_to_id = server_ip_address_to_id
+        self.excluded_propagation_channel_ids = excluded_propagation_channel_ids
+        self.minimal = minimal
+        self.error_file = error_file
+        self.checkpoint = None
+        self.next_last_timestamp = None
+        self.lines_processed = 0
 
-    event_columns = {}
-    event_sql = {}
+    def entries(self):
+        # Yields (event_type, field_values)
 
-    for event_type, event_fields in LOG_EVENT_TYPE_SCHEMA.iteritems():
-        event_columns[event_type] = LOG_ENTRY_COMMON_FIELDS + event_fields
-        assert(event_fields[0] == 'server_id' or 'server_id' not in event_fields)
-        assert(len(LOG_ENTRY_COMMON_FIELDS) == 2)
-        table_name = event_type
-        if event_type.find('.') != -1:
+        line_re = re.compile(LOG_LINE_PATTERN)
+        last_timestamp = self.last_timestamp
+        error_file = self.error_file
+
+        filename = os.path.basename(self.path)
+        stat = os.stat(self.path)
+
+        # A log file which hasn't changed since it was processed isn't read
+        for checkpoint in self.checkpoints:
+            if (checkpoint.filename == filename and
+                    checkpoint.inode == stat.st_ino and
+                    checkpoint.size == stat.st_size):
+                self.checkpoint = checkpoint
+                return
+
+        file = open_log_file(self.path)
+        try:
+            # Resume after the last line processed. Log rotation renames
+            # (and compresses) files, so the checkpoint is found by the
+            # fingerprint of the start of the log, trying the same file
+            # name first.
+            offset = 0
+            for checkpoint in sorted(self.checkpoints, key=lambda checkpoint: checkpoint.filename != filename):
+                if get_log_file_fingerprint(file, checkpoint.fingerprint_size) == checkpoint.fingerprint:
+                    offset = checkpoint.byte_offset
+                    break
+            file.seek(offset)
+
+            while True:
+                line = file.readline()
+                if not line.endswith('\n'):
+                    # End of file, or a partial line which was still being
+                    # written when the log was pulled
+                    break
+                offset += len(line)
+                line = line[:-1]
+
+                match = line_re.match(line)
+                if (not match or
+                    not LOG_EVENT_TYPE_SCHEMA.has_key(match.group(3))):
+                    err = 'unexpected log line pattern: %s' % (line,)
+                    if error_file:
+                        error_file.write(err + '\n')
+                    continue
+
+                # Note: We convert timestamps here to UTC so that they can all be rationally compared without
+                #       taking the timezone into consideration. This eases matching of outbound statistics
+                #       (and any other records that may not have consistent timezone info) to sessions.
+                # Update: no longer calling iso8601_to_utc(timestamp) as database can perform translation
+
+                timestamp = match.group(1)
+
+                # If we cannot parse the matched string as an ISO8601 timestamp, zero out the time and
+                # try to produce a valid timestamp. If this fails too, don't change the matched timestamp
+                timestamp = fix_timestamp(timestamp)
+
+                # Last timestamp check, for hosts without checkpoints
+                # Note: - assuming lexicographical order (ISO8601)
+                #       - broken for 1 hour DST window or backwards moving server clock
+                #       - Strict < check to not skip new logs in same time... but this will
+                #         also guarantee reprocessing of the last line for each host
+
+                if last_timestamp and timestamp < last_timestamp:
+                    continue
+
+                host_id = self.host_id
+                event_type = match.group(3)
+
+                if self.minimal:
+                    if event_type not in ['connected', 'page_views']:
+                        continue
+
+                if not self.next_last_timestamp or timestamp > self.next_last_timestamp:
+                    self.next_last_timestamp = timestamp
+
+                event_values = [event_value.decode('utf-8', 'replace') for event_value in match.group(4).split()]
+                event_fields = LOG_EVENT_TYPE_SCHEMA[event_type]
+
+                if len(event_values) != len(event_fields):
+                    # Backwards compatibility case
+                    event_type = '%s.%d' % (event_type, len(event_values))
+                    if event_type not in LOG_EVENT_TYPE_SCHEMA:
+                        err = 'invalid log line fields %s' % (line,)
+                        if error_file:
+                            error_file.write(err + '\n')
+                        continue
+                    event_fields = LOG_EVENT_TYPE_SCHEMA[event_type]
+
+                if len(event_values) != len(event_fields):
+                    err = 'invalid log line fields %s' % (line,)
+                    if error_file:
+                        error_file.write(err + '\n')
+                    continue
+
+                field_names = EVENT_COLUMNS[event_type]
+
+                field_values = [timestamp, host_id] + event_values
+                assert(len(field_names) == len(field_values))
+
+                # Check for invalid bytes value for bytes_transferred
+
+                if event_type == 'bytes_transferred.8':
+                    assert(field_names[9] == 'bytes')
+                    # Client version 24 had a bug which resulted in
+                    # corrupt byte transferred values, so discard them
+                    assert(field_names[6] == 'client_version')
+                    if int(field_values[6]) == 24:
+                        continue
+
+                invalid_byte_field = False
+                for index, field_name in enumerate(field_names):
+                    if field_name == 'bytes':
+                        # This is an integer field
+                        if not (0 <= int(field_values[index]) < 2147483647):
+                            err = 'invalid byte fields %s' % (line,)
+                            print err
+                            if error_file:
+                                error_file.write(err + '\n')
+                            invalid_byte_field = True
+                            break
+                if invalid_byte_field:
+                    continue
+
+                # Don't record entries for testing or deployment-validation logs
+                try:
+                    if field_values[field_names.index('propagation_channel_id')] in self.excluded_propagation_channel_ids:
+                        continue
+                except:
+                    # propagation_channel_id is not present
+                    pass
+
+                # Replace server IP addresses with server IDs in
+                # stats to keep IP addresses confidental in reporting.
+
+                for index, field_name in enumerate(field_names):
+                    if field_name == 'server_id' or field_name == 'discovery_server_id':
+                        field_values[index] = self.server_ip_address_to_id.get(field_values[index], 'Unknown')
+
+                # Fixup for last_connected: this field (in the log) contains either a timestamp,
+                # 'None' (meaning a first time connection), or 'Unknown' (meaning an old client that
+                # doesn't send this info connected)
+                if event_type.find('connected') == 0:
+                    for index, field_name in enumerate(field_names):
+                        if field_name == 'last_connected':
+                            if field_values[index] == 'Unknown':
+                                field_values[index] = None
+                            elif field_values[index] == 'None':
+                                field_values[index] = '1900-01-01T00:00:00Z'
+                            else:
+                                field_values[index] = fix_timestamp(field_values[index])
+
+                self.lines_processed += 1
+
+                yield event_type, field_values
+
+            fingerprint_size = min(FINGERPRINT_SIZE, offset)
+            self.checkpoint = LogFileCheckpoint(
+                                    filename,
+                                    stat.st_ino,
+                                    stat.st_size,
+                                    offset,
+                                    get_log_file_fingerprint(file, fingerprint_size),
+                                    fingerprint_size)
+
+        finally:
+            file.close()
+
+
+class LineWriter(object):
+
+    # Writes log entries one at a time, skipping entries already present
+
+    def __init__(self, db_cur):
+        self.db_cur = db_cur
+
+        # Prepare some loop invariant formatted strings. Gives a significant
+        # performance boots vs. formatting per log line.
+
+        self.event_sql = {}
+
+        for event_type, columns in EVENT_COLUMNS.iteritems():
             table_name = event_type.split('.')[0]
-        command = 'insert into %s (%s) select %s where not exists (select 1 from %s where %s)' % (
-                        table_name,
-                        ', '.join(event_columns[event_type]),
-                        ', '.join(['%s']*len(event_columns[event_type])),
-                        table_name,
-                        ' and '.join(['%s = %%s' % x for x in event_columns[event_type]]))
-        event_sql[event_type] = command
-
-        # Add special case statement to use when last_connected is NULL
-        if 'last_connected' in event_columns[event_type]:
             command = 'insert into %s (%s) select %s where not exists (select 1 from %s where %s)' % (
                             table_name,
-                            ', '.join(event_columns[event_type]),
-                            ', '.join(['%s']*len(event_columns[event_type])),
+                            ', '.join(columns),
+                            ', '.join(['%s']*len(columns)),
                             table_name,
-                            ' and '.join([('%s is %%s' % x) if x == 'last_connected' else ('%s = %%s' % x)
-                                        for x in event_columns[event_type]]))
-            event_sql[event_type + '.last_connected_NULL'] = command
+                            ' and '.join(['%s = %%s' % x for x in columns]))
+            self.event_sql[event_type] = command
+
+            # Add special case statement to use when last_connected is NULL
+            if 'last_connected' in columns:
+                command = 'insert into %s (%s) select %s where not exists (select 1 from %s where %s)' % (
+                                table_name,
+                                ', '.join(columns),
+                                ', '.join(['%s']*len(columns)),
+                                table_name,
+                                ' and '.join([('%s is %%s' % x) if x == 'last_connected' else ('%s = %%s' % x)
+                                            for x in columns]))
+                self.event_sql[event_type + '.last_connected_NULL'] = command
+
+    @staticmethod
+    def prepare(field_values):
+        # Returns the entry to pass to write()
+        return field_values
+
+    def write(self, event_type, field_values):
+
+        # SQL injection note: the table name isn't parameterized
+        # and comes from log file data, but it's implicitly
+        # validated by hash table lookups
+
+        command_type = event_type
+        if 'last_connected' in EVENT_COLUMNS[event_type]:
+            if field_values[EVENT_COLUMNS[event_type].index('last_connected')] is None:
+                # Use alternate SQL that works with NULL values
+                command_type += '.last_connected_NULL'
+        command = self.event_sql[command_type]
+
+        try:
+            table = event_type.split('.')[0]
+            if table in self.db_cur:
+                cursor = self.db_cur[table]
+            else:
+                cursor = self.db_cur[None]
+            cursor.execute(command, field_values + field_values)
+        except psycopg2.DataError as data_error:
+            print field_values[1] + ': ' + str(data_error)
+
+    def flush(self):
+        pass
+
+
+class BulkWriter(object):
+
+    # Writes log entries in batches: each event type's entries are loaded with
+    # COPY into a temporary staging table, and then inserted into the event
+    # table with a single statement which skips entries already present.
+    # Entries are matched by row hash, and by the tables' other unique
+    # constraints for rows inserted without one (by LineWriter, or before the
+    # row_hash columns were added).
+
+    def __init__(self, db_cur):
+        self.db_cur = db_cur
+        self.__check_database()
+        self.buffers = {}
+        self.buffer_counts = collections.defaultdict(int)
+        self.staging_tables = set()
+        self.inserted_count = 0
+
+    @staticmethod
+    def prepare(field_values):
+        # Returns the entry to pass to write(): a line of COPY input. Called
+        # by the log parser processes, to keep this work out of the writer.
+        return '\t'.join([copy_escape(value) for value in field_values] +
+                         [get_row_hash(field_values)]) + '\n'
+
+    def write(self, event_type, line):
+        buffer = self.buffers.get(event_type)
+        if buffer is None:
+            buffer = self.buffers[event_type] = cStringIO.StringIO()
+        buffer.write(line)
+        self.buffer_counts[event_type] += 1
+        if self.buffer_counts[event_type] >= BULK_INSERT_BATCH_SIZE:
+            self.__flush_event_type(event_type)
+
+    def flush(self):
+        for event_type in self.buffers.keys():
+            self.__flush_event_type(event_type)
+
+    def __check_database(self):
+        # ON CONFLICT needs PostgreSQL 9.5, and the row_hash columns are added
+        # by the upgrade in psi_process_stats.sql
+        tables = set(event_type.split('.')[0] for event_type in EVENT_COLUMNS)
+        for cursor_table, cursor in self.db_cur.iteritems():
+            if cursor.connection.server_version < 90500:
+                raise Exception('bulk insert requires PostgreSQL 9.5 or later')
+            cursor.execute(
+                'select table_name from information_schema.columns '
+                'where table_schema = any (current_schemas(false)) and column_name = %s',
+                ['row_hash'])
+            upgraded_tables = set(row[0] for row in cursor.fetchall())
+            cursor_tables = [table for table in tables
+                             if table == cursor_table or (cursor_table is None and table not in self.db_cur)]
+            missing_tables = [table for table in cursor_tables if table not in upgraded_tables]
+            if missing_tables:
+                raise Exception('bulk insert requires row_hash columns (see psi_process_stats.sql); missing in: %s' % (
+                                    ', '.join(sorted(missing_tables)),))
+
+    def __flush_event_type(self, event_type):
+        data = self.buffers.pop(event_type).getvalue()
+        del self.buffer_counts[event_type]
+        try:
+            self.__insert(event_type, data)
+        except psycopg2.DataError:
+            # Retry one entry at a time to skip only the invalid entries
+            for line in data.split('\n')[:-1]:
+                try:
+                    self.__insert(event_type, line + '\n')
+                except psycopg2.DataError as data_error:
+                    print line.split('\t')[1] + ': ' + str(data_error)
+
+    def __insert(self, event_type, data):
+        table = event_type.split('.')[0]
+        cursor = self.db_cur[table] if table in self.db_cur else self.db_cur[None]
+        staging_table = 'staging_' + event_type.replace('.', '_')
+        columns = ', '.join(EVENT_COLUMNS[event_type] + ('row_hash',))
+        if (table, staging_table) not in self.staging_tables:
+            cursor.execute('create temporary table if not exists %s as select %s from %s with no data' % (
+                                staging_table, columns, table))
+            self.staging_tables.add((table, staging_table))
+        cursor.execute('savepoint bulk_insert')
+        try:
+            cursor.copy_expert(
+                'copy %s (%s) from stdin' % (staging_table, columns),
+                cStringIO.StringIO(data))
+            cursor.execute(
+                'insert into %s (%s) select distinct on (row_hash) %s from %s on conflict do nothing' % (
+                    table, columns, columns, staging_table))
+            self.inserted_count += cursor.rowcount
+            cursor.execute('truncate %s' % (staging_table,))
+        except psycopg2.DataError:
+            cursor.execute('rollback to savepoint bulk_insert')
+            raise
+        cursor.execute('release savepoint bulk_insert')
+
+
+def get_server_ip_address_to_id(servers):
+    server_ip_address_to_id = {}
+    for server in servers:
+        server_ip_address_to_id[server.internal_ip_address] = server.id
+    return server_ip_address_to_id
+
 
+def get_excluded_propagation_channel_ids(psinet):
     # Don't record entries for testing or deployment-validation logs.
     # Manual and automated testing are typically done with a propagation channel
     # name of 'Testing' (which we're going to look up in psinet to get the ID).
@@ -489,172 +856,277 @@ def process_stats(host, servers, db_cur, psinet, minimal, error_file=None):
     excluded_propagation_channel_ids = []
     if TESTING_PROPAGATION_CHANNEL_NAME:
         excluded_propagation_channel_ids += [psinet.get_propagation_channel_by_name(TESTING_PROPAGATION_CHANNEL_NAME).id]
+    return excluded_propagation_channel_ids
 
-    for filename in os.listdir(directory):
-        if re.match(HOST_LOG_FILENAME_PATTERN, filename):
-            path = os.path.join(directory, filename)
-            if filename.endswith('.gz'):
-                # Older log file archives are in gzip format
-                file = gzip.open(path)
-            else:
-                file = open(path)
-            print 'processing %s...' % (filename,)
-            lines_processed = 0
-            try:
-                lines = file.read().split('\n')
-                for line in reversed(lines):
-                    match = line_re.match(line)
-                    if (not match or
-                        not LOG_EVENT_TYPE_SCHEMA.has_key(match.group(3))):
-                        err = 'unexpected log line pattern: %s' % (line,)
-                        if error_file:
-                            error_file.write(err + '\n')
-                        continue
 
-                    # Note: We convert timestamps here to UTC so that they can all be rationally compared without
-                    #       taking the timezone into consideration. This eases matching of outbound statistics
-                    #       (and any other records that may not have consistent timezone info) to sessions.
-                    # Update: no longer calling iso8601_to_utc(timestamp) as database can perform translation
+def get_log_file_paths(host_id):
+    directory = os.path.join(LOCAL_LOG_ROOT, host_id)
+    if not os.path.exists(directory):
+        return []
+    return [os.path.join(directory, filename) for filename in os.listdir(directory)
+            if re.match(HOST_LOG_FILENAME_PATTERN, filename)]
+
+
+def get_last_timestamp(db_cur, host_id):
+    # Before a host has log file checkpoints, only process logs lines after
+    # last timestamp processed
+    db_cur[None].execute(
+        'select last_timestamp from processed_logs where host_id = %s',
+        [host_id])
+    last_timestamp = db_cur[None].fetchone()
+    if last_timestamp:
+        return last_timestamp[0]
+    return None
+
+
+def set_last_timestamp(db_cur, host_id, last_timestamp, next_last_timestamp):
+    if next_last_timestamp:
+        if not last_timestamp:
+            db_cur[None].execute(
+                'insert into processed_logs (host_id, last_timestamp) values (%s, %s)',
+                [host_id, next_last_timestamp])
+        else:
+            db_cur[None].execute(
+                'update processed_logs set last_timestamp = %s where host_id = %s',
+                [next_last_timestamp, host_id])
+
 
-                    timestamp = match.group(1)
+def get_log_file_checkpoints(db_cur, host_id):
+    db_cur[None].execute(
+        'select filename, inode, size, byte_offset, fingerprint, fingerprint_size '
+        'from processed_log_files where host_id = %s',
+        [host_id])
+    return [LogFileCheckpoint(*row) for row in db_cur[None].fetchall()]
 
-                    # If we cannot parse the matched string as an ISO8601 timestamp, zero out the time and
-                    # try to produce a valid timestamp. If this fails too, don't change the matched timestamp
-                    timestamp = fix_timestamp(timestamp)
 
-                    # Last timestamp check
-                    # Note: - assuming lexicographical order (ISO8601)
-                    #       - currently broken for 1 hour DST window or backwards moving server clock
-                    #       - Strict < check to not skip new logs in same time... but this will
-                    #         also guarantee reprocessing of the last line for each host
+def set_log_file_checkpoints(db_cur, host_id, checkpoints):
+    # Replaces the host's checkpoints, so checkpoints for log files which are
+    # no longer pulled are dropped
+    db_cur[None].execute(
+        'delete from processed_log_files where host_id = %s',
+        [host_id])
+    for checkpoint in checkpoints:
+        db_cur[None].execute(
+            'insert into processed_log_files (host_id, filename, inode, size, byte_offset, fingerprint, fingerprint_size) '
+            'values (%s, %s, %s, %s, %s, %s, %s)',
+            [host_id] + list(checkpoint))
 
-                    if last_timestamp and timestamp < last_timestamp:
-                        # Assumes processing the lines in reverse chronological order
-                        break
 
-                    host_id = host.id
-                    event_type = match.group(3)
+def get_writer_class(bulk):
+    if bulk:
+        return BulkWriter
+    return LineWriter
 
-                    if minimal:
-                        if event_type not in ['connected', 'page_views']:
-                            continue
 
-                    if not next_last_timestamp or timestamp > next_last_timestamp:
-                        next_last_timestamp = timestamp
+def process_stats(host, servers, db_cur, psinet, minimal, error_file=None, bulk=False):
 
-                    event_values = [event_value.decode('utf-8', 'replace') for event_value in match.group(4).split()]
-                    event_fields = LOG_EVENT_TYPE_SCHEMA[event_type]
+    # Process the new log entries for one host, in this process.
+    # See process_stats_for_hosts for processing many hosts in parallel.
 
-                    if len(event_values) != len(event_fields):
-                        # Backwards compatibility case
-                        event_type = '%s.%d' % (event_type, len(event_values))
-                        if event_type not in LOG_EVENT_TYPE_SCHEMA:
-                            err = 'invalid log line fields %s' % (line,)
-                            if error_file:
-                                error_file.write(err + '\n')
-                            continue
-                        event_fields = LOG_EVENT_TYPE_SCHEMA[event_type]
+    print 'process stats from host %s...' % (host.id,)
 
-                    if len(event_values) != len(event_fields):
-                        err = 'invalid log line fields %s' % (line,)
-                        if error_file:
-                            error_file.write(err + '\n')
-                        continue
+    server_ip_address_to_id = get_server_ip_address_to_id(servers)
+    excluded_propagation_channel_ids = get_excluded_propagation_channel_ids(psinet)
 
-                    field_names = event_columns[event_type]
+    checkpoints = get_log_file_checkpoints(db_cur, host.id)
+    last_timestamp = get_last_timestamp(db_cur, host.id)
+    next_last_timestamp = None
+    next_checkpoints = []
 
-                    field_values = [timestamp, host_id] + event_values
-                    assert(len(field_names) == len(field_values))
+    writer = get_writer_class(bulk)(db_cur)
 
-                    # Check for invalid bytes value for bytes_transferred
+    for path in get_log_file_paths(host.id):
+        print 'processing %s...' % (os.path.basename(path),)
+        parser = LogFileParser(host.id, path, checkpoints, None if checkpoints else last_timestamp,
+                               server_ip_address_to_id, excluded_propagation_channel_ids, minimal, error_file)
+        for event_type, field_values in parser.entries():
+            writer.write(event_type, writer.prepare(field_values))
+        next_checkpoints.append(parser.checkpoint)
+        if parser.next_last_timestamp > next_last_timestamp:
+            next_last_timestamp = parser.next_last_timestamp
+        print '%d new lines processed' % (parser.lines_processed)
+        sys.stdout.flush()
 
-                    if event_type == 'bytes_transferred.8':
-                        assert(field_names[9] == 'bytes')
-                        # Client version 24 had a bug which resulted in
-                        # corrupt byte transferred values, so discard them
-                        assert(field_names[6] == 'client_version')
-                        if int(field_values[6]) == 24:
-                            continue
+    writer.flush()
+    if bulk:
+        print '%d new log entries inserted' % (writer.inserted_count,)
 
-                    invalid_byte_field = False
-                    for index, field_name in enumerate(field_names):
-                        if field_name == 'bytes':
-                            # This is an integer field
-                            if not (0 <= int(field_values[index]) < 2147483647):
-                                err = 'invalid byte fields %s' % (line,)
-                                print err
-                                if error_file:
-                                    error_file.write(err + '\n')
-                                invalid_byte_field = True
-                                break
-                    if invalid_byte_field:
-                        continue
+    set_last_timestamp(db_cur, host.id, last_timestamp, next_last_timestamp)
+    set_log_file_checkpoints(db_cur, host.id, next_checkpoints)
 
-                    # Don't record entries for testing or deployment-validation logs
-                    try:
-                        if field_values[field_names.index('propagation_channel_id')] in excluded_propagation_channel_ids:
-                            continue
-                    except:
-                        # propagation_channel_id is not present
-                        pass
 
-                    # Replace server IP addresses with server IDs in
-                    # stats to keep IP addresses confidental in reporting.
+# Log parsing runs in a process pool. Workers send parsed entries in batches,
+# through a bounded queue, to the single writer in the main process.
 
-                    for index, field_name in enumerate(field_names):
-                        if field_name == 'server_id' or field_name == 'discovery_server_id':
-                            field_values[index] = server_ip_address_to_id.get(field_values[index], 'Unknown')
-
-                    # Fixup for last_connected: this field (in the log) contains either a timestamp,
-                    # 'None' (meaning a first time connection), or 'Unknown' (meaning an old client that
-                    # doesn't send this info connected)
-                    if event_type.find('connected') == 0:
-                        for index, field_name in enumerate(field_names):
-                            if field_name == 'last_connected':
-                                if field_values[index] == 'Unknown':
-                                    # Use alternate SQL that works with NULL values
-                                    event_type += '.last_connected_NULL'
-                                    field_values[index] = None
-                                elif field_values[index] == 'None':
-                                    field_values[index] = '1900-01-01T00:00:00Z'
-                                else:
-                                    field_values[index] = fix_timestamp(field_values[index])
-
-                    # SQL injection note: the table name isn't parameterized
-                    # and comes from log file data, but it's implicitly
-                    # validated by hash table lookups
-
-                    command = event_sql[event_type]
+_log_parser_queue = None
+_log_parser_arguments = None
 
-                    try:
-                        table = event_type
-                        if table.find('.') != -1:
-                            table = table.split('.')[0]
-                        if table in db_cur:
-                            cursor = db_cur[table]
-                        else:
-                            cursor = db_cur[None]
-                        cursor.execute(command, field_values + field_values)
-                    except psycopg2.DataError as data_error:
-                        print host.id + ': ' + filename + ': ' + str(data_error)
-
-                    lines_processed += 1
 
-            finally:
-                file.close()
+def _initialize_log_parser_worker(queue, server_ip_address_to_id, excluded_propagation_channel_ids, minimal, writer_class):
+    global _log_parser_queue
+    global _log_parser_arguments
+    _log_parser_queue = queue
+    _log_parser_arguments = (server_ip_address_to_id, excluded_propagation_channel_ids, minimal, writer_class)
+
+
+def _parse_log_file_worker(args):
+    host_id, path, checkpoints, last_timestamp = args
+    server_ip_address_to_id, excluded_propagation_channel_ids, minimal, writer_class = _log_parser_arguments
+    _log_parser_queue.put(('start', (host_id, path, os.getpid())))
+    parser = LogFileParser(host_id, path, checkpoints, last_timestamp, server_ip_address_to_id,
+                           excluded_propagation_channel_ids, minimal)
+    error = None
+    try:
+        entries = []
+        for event_type, field_values in parser.entries():
+            entries.append((event_type, writer_class.prepare(field_values)))
+            if len(entries) >= PARSED_ENTRIES_BATCH_SIZE:
+                _log_parser_queue.put(('entries', entries))
+                entries = []
+        if entries:
+            _log_parser_queue.put(('entries', entries))
+    except Exception as e:
+        for line in traceback.format_exc().split('\n'):
+            print line
+        error = str(e)
+    finally:
+        _log_parser_queue.put(('done', (host_id, path, parser.checkpoint, parser.next_last_timestamp,
+                                        parser.lines_processed, error)))
+
+
+def _is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def process_stats_for_hosts(hosts, servers, psinet, minimal, bulk, processes=None):
+
+    # Returns [(host_id, elapsed time), ...]
+
+    queue = multiprocessing.Queue(PARSED_ENTRIES_QUEUE_SIZE)
+    pool = multiprocessing.Pool(
+                processes,
+                initializer=_initialize_log_parser_worker,
+                initargs=(queue,
+                          get_server_ip_address_to_id(servers),
+                          get_excluded_propagation_channel_ids(psinet),
+                          minimal,
+                          get_writer_class(bulk)))
+
+    db_conn = build_db_connections()
+    results = []
+
+    try:
+        cursors = {}
+        for table, conn in db_conn.iteritems():
+            cursors[table] = conn.cursor()
 
-            print '%d new lines processed' % (lines_processed)
+        writer = get_writer_class(bulk)(cursors)
+
+        tasks = []
+        last_timestamps = {}
+        next_last_timestamps = {}
+        next_checkpoints = {}
+        remaining_file_counts = {}
+        errors = {}
+        start_times = {}
+        for host in hosts:
+            paths = get_log_file_paths(host.id)
+            if not paths:
+                continue
+            checkpoints = get_log_file_checkpoints(cursors, host.id)
+            last_timestamps[host.id] = get_last_timestamp(cursors, host.id)
+            next_last_timestamps[host.id] = None
+            next_checkpoints[host.id] = []
+            remaining_file_counts[host.id] = len(paths)
+            start_times[host.id] = time.time()
+            tasks += [(host.id, path, checkpoints, None if checkpoints else last_timestamps[host.id])
+                      for path in paths]
+
+        def finish_task(host_id, path, checkpoint, next_last_timestamp, error):
+            del pending_tasks[(host_id, path)]
             sys.stdout.flush()
+            if error:
+                errors[host_id] = error
+            else:
+                next_checkpoints[host_id].append(checkpoint)
+            if next_last_timestamp > next_last_timestamps[host_id]:
+                next_last_timestamps[host_id] = next_last_timestamp
+            remaining_file_counts[host_id] -= 1
+            if remaining_file_counts[host_id] == 0:
+                # All of the host's entries have been queued before its last
+                # 'done' message; write them out and commit with the host's
+                # new checkpoints. Don't advance the checkpoints past entries
+                # from a file which failed to parse or whose parser died.
+                writer.flush()
+                if host_id not in errors:
+                    set_last_timestamp(cursors, host_id, last_timestamps[host_id], next_last_timestamps[host_id])
+                    set_log_file_checkpoints(cursors, host_id, next_checkpoints[host_id])
+                for connection in db_conn.itervalues():
+                    connection.commit()
+                results.append((host_id, time.time()-start_times[host_id]))
+
+        result = pool.map_async(_parse_log_file_worker, tasks, chunksize=1)
+
+        # (host_id, path) -> pid of the parser process, for started tasks
+        pending_tasks = dict(((host_id, path), None) for (host_id, path, _, _) in tasks)
+        tasks_lost = False
+        while pending_tasks:
+            try:
+                message_type, message = queue.get(timeout=PARSER_IDLE_CHECK_SECONDS)
+            except Queue.Empty:
+                # Python 2's Pool replaces a parser process which dies, but
+                # its task is lost. Fail the tasks of dead parser processes;
+                # if no task is running, the remaining ones will never run.
+                lost_tasks = [task for (task, pid) in pending_tasks.iteritems()
+                              if pid is not None and not _is_process_running(pid)]
+                if not lost_tasks and all(pid is None for pid in pending_tasks.itervalues()):
+                    lost_tasks = pending_tasks.keys()
+                if not lost_tasks:
+                    continue
+                tasks_lost = True
+                error = 'parser process exited'
+                if result.ready() and not result.successful():
+                    try:
+                        result.get()
+                    except Exception as e:
+                        error = 'parser failed: %s' % (str(e),)
+                for (host_id, path) in lost_tasks:
+                    print '%s: %s' % (path, error)
+                    finish_task(host_id, path, None, None, error)
+                continue
+
+            if message_type == 'entries':
+                for event_type, entry in message:
+                    writer.write(event_type, entry)
+                continue
+
+            host_id, path = message[:2]
+            if (host_id, path) not in pending_tasks:
+                # Already failed as lost
+                continue
+            if message_type == 'start':
+                pending_tasks[(host_id, path)] = message[2]
+            else:
+                _, _, checkpoint, next_last_timestamp, lines_processed, error = message
+                print '%s: %d new lines processed' % (path, lines_processed)
+                finish_task(host_id, path, checkpoint, next_last_timestamp, error)
 
-    if next_last_timestamp:
-        if not last_timestamp:
-            db_cur[None].execute(
-                'insert into processed_logs (host_id, last_timestamp) values (%s, %s)',
-                [host.id, next_last_timestamp])
+        if tasks_lost:
+            # The pool waits for the lost tasks' results forever on close()
+            pool.terminate()
         else:
-            db_cur[None].execute(
-                'update processed_logs set last_timestamp = %s where host_id = %s',
-                [next_last_timestamp, host.id])
+            pool.close()
+            pool.join()
+    finally:
+        pool.terminate()
+        for connection in db_conn.itervalues():
+            connection.close()
+
+    return results
 
 
 def reconstruct_sessions(db):
@@ -728,36 +1200,6 @@ def update_servers(db, psinet):
     cursor.execute('COMMIT')
 
 
-def process_stats_on_host(args):
-
-    start_time = time.time()
-
-    host = args[0]
-    servers = args[1]
-    psinet = args[2]
-    minimal = args[3]
-
-    db_conn = build_db_connections()
-    cursors = {}
-
-    try:
-        for table, conn in db_conn.iteritems():
-            cursors[table] = conn.cursor()
-        process_stats(host, servers, cursors, psinet, minimal)
-        for cursor in cursors.itervalues():
-            cursor.close()
-        for connection in db_conn.itervalues():
-            connection.commit()
-    except Exception as e:
-        for line in traceback.format_exc().split('\n'):
-            print line
-    finally:
-        for connection in db_conn.itervalues():
-            connection.close()
-
-    return (host.id, time.time()-start_time)
-
-
 def build_db_connections():
     db_conn = {}
     if hasattr(psi_ops_stats_credentials,'DB_MAP'):
@@ -779,13 +1221,117 @@ def build_db_connections():
     return db_conn
 
 
+def benchmark_ingestion(line_count):
+    # Compare per-line, bulk and parallel bulk ingestion throughput on synthetic
+    # logs for BENCHMARK_HOST_COUNT hosts. Each host's log is pulled "twice"
+    # (two files with the same lines, as when a log is pulled again after
+    # rotation), so half of the lines are duplicates. Each run uses a scratch
+    # schema, created from psi_process_stats.sql, in the stats database.
+
+    global LOCAL_LOG_ROOT
+
+    BENCHMARK_HOST_COUNT = 4
+
+    BenchmarkHost = collections.namedtuple('BenchmarkHost', 'id')
+    BenchmarkServer = collections.namedtuple('BenchmarkServer', 'id internal_ip_address')
+
+    psinet = psi_ops.PsiphonNetwork(initialize_plugins=False)
+    psinet.is_locked = True
+    psinet.add_propagation_channel(TESTING_PROPAGATION_CHANNEL_NAME, [])
+    hosts = [BenchmarkHost('benchmark%d' % (i,)) for i in range(BENCHMARK_HOST_COUNT)]
+    servers = [BenchmarkServer('server%d' % (i,), '10.0.0.%d' % (i,)) for i in range(1, 5)]
+
+    event_formats = [
+        'handshake %(ip)s CA Toronto ISP 0123456789ABCDEF FEDCBA9876543210 75 Android_4.4 OSSH 0',
+        'connected %(ip)s CA Toronto ISP 0123456789ABCDEF FEDCBA9876543210 75 Android_4.4 OSSH 0 %(session)s None',
+        'status OSSH %(session)s',
+        'bytes_transferred %(ip)s CA Toronto ISP 0123456789ABCDEF FEDCBA9876543210 75 Android_4.4 OSSH 0 %(session)s 1 %(bytes)d',
+        'page_views %(ip)s CA Toronto ISP 0123456789ABCDEF FEDCBA9876543210 75 Android_4.4 OSSH 0 %(session)s 1 example.com 3',
+        'disconnected OSSH %(session)s']
+
+    log_root = tempfile.mkdtemp()
+    saved_log_root = LOCAL_LOG_ROOT
+    LOCAL_LOG_ROOT = log_root
+    # Connections opened by process_stats_for_hosts use the scratch schema too
+    saved_pgoptions = os.environ.get('PGOPTIONS')
+    os.environ['PGOPTIONS'] = '-c search_path=psi_process_stats_benchmark'
+    try:
+        start = datetime.datetime(2016, 1, 1)
+        for host in hosts:
+            os.mkdir(os.path.join(log_root, host.id))
+            with open(os.path.join(log_root, host.id, 'psiphonv.log'), 'w') as file:
+                for i in xrange(line_count / (2 * len(hosts))):
+                    timestamp = (start + datetime.timedelta(microseconds=i)).strftime('%Y-%m-%dT%H:%M:%S.%f-05:00')
+                    event = event_formats[i % len(event_formats)] % {
+                                'ip': servers[i % len(servers)].internal_ip_address,
+                                'session': '%032x' % (i / len(event_formats),),
+                                'bytes': i}
+                    file.write('%s %s psiphonv: %s\n' % (timestamp, host.id, event))
+            shutil.copyfile(os.path.join(log_root, host.id, 'psiphonv.log'),
+                            os.path.join(log_root, host.id, 'psiphonv.log.1'))
+
+        for mode in ['per-line', 'bulk', 'parallel']:
+            db_conn = build_db_connections()
+            connection = db_conn.values()[0]
+            try:
+                cursor = connection.cursor()
+                cursor.execute('drop schema if exists psi_process_stats_benchmark cascade')
+                cursor.execute('create schema psi_process_stats_benchmark')
+                cursor.execute('set search_path to psi_process_stats_benchmark')
+                with open('psi_process_stats.sql') as file:
+                    cursor.execute(file.read())
+                connection.commit()
+
+                # The second run has no new log lines to process
+                for run in ['', ' (rerun)']:
+                    start_time = time.time()
+                    if mode == 'parallel':
+                        process_stats_for_hosts(hosts, servers, psinet, False, True)
+                    else:
+                        for host in hosts:
+                            process_stats(host, servers, {None: cursor}, psinet, False, bulk=(mode == 'bulk'))
+                            connection.commit()
+                    elapsed = time.time() - start_time
+
+                    row_count = 0
+                    for table in ['handshake', 'connected', 'status', 'bytes_transferred', 'page_views', 'disconnected']:
+                        cursor.execute('select count(*) from %s' % (table,))
+                        row_count += cursor.fetchone()[0]
+
+                    print '%-17s %10d lines  %10d rows  %8.1f s  %10.0f lines/s' % (
+                            mode + run, line_count, row_count, elapsed, line_count / elapsed)
+
+                cursor.execute('drop schema psi_process_stats_benchmark cascade')
+                connection.commit()
+            finally:
+                for connection in db_conn.itervalues():
+                    connection.close()
+    finally:
+        if saved_pgoptions is None:
+            del os.environ['PGOPTIONS']
+        else:
+            os.environ['PGOPTIONS'] = saved_pgoptions
+        LOCAL_LOG_ROOT = saved_log_root
+        shutil.rmtree(log_root)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-m', '--minimal', dest='minimal', action='store_true',
                         help='minimal processing')
+    parser.add_argument('-b', '--bulk', dest='bulk', action='store_true',
+                        help='bulk insert log entries with COPY (requires PostgreSQL 9.5 and row_hash columns, see psi_process_stats.sql)')
+    parser.add_argument('-p', '--processes', dest='processes', type=int,
+                        help='number of log parser processes (default: number of CPUs)')
+    parser.add_argument('--benchmark', dest='benchmark', type=int, metavar='LINE_COUNT',
+                        help='compare ingestion modes on a synthetic log, in a scratch schema')
     args = parser.parse_args()
 
+    if args.benchmark:
+        benchmark_ingestion(args.benchmark)
+        sys.exit(0)
+
     start_time = time.time()
 
     psinet = psi_ops.PsiphonNetwork.load_from_file(PSI_OPS_DB_FILENAME)
@@ -803,8 +1349,7 @@ if __name__ == "__main__":
         update_sponsors(db_conn[None], sponsors)
         update_servers(db_conn[None], psinet)
 
-        pool = multiprocessing.pool.ThreadPool(4)
-        results = pool.map(process_stats_on_host, [(host, servers, psinet, args.minimal) for host in hosts])
+        results = process_stats_for_hosts(hosts, servers, psinet, args.minimal, args.bulk, args.processes)
 
         # print results as a dict (sorted for visual inspection)
         print '{' + ','.join(['"%s": %f' % (host_id, host_time) for (host_id, host_time)
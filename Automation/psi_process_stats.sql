@@ -10,6 +10,28 @@ WITH (
   OIDS=FALSE
 );
 
+-- Table: processed_log_files
+
+-- Checkpoint for each log file pulled from a host: the file's inode and size,
+-- the offset in the (uncompressed) log after the last line processed, and an
+-- MD5 of the first fingerprint_size bytes of the log, to recognize the file
+-- after it's renamed or compressed by log rotation.
+
+CREATE TABLE processed_log_files
+(
+  host_id text NOT NULL,
+  filename text NOT NULL,
+  inode bigint NOT NULL,
+  size bigint NOT NULL,
+  byte_offset bigint NOT NULL,
+  fingerprint text NOT NULL,
+  fingerprint_size integer NOT NULL,
+  CONSTRAINT processed_log_files_pkey PRIMARY KEY (host_id, filename)
+)
+WITH (
+  OIDS=FALSE
+);
+
 -- Table: connected
 
 CREATE TABLE connected
@@ -29,9 +51,11 @@ CREATE TABLE connected
   session_id text,
   last_connected timestamp with time zone DEFAULT NULL,
   processed integer NOT NULL DEFAULT 0,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT connected_pkey PRIMARY KEY (id),
-  CONSTRAINT connected_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, last_connected)
+  CONSTRAINT connected_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, last_connected),
+  CONSTRAINT connected_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -46,9 +70,11 @@ CREATE TABLE disconnected
   relay_protocol text,
   session_id text,
   processed integer NOT NULL DEFAULT 0,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT disconnected_pkey PRIMARY KEY (id),
-  CONSTRAINT disconnected_unique UNIQUE ("timestamp", host_id, relay_protocol, session_id)
+  CONSTRAINT disconnected_unique UNIQUE ("timestamp", host_id, relay_protocol, session_id),
+  CONSTRAINT disconnected_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -72,9 +98,11 @@ CREATE TABLE discovery
   tunnel_whole_device int NOT NULL DEFAULT 0,
   discovery_server_id text,
   client_unknown text,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT discovery_pkey PRIMARY KEY (id),
-  CONSTRAINT discovery_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, discovery_server_id, client_unknown)
+  CONSTRAINT discovery_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, discovery_server_id, client_unknown),
+  CONSTRAINT discovery_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -96,9 +124,11 @@ CREATE TABLE download
   client_platform text,
   relay_protocol text,
   tunnel_whole_device int NOT NULL DEFAULT 0,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT download_pkey PRIMARY KEY (id),
-  CONSTRAINT download_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device)
+  CONSTRAINT download_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device),
+  CONSTRAINT download_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -121,9 +151,11 @@ CREATE TABLE failed
   relay_protocol text,
   tunnel_whole_device int NOT NULL DEFAULT 0,
   error_code text,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT failed_pkey PRIMARY KEY (id),
-  CONSTRAINT failed_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, error_code)
+  CONSTRAINT failed_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, error_code),
+  CONSTRAINT failed_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -145,9 +177,11 @@ CREATE TABLE handshake
   client_platform text,
   relay_protocol text,
   tunnel_whole_device int NOT NULL DEFAULT 0,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT handshake_pkey PRIMARY KEY (id),
-  CONSTRAINT handshake_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device)
+  CONSTRAINT handshake_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device),
+  CONSTRAINT handshake_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -160,9 +194,11 @@ CREATE TABLE started
   "timestamp" timestamp with time zone,
   host_id text,
   server_id text,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT started_pkey PRIMARY KEY (id),
-  CONSTRAINT started_unique UNIQUE ("timestamp", host_id, server_id)
+  CONSTRAINT started_unique UNIQUE ("timestamp", host_id, server_id),
+  CONSTRAINT started_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -177,9 +213,11 @@ CREATE TABLE status
   relay_protocol text,
   session_id text,
   processed integer NOT NULL DEFAULT 0,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT status_pkey PRIMARY KEY (id),
-  CONSTRAINT status_unique UNIQUE ("timestamp", host_id, relay_protocol, session_id)
+  CONSTRAINT status_unique UNIQUE ("timestamp", host_id, relay_protocol, session_id),
+  CONSTRAINT status_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -204,9 +242,11 @@ CREATE TABLE bytes_transferred
   session_id text DEFAULT NULL,
   connected text DEFAULT NULL,
   bytes integer NOT NULL,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT bytes_transferred_pkey PRIMARY KEY (id),
-  CONSTRAINT bytes_transferred_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, connected, bytes)
+  CONSTRAINT bytes_transferred_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, connected, bytes),
+  CONSTRAINT bytes_transferred_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -232,9 +272,11 @@ CREATE TABLE page_views
   connected text DEFAULT NULL,
   pagename text,
   viewcount integer NOT NULL,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT page_views_pkey PRIMARY KEY (id),
-  CONSTRAINT page_views_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, connected, pagename, viewcount)
+  CONSTRAINT page_views_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, connected, pagename, viewcount),
+  CONSTRAINT page_views_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -260,9 +302,11 @@ CREATE TABLE https_requests
   connected text DEFAULT NULL,
   "domain" text,
   count integer NOT NULL,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT https_requests_pkey PRIMARY KEY (id),
-  CONSTRAINT https_requests_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, connected, "domain", count)
+  CONSTRAINT https_requests_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, connected, "domain", count),
+  CONSTRAINT https_requests_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -288,9 +332,11 @@ CREATE TABLE speed
   info text,
   milliseconds integer,
   "size" integer,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT speed_pkey PRIMARY KEY (id),
-  CONSTRAINT speed_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, "operation", info, milliseconds, "size")
+  CONSTRAINT speed_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, "operation", info, milliseconds, "size"),
+  CONSTRAINT speed_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -315,9 +361,11 @@ CREATE TABLE feedback
   session_id text,
   question text,
   answer text,
+  row_hash text,
   id bigserial NOT NULL,
   CONSTRAINT feedback_pkey PRIMARY KEY (id),
-  CONSTRAINT feedback_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, question, answer)
+  CONSTRAINT feedback_unique UNIQUE ("timestamp", host_id, server_id, client_region, client_city, client_isp, propagation_channel_id, sponsor_id, client_version, client_platform, relay_protocol, tunnel_whole_device, session_id, question, answer),
+  CONSTRAINT feedback_row_hash_unique UNIQUE (row_hash)
 )
 WITH (
   OIDS=FALSE
@@ -871,3 +919,38 @@ JOIN propagation_channel ON propagation_channel.id = feedback.propagation_channe
 JOIN sponsor ON  sponsor.id = feedback.sponsor_id
 JOIN server ON server.id = feedback.server_id;
 
+-- Upgrade: row hashes for bulk ingestion (psi_process_stats.py --bulk)
+--
+-- Adds the row_hash columns and unique constraints to databases created before
+-- they were added; does nothing for tables which already have them. Bulk
+-- ingestion checks for the columns before it starts.
+--
+-- Existing rows, and rows written by per-line ingestion, have a NULL row hash.
+-- Bulk ingestion inserts with ON CONFLICT DO NOTHING, so a log entry which is
+-- already present is skipped when it matches the table's <table>_unique
+-- constraint, as with per-line ingestion. Those constraints don't match
+-- entries with NULL values (such as a NULL last_connected), so entries like
+-- that which were inserted without a row hash can be inserted again.
+
+DO $$
+DECLARE
+  event_table text;
+BEGIN
+  FOREACH event_table IN ARRAY ARRAY['connected', 'disconnected', 'discovery', 'download', 'failed',
+                                     'handshake', 'started', 'status', 'bytes_transferred', 'page_views',
+                                     'https_requests', 'speed', 'feedback']
+  LOOP
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = event_table AND column_name = 'row_hash') THEN
+      EXECUTE format('ALTER TABLE %I ADD COLUMN row_hash text', event_table);
+      EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I UNIQUE (row_hash)', event_table, event_table || '_row_hash_unique');
+    END IF;
+  END LOOP;
+END
+$$;
+
+-- Upgrade: log file checkpoints
+--
+-- For databases created before processed_log_files was added, create the table
+-- as above. Until a host has checkpoints, its log files are processed from the
+-- processed_logs last_timestamp.
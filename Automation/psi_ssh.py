@@ -23,6 +23,9 @@ import sys
 import StringIO
 import socket
 import time
+import threading
+import contextlib
+import atexit
 
 try:
     import paramiko as ssh
@@ -88,45 +91,216 @@ class SSH(object):
 
         self.ssh.connect(ip_address, ssh_port, ssh_username, ssh_password, pkey=ssh_pkey, timeout=60)
 
+        # Open SFTP sessions which aren't in use, so that each file operation
+        # doesn't open a new one
+        self.__sftp_lock = threading.Lock()
+        self.__idle_sftps = []
+
     def close(self):
+        with self.__sftp_lock:
+            sftps, self.__idle_sftps = self.__idle_sftps, []
+        for sftp in sftps:
+            sftp.close()
         self.ssh.close()
 
+    def is_active(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def set_keepalive(self, interval):
+        self.ssh.get_transport().set_keepalive(interval)
+
     def exec_command(self, command_line):
         (_, output, _) = self.ssh.exec_command(command_line)
+        return self.__read_output(command_line, output)
+
+    def exec_commands(self, command_lines):
+        '''
+        Runs the commands at the same time, each in its own channel over this
+        connection, and returns a list of their outputs.
+        '''
+        outputs = [self.ssh.exec_command(command_line)[1] for command_line in command_lines]
+        return [self.__read_output(command_line, output)
+                for (command_line, output) in zip(command_lines, outputs)]
+
+    def __read_output(self, command_line, output):
         out = output.read()
         out = out.decode('utf-8')
         print 'SSH %s: %s %s' % (self.ip_address, command_line[0:20]+'...', out[:100])
         return out
 
+    @contextlib.contextmanager
+    def __sftp(self):
+        # Threads sharing this connection each get their own SFTP session
+        with self.__sftp_lock:
+            sftp = self.__idle_sftps.pop() if self.__idle_sftps else None
+        if sftp is None:
+            sftp = self.ssh.open_sftp()
+        try:
+            yield sftp
+        except:
+            sftp.close()
+            raise
+        with self.__sftp_lock:
+            self.__idle_sftps.append(sftp)
+
     def list_dir(self, remote_path):
         print 'SSH %s: list dir %s' % (self.ip_address, remote_path)
-        sftp = self.ssh.open_sftp()
-        list = sftp.listdir(remote_path)
-        sftp.close()
-        return list
+        with self.__sftp() as sftp:
+            return sftp.listdir(remote_path)
 
     def list_dir_attributes(self, remote_path):
         print 'SSH %s: list dir %s' % (self.ip_address, remote_path)
-        sftp = self.ssh.open_sftp()
-        list = sftp.listdir_attr(remote_path)
-        sftp.close()
-        return list
+        with self.__sftp() as sftp:
+            return sftp.listdir_attr(remote_path)
 
     def stat_file(self, remote_path):
         print 'SSH %s: stat file %s' % (self.ip_address, remote_path)
-        sftp = self.ssh.open_sftp()
-        attributes = sftp.lstat(remote_path)
-        sftp.close()
-        return attributes
+        with self.__sftp() as sftp:
+            return sftp.lstat(remote_path)
 
     def put_file(self, local_path, remote_path):
         print 'SSH %s: put file %s %s' % (self.ip_address, local_path, remote_path)
-        sftp = self.ssh.open_sftp()
-        sftp.put(local_path, remote_path)
-        sftp.close()
+        with self.__sftp() as sftp:
+            sftp.put(local_path, remote_path)
 
     def get_file(self, remote_path, local_path):
         print 'SSH %s: get file %s %s' % (self.ip_address, local_path, remote_path)
-        sftp = self.ssh.open_sftp()
-        sftp.get(remote_path, local_path)
-        sftp.close()
+        with self.__sftp() as sftp:
+            sftp.get(remote_path, local_path)
+
+
+# Pooled sessions are closed after being unused for this long
+SESSION_IDLE_TIMEOUT_SECONDS = 5*60
+
+# Keeps pooled sessions from being dropped by NAT and firewalls while idle
+SESSION_KEEPALIVE_INTERVAL_SECONDS = 30
+
+
+class _PooledSession(object):
+
+    def __init__(self):
+        # Held while connecting, so that concurrent users of a new session
+        # wait for one connection instead of each making their own
+        self.lock = threading.Lock()
+        self.ssh = None
+        self.users = 0
+        self.last_used = time.time()
+
+
+class SSHPool(object):
+    '''
+    Shares one SSH connection per host (and credentials) between callers,
+    including concurrent ones. Connections which fail are dropped and made
+    again on next use, and idle connections are closed after idle_timeout.
+    '''
+
+    def __init__(self,
+                 idle_timeout=SESSION_IDLE_TIMEOUT_SECONDS,
+                 keepalive_interval=SESSION_KEEPALIVE_INTERVAL_SECONDS):
+        self.__idle_timeout = idle_timeout
+        self.__keepalive_interval = keepalive_interval
+        self.__lock = threading.Lock()
+        self.__sessions = {}
+        self.__pid = os.getpid()
+        self.__evicter = None
+
+    @contextlib.contextmanager
+    def session(self,
+                ip_address,
+                ssh_port,
+                ssh_username,
+                ssh_password,
+                ssh_host_key,
+                ssh_pkey=None):
+        '''
+        Use as:
+            with pool.session(...) as ssh:
+                ssh.exec_command(...)
+        The session must not be closed by the caller.
+        '''
+        key = (ip_address, int(ssh_port), ssh_username, ssh_password, ssh_host_key, ssh_pkey)
+        session = self.__acquire(key)
+        try:
+            with session.lock:
+                if session.ssh is not None and not session.ssh.is_active():
+                    self.__close_ssh(session.ssh)
+                    session.ssh = None
+                if session.ssh is None:
+                    ssh = SSH(ip_address, ssh_port, ssh_username, ssh_password, ssh_host_key, ssh_pkey)
+                    ssh.set_keepalive(self.__keepalive_interval)
+                    session.ssh = ssh
+                ssh = session.ssh
+            yield ssh
+        finally:
+            self.__release(key, session)
+
+    def __acquire(self, key):
+        with self.__lock:
+            if os.getpid() != self.__pid:
+                # Connections made before a fork belong to the parent
+                self.__sessions = {}
+                self.__evicter = None
+                self.__pid = os.getpid()
+            if self.__evicter is None:
+                self.__evicter = threading.Thread(target=self.__evict_idle_sessions)
+                self.__evicter.daemon = True
+                self.__evicter.start()
+            session = self.__sessions.get(key)
+            if session is None:
+                session = _PooledSession()
+                self.__sessions[key] = session
+            session.users += 1
+            return session
+
+    def __release(self, key, session):
+        failed_ssh = None
+        with self.__lock:
+            session.users -= 1
+            session.last_used = time.time()
+            if session.users == 0 and session.ssh is not None and not session.ssh.is_active():
+                # Failed; don't keep it around until it's idle
+                failed_ssh = session.ssh
+                if self.__sessions.get(key) is session:
+                    del self.__sessions[key]
+        if failed_ssh:
+            self.__close_ssh(failed_ssh)
+
+    def __evict_idle_sessions(self):
+        while True:
+            time.sleep(min(self.__idle_timeout, 60))
+            self.evict_idle()
+
+    def evict_idle(self, idle_timeout=None):
+        if idle_timeout is None:
+            idle_timeout = self.__idle_timeout
+        evicted = []
+        with self.__lock:
+            now = time.time()
+            for key, session in self.__sessions.items():
+                if session.users == 0 and now - session.last_used >= idle_timeout:
+                    del self.__sessions[key]
+                    if session.ssh is not None:
+                        evicted.append(session.ssh)
+        for evicted_ssh in evicted:
+            self.__close_ssh(evicted_ssh)
+
+    def close_all(self):
+        self.evict_idle(0)
+
+    def __close_ssh(self, pooled_ssh):
+        try:
+            pooled_ssh.close()
+        except Exception:
+            pass
+
+
+_pool = SSHPool()
+atexit.register(_pool.close_all)
+
+
+def session(ip_address, ssh_port, ssh_username, ssh_password, ssh_host_key, ssh_pkey=None):
+    '''
+    A session from the shared SSHPool; see SSHPool.session.
+    '''
+    return _pool.session(ip_address, ssh_port, ssh_username, ssh_password, ssh_host_key, ssh_pkey)
@@ -44,22 +44,21 @@ def pull_log_files(host):
 
     print 'pull log files from host %s...' % (host.id,)
 
-    ssh = psi_ssh.SSH(
+    with psi_ssh.session(
             host.ip_address, host.ssh_port,
             host.stats_ssh_username, host.stats_ssh_password,
-            host.ssh_host_key)
-
-    dirlist = ssh.list_dir(HOST_LOG_DIR)
-    for filename in dirlist:
-        if re.match(HOST_LOG_FILENAME_PATTERN, filename):
-            try:
-                os.makedirs(os.path.join(LOCAL_LOG_ROOT, host.id))
-            except OSError:
-                pass
-            ssh.get_file(
-                posixpath.join(HOST_LOG_DIR, filename),
-                os.path.join(LOCAL_LOG_ROOT, host.id, filename))
-    ssh.close()
+            host.ssh_host_key) as ssh:
+
+        dirlist = ssh.list_dir(HOST_LOG_DIR)
+        for filename in dirlist:
+            if re.match(HOST_LOG_FILENAME_PATTERN, filename):
+                try:
+                    os.makedirs(os.path.join(LOCAL_LOG_ROOT, host.id))
+                except OSError:
+                    pass
+                ssh.get_file(
+                    posixpath.join(HOST_LOG_DIR, filename),
+                    os.path.join(LOCAL_LOG_ROOT, host.id, filename))
 
     print 'completed host %s' % (host.id,)
 
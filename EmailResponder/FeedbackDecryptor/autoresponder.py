@@ -22,6 +22,7 @@ import html2text
 import sys
 import re
 import json
+import argparse
 from mako.template import Template
 from mako.lookup import TemplateLookup
 import pynliner
@@ -46,6 +47,10 @@ import aws_helpers
 
 _SLEEP_TIME_SECS = 60
 _RESPONSES_DIR = 'responses'
+_TEMPLATE_FILENAME = 'templates/feedback_response.mako'
+
+# How often to check for changed response translations
+_RESPONSES_CHECK_INTERVAL_SECS = 60
 
 
 # Specifies which languages should be at the top of the email by default.
@@ -249,7 +254,7 @@ def _render_email(data):
 
     global _template
     if not _template:
-        _template = Template(filename='templates/feedback_response.mako',
+        _template = Template(filename=_TEMPLATE_FILENAME,
                              default_filters=['unicode', 'h', 'decode.utf8'],
                              input_encoding='utf-8', output_encoding='utf-8',
                               lookup=TemplateLookup(directories=['.']))
@@ -265,8 +270,180 @@ def _render_email(data):
     return rendered
 
 
+# Format specifiers in the response translations, like "%(0)s"
+_format_specifier_regex = re.compile(r'%(?:\((\w+)\)s|%)')
+
+# Stands in for the format specifier `name` of the `index`th response in a
+# rendered email, until the values are known. Alphanumeric, so that it comes
+# through HTML parsing, CSS inlining and conversion to text unchanged.
+_PLACEHOLDER_FORMAT = 'PSIFORMAT%dX%sX'
+_placeholder_regex = re.compile(r'PSIFORMAT(\d+)X(\w+?)X')
+
+
+class _ResponseRegistry(object):
+    '''
+    Holds the response translations, parsed, and the email bodies rendered
+    from them, with CSS inlined, for each response ID and user language.
+    Everything is reloaded when a response translation or the email template
+    changes (checked at most every _RESPONSES_CHECK_INTERVAL_SECS).
+
+    A rendered email has placeholders (see _PLACEHOLDER_FORMAT) where the
+    translations have format specifiers, as the values depend on the user's
+    sponsor and propagation channel. Rendering a response only fills them in.
+    '''
+
+    def __init__(self):
+        self._files_version = None
+        self._check_time = 0
+        # List of (lang, subject, {response_id: body}), in the order of
+        # os.walk (which decides the order of languages not in _TOP_LANGS)
+        self._translations = []
+        # (response_id, lang_id): (subject, body langs, body html, body text)
+        self._rendered = {}
+
+    def _get_files_version(self):
+        filenames = [_TEMPLATE_FILENAME]
+        for root, _, files in os.walk(_RESPONSES_DIR):
+            filenames += [os.path.join(root, name) for name in files]
+        version = []
+        for filename in filenames:
+            stat = os.stat(filename)
+            version.append((filename, stat.st_mtime, stat.st_size))
+        return version
+
+    def _load(self):
+        global _template
+
+        logger.debug_log('_ResponseRegistry._load: enter')
+
+        # Read in all translations HTML
+        translations = []
+        for root, _, files in os.walk(_RESPONSES_DIR):
+            for name in files:
+                lang, ext = os.path.splitext(name)
+                if ext != '.html':
+                    continue
+
+                if lang == 'master':
+                    lang = 'en'
+
+                with open(os.path.join(root, name)) as translation_file:
+                    translation = translation_file.read().decode('utf-8')
+
+                # Strip leading and trailing whitespace so that we don't get extra
+                # text elements in our BeautifulSoup
+                soup = BeautifulSoup(translation.strip())
+
+                subject = soup.find(id='default_response_subject')
+                if subject:
+                    # Strip outer element
+                    subject = u''.join(unicode(elem) for elem in subject.contents).strip()
+
+                bodies = {}
+                for body in soup.findAll(id=True):
+                    if body['id'] not in bodies:
+                        # Strip outer element
+                        bodies[body['id']] = u''.join(unicode(elem) for elem in body.contents).strip()
+
+                translations.append((lang, subject, bodies))
+
+        self._translations = translations
+        self._rendered = {}
+        # Pick up template changes too
+        _template = None
+
+        logger.debug_log('_ResponseRegistry._load: exiting with %d translations' % len(translations))
+
+    def _ensure_loaded(self):
+        now = time.time()
+        if self._files_version and now < self._check_time + _RESPONSES_CHECK_INTERVAL_SECS:
+            return
+        self._check_time = now
+        files_version = self._get_files_version()
+        if files_version != self._files_version:
+            self._load()
+            self._files_version = files_version
+
+    def get(self, response_id, lang_id):
+        '''
+        Returns (subject, body langs, body html, body text) for the response
+        to a user whose language is `lang_id` (which may be None). Body langs
+        are the languages of the response bodies in the email, in order; the
+        placeholders in the body are numbered by position in that list.
+        '''
+
+        self._ensure_loaded()
+
+        # Only the order of the languages depends on lang_id, and any language
+        # we don't have a translation for gives the same order
+        if lang_id not in [lang for (lang, _, _) in self._translations]:
+            lang_id = None
+
+        key = (response_id, lang_id)
+        if key not in self._rendered:
+            self._rendered[key] = self._render(response_id, lang_id)
+        return self._rendered[key]
+
+    def _render(self, response_id, lang_id):
+        logger.debug_log('_ResponseRegistry._render: enter')
+
+        # Reorder the translations according to the detected language and _TOP_LANGS
+        def lang_sorter(item):
+            lang = item[0]
+            rank = 999
+            try:
+                if lang == lang_id:
+                    rank = -1
+                else:
+                    rank = _TOP_LANGS.index(lang)
+            except ValueError:
+                pass
+            return rank
+
+        translations = sorted(self._translations, key=lang_sorter)
+
+        # Collect the translations of the specific response we're sending
+
+        subject = None
+        body_langs = []
+        bodies = []
+        for lang, lang_subject, lang_bodies in translations:
+            subject = subject or lang_subject
+            body = lang_bodies.get(response_id)
+            if body is not None:
+                index = len(bodies)
+
+                def placeholder(match):
+                    if not match.group(1):
+                        # "%%"
+                        return '%'
+                    return _PLACEHOLDER_FORMAT % (index, match.group(1))
+
+                body_langs.append(lang)
+                bodies.append(_format_specifier_regex.sub(placeholder, body))
+
+        # Render the email body from the Mako template
+        body_html = _render_email({
+            'lang_id': lang_id,
+            'response_id': response_id,
+            'responses': bodies
+        })
+
+        logger.debug_log('_ResponseRegistry._render: exit')
+
+        return (subject, body_langs, body_html, _html_to_text(body_html))
+
+
+_responses = _ResponseRegistry()
+
+
+def _fill_placeholders(rendered, format_dicts):
+    return _placeholder_regex.sub(lambda match: format_dicts[int(match.group(1))][match.group(2)],
+                                  rendered)
+
+
 def _get_response_content(response_id, diagnostic_info):
-    """Gets the response for the given response_id. diagnostic_info will be
+    '''Gets the response for the given response_id. diagnostic_info will be
     used to determine language and some content, but may be None.
 
     Returns a dict of the form:
@@ -278,7 +455,7 @@ def _get_response_content(response_id, diagnostic_info):
         }
 
     Returns None if no response content can be derived.
-    """
+    '''
 
     logger.debug_log('_get_response_content: enter')
 
@@ -297,41 +474,6 @@ def _get_response_content(response_id, diagnostic_info):
     lang_id = _get_lang_id_from_diagnostic_info(diagnostic_info)
     # lang_id may be None, if the language could not be determined
 
-    # Read in all translations HTML
-    response_translations = []
-    for root, _, files in os.walk(_RESPONSES_DIR):
-        for name in files:
-            lang, ext = os.path.splitext(name)
-            if ext != '.html':
-                continue
-
-            if lang == 'master':
-                lang = 'en'
-
-            with open(os.path.join(root, name)) as translation_file:
-                translation = translation_file.read().decode('utf-8')
-
-            # Strip leading and trailing whitespace so that we don't get extra
-            # text elements in our BeautifulSoup
-            translation = translation.strip()
-
-            response_translations.append((lang, translation.strip()))
-
-    # Reorder the array according to the detected language and _TOP_LANGS
-    def lang_sorter(item):
-        lang, _ = item
-        rank = 999
-        try:
-            if lang == lang_id:
-                rank = -1
-            else:
-                rank = _TOP_LANGS.index(lang)
-        except ValueError:
-            pass
-        return rank
-
-    response_translations.sort(key=lang_sorter)
-
     # Gather the info we'll need for formatting the email
     bucketname, email_address = psi_ops_helpers.get_bucket_name_and_email_address(sponsor_name, prop_channel_name)
 
@@ -349,52 +491,29 @@ def _get_response_content(response_id, diagnostic_info):
         logger.debug_log('_get_response_content: exiting due to no bucketname or address')
         return None
 
-    # Collect the translations of the specific response we're sending
-
-    subject = None
-    bodies = []
-    for lang_id, html in response_translations:
-        soup = BeautifulSoup(html)
-        if not subject:
-            subject = soup.find(id='default_response_subject')
-            if subject:
-                # Strip outer element
-                subject = u''.join(unicode(elem) for elem in subject.contents).strip()
-        body = soup.find(id=response_id)
-        if body:
-            # Strip outer element
-            body = u''.join(unicode(elem) for elem in body.contents).strip()
-
-            # The user might be using a language for which there isn't a
-            # download page. Fall back to English if that's the case.
-            home_page_url = psi_ops_helpers.get_s3_bucket_home_page_url(
-                bucketname,
-                lang_id if lang_id in psi_ops_helpers.WEBSITE_LANGS else 'en')
-            download_page_url = psi_ops_helpers.get_s3_bucket_download_page_url(
-                bucketname,
-                lang_id if lang_id in psi_ops_helpers.WEBSITE_LANGS else 'en')
-            faq_page_url = psi_ops_helpers.get_s3_bucket_faq_url(
-                bucketname,
-                lang_id if lang_id in psi_ops_helpers.WEBSITE_LANGS else 'en')
-
-            # We're using numbers rather than more readable names here because
-            # they're less likely to be accidentally modified by translators
-            # (we think).
-            format_dict = {
-                '0': email_address,
-                '1': download_page_url,
-                '2': home_page_url,
-                '3': faq_page_url
-            }
-            body = unicode(body) % format_dict
-            bodies.append(body)
-
-    # Render the email body from the Mako template
-    body_html = _render_email({
-        'lang_id': lang_id,
-        'response_id': response_id,
-        'responses': bodies
-    })
+    subject, body_langs, body_html, body_text = _responses.get(response_id, lang_id)
+
+    format_dicts = []
+    for lang in body_langs:
+        # The user might be using a language for which there isn't a
+        # download page. Fall back to English if that's the case.
+        website_lang = lang if lang in psi_ops_helpers.WEBSITE_LANGS else 'en'
+        home_page_url = psi_ops_helpers.get_s3_bucket_home_page_url(bucketname, website_lang)
+        download_page_url = psi_ops_helpers.get_s3_bucket_download_page_url(bucketname, website_lang)
+        faq_page_url = psi_ops_helpers.get_s3_bucket_faq_url(bucketname, website_lang)
+
+        # We're using numbers rather than more readable names here because
+        # they're less likely to be accidentally modified by translators
+        # (we think).
+        format_dicts.append({
+            '0': email_address,
+            '1': download_page_url,
+            '2': home_page_url,
+            '3': faq_page_url
+        })
+
+    body_html = _fill_placeholders(body_html, format_dicts)
+    body_text = _fill_placeholders(body_text, format_dicts)
 
     # Get attachments.
     # This depends on which response we're returning.
@@ -417,7 +536,7 @@ def _get_response_content(response_id, diagnostic_info):
 
     return {
         'subject': subject,
-        'body_text': _html_to_text(body_html),
+        'body_text': body_text,
         'body_html': body_html,
         'attachments': attachments
     }
@@ -538,3 +657,31 @@ def go():
                 logger.debug_log('go: send_response excepted')
                 logger.exception()
                 logger.error(str(e))
+
+
+def _benchmark(count):
+    # Renders responses with the registry, and with a new registry for each
+    # response, which loads and renders everything like before there was one
+    global _responses
+
+    diagnostic_infos = [{'Feedback': {'Message': {'text_lang_code': lang}}}
+                        for lang in _TOP_LANGS + ['es', 'xx']]
+
+    for name, new_registry in [('registry reloaded per response', True),
+                               ('registry', False)]:
+        _responses = _ResponseRegistry()
+        start_time = time.time()
+        for i in range(count):
+            if new_registry:
+                _responses = _ResponseRegistry()
+            _get_response_content('download_new_version_links',
+                                  diagnostic_infos[i % len(diagnostic_infos)])
+        elapsed = time.time() - start_time
+        print '%s: %d responses, %.3f s, %.1f responses/s' % (name, count, elapsed, count / elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark feedback response rendering')
+    parser.add_argument('--count', type=int, default=100, help='number of responses')
+    args = parser.parse_args()
+    _benchmark(args.count)
@@ -74,6 +74,10 @@ _response_blacklist_store = _db.response_blacklist
 # A store of the errors we've seen. Printed into the stats email.
 _errors_store = _db.errors
 
+# Translations of feedback messages, keyed by a hash of the normalized
+# message. See translation.py.
+_translation_cache_store = _db.translation_cache
+
 
 #
 # Create any necessary indexes
@@ -97,6 +101,14 @@ _errors_store.ensure_index('datetime', expireAfterSeconds=_ERRORS_LIFETIME_SECS)
 _EMAIL_DIAGNOSTIC_INFO_LIFETIME_SECS = 60*60  # one hour
 _email_diagnostic_info_store.ensure_index('datetime', expireAfterSeconds=_EMAIL_DIAGNOSTIC_INFO_LIFETIME_SECS)
 
+# Cached translations expire, so that they eventually pick up improvements in
+# the translation API.
+_TRANSLATION_CACHE_LIFETIME_SECS = 60*60*24*30  # thirty days
+_translation_cache_store.ensure_index('datetime', expireAfterSeconds=_TRANSLATION_CACHE_LIFETIME_SECS)
+
+# The oldest cached translations are removed when there are more than this.
+TRANSLATION_CACHE_MAX_COUNT = 200000
+
 # More loookup indexes
 _diagnostic_info_store.ensure_index('Metadata.platform')
 _diagnostic_info_store.ensure_index('Metadata.version')
@@ -111,6 +123,17 @@ def insert_diagnostic_info(obj):
     return _diagnostic_info_store.insert(obj)
 
 
+def insert_diagnostic_infos(objs):
+    '''
+    Stores a batch of diagnostic info with a single request. Returns the
+    record IDs, in order.
+    '''
+    now = datetime.datetime.now()
+    for obj in objs:
+        obj['datetime'] = now
+    return _diagnostic_info_store.insert(objs)
+
+
 def insert_email_diagnostic_info(diagnostic_info_record_id,
                                  email_id,
                                  email_subject):
@@ -122,6 +145,17 @@ def insert_email_diagnostic_info(diagnostic_info_record_id,
     return _email_diagnostic_info_store.insert(obj)
 
 
+def insert_email_diagnostic_infos(diagnostic_info_record_ids):
+    now = datetime.datetime.now()
+    objs = [{'diagnostic_info_record_id': diagnostic_info_record_id,
+             'email_id': None,
+             'email_subject': None,
+             'datetime': now
+             }
+            for diagnostic_info_record_id in diagnostic_info_record_ids]
+    return _email_diagnostic_info_store.insert(objs)
+
+
 def get_email_diagnostic_info_iterator():
     return _email_diagnostic_info_store.find()
 
@@ -152,6 +186,16 @@ def insert_autoresponder_entry(email_info, diagnostic_info_record_id):
     return _autoresponder_store.insert(obj)
 
 
+def insert_autoresponder_entries(diagnostic_info_record_ids):
+    now = datetime.datetime.now()
+    objs = [{'diagnostic_info_record_id': diagnostic_info_record_id,
+             'email_info': None,
+             'datetime': now
+             }
+            for diagnostic_info_record_id in diagnostic_info_record_ids]
+    return _autoresponder_store.insert(objs)
+
+
 def get_autoresponder_iterator():
     while True:
         next_rec = _autoresponder_store.find_and_modify(remove=True)
@@ -222,6 +266,35 @@ def get_stats(since_time):
     }
 
 
+#
+# Functions related to the translation cache
+#
+
+def get_cached_translations(keys):
+    '''
+    Returns a dict of the cached translations found for `keys`.
+    '''
+    return dict((rec['_id'], tuple(rec['translation']))
+                for rec in _translation_cache_store.find({'_id': {'$in': list(keys)}}))
+
+
+def cache_translations(translations):
+    '''
+    `translations` is a dict of key: translation tuple.
+    '''
+    now = datetime.datetime.now()
+    for key, value in translations.iteritems():
+        # Upsert, as another service may have cached the same message
+        _translation_cache_store.update({'_id': key},
+                                        {'_id': key, 'translation': value, 'datetime': now},
+                                        upsert=True)
+
+    excess_count = _translation_cache_store.count() - TRANSLATION_CACHE_MAX_COUNT
+    if excess_count > 0:
+        oldest = _translation_cache_store.find({}, ['_id']).sort('datetime', 1).limit(excess_count)
+        _translation_cache_store.remove({'_id': {'$in': [rec['_id'] for rec in oldest]}})
+
+
 def add_error(error):
     _errors_store.insert({'error': error, 'datetime': datetime.datetime.now()})
 
@@ -15,7 +15,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from base64 import b64decode
+import os
+import sys
+import time
+import argparse
+from base64 import b64decode, b64encode
 import M2Crypto
 
 from config import config
@@ -30,7 +34,120 @@ sending.
 class DecryptorException(Exception):
     pass
 
-_private_key_pem = None
+
+# The stages of decryption that timings are kept for
+STAGES = ('key_unwrap', 'hmac_verify', 'aes_cbc')
+
+
+class Decryptor(object):
+    '''
+    Decrypts diagnostic feedback packages with the private key, which is
+    loaded and unlocked once, when the object is created. Keeps the total time
+    spent in each of STAGES, for measuring per-item cost.
+    '''
+
+    def __init__(self, private_key_pem, private_key_password):
+        # We need to explicitly call `str()` on the password, because if it has
+        # been extracted from a JSON config file it will be of type `unicode`
+        # which will cause a key unwrap error ("bad password read").
+        self._rsa_private_key = M2Crypto.RSA.load_key_string(private_key_pem,
+                                                             lambda _: str(private_key_password))
+        self.reset_timings()
+
+    def reset_timings(self):
+        self.timings = dict((stage, 0.0) for stage in STAGES)
+        self.decrypt_count = 0
+
+    def decrypt(self, data):
+        '''
+        `data` is a dict containing the object given in the diagnostic feedback
+        attachment. The decrypted content string is returned. A
+        DecryptorException is thrown in case of error.
+        '''
+
+        ciphertext = b64decode(data['contentCiphertext'])
+        iv = b64decode(data['iv'])
+
+        start_time = time.time()
+
+        # Unwrap the MAC key
+        try:
+            macKey = self._rsa_private_key.private_decrypt(b64decode(data['wrappedMacKey']),
+                                                           M2Crypto.RSA.pkcs1_oaep_padding)
+        except:
+            raise DecryptorException("can't unwrap MAC key")
+
+        unwrap_time = time.time()
+        self.timings['key_unwrap'] += unwrap_time - start_time
+
+        # Calculate and verify the MAC.
+        mac = M2Crypto.EVP.HMAC(macKey, algo='sha256')
+        # Include the IV in the MAC'd data, as per http://tools.ietf.org/html/draft-mcgrew-aead-aes-cbc-hmac-sha2-01
+        mac.update(iv)
+        mac.update(ciphertext)
+        if mac.final() != b64decode(data['contentMac']):
+            raise DecryptorException('MAC verification failed')
+
+        verify_time = time.time()
+        self.timings['hmac_verify'] += verify_time - unwrap_time
+
+        # Unwrap the encryption key.
+        try:
+            aesKey = self._rsa_private_key.private_decrypt(b64decode(data['wrappedEncryptionKey']),
+                                                           M2Crypto.RSA.pkcs1_oaep_padding)
+        except:
+            raise DecryptorException("can't unwrap encryption key")
+
+        unwrap_time = time.time()
+        self.timings['key_unwrap'] += unwrap_time - verify_time
+
+        # Decrypt the content.
+
+        aesCipher = M2Crypto.EVP.Cipher(alg='aes_128_cbc',
+                                        key=aesKey,
+                                        iv=iv,
+                                        op=0)
+
+        plaintext = aesCipher.update(ciphertext)
+        plaintext += aesCipher.final()
+
+        self.timings['aes_cbc'] += time.time() - unwrap_time
+        self.decrypt_count += 1
+
+        return plaintext
+
+    def decrypt_many(self, data_list):
+        '''
+        Decrypts each of the `data` dicts in `data_list`. Returns a list with a
+        (plaintext, None) or a (None, exception) tuple for each, in order, so
+        that one bad item doesn't affect the rest.
+        '''
+        results = []
+        for data in data_list:
+            try:
+                results.append((self.decrypt(data), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+
+_decryptor = None
+_decryptor_pid = None
+
+
+def get_decryptor():
+    '''
+    Returns the Decryptor for the configured private key, creating it on the
+    first call in each process. Forked processes (like s3decryptor's
+    decryptor pool) don't share the parent's key object.
+    '''
+    global _decryptor, _decryptor_pid
+    if not _decryptor or _decryptor_pid != os.getpid():
+        with open(config['privateKeyPemFile'], 'r') as f:
+            private_key_pem = f.read()
+        _decryptor = Decryptor(private_key_pem, config['privateKeyPassword'])
+        _decryptor_pid = os.getpid()
+    return _decryptor
 
 
 def decrypt(data):
@@ -39,52 +156,65 @@ def decrypt(data):
     attachment. The decrypted content string is returned. A DecryptorException
     is thrown in case of error.
     '''
+    return get_decryptor().decrypt(data)
 
-    global _private_key_pem
-    if not _private_key_pem:
-        _private_key_pem = open(config['privateKeyPemFile'], 'r').read()
-
-    ciphertext = b64decode(data['contentCiphertext'])
-    iv = b64decode(data['iv'])
-
-    # Ready our private key, with which we'll unwrap the encryption and MAC
-    # keys.
-    # We need to explicitly call `str()` on the password, because if it has
-    # been extracted from a JSON config file it will be of type `unicode`
-    # which will cause a key unwrap error ("bad password read").
-    rsaPrivKey = M2Crypto.RSA.load_key_string(_private_key_pem,
-                                              lambda _: str(config['privateKeyPassword']))
-
-    # Unwrap the MAC key
-    try:
-        macKey = rsaPrivKey.private_decrypt(b64decode(data['wrappedMacKey']),
-                                            M2Crypto.RSA.pkcs1_oaep_padding)
-    except:
-        raise DecryptorException("can't unwrap MAC key")
-
-    # Calculate and verify the MAC.
-    mac = M2Crypto.EVP.HMAC(macKey, algo='sha256')
-    # Include the IV in the MAC'd data, as per http://tools.ietf.org/html/draft-mcgrew-aead-aes-cbc-hmac-sha2-01
-    mac.update(iv)
-    mac.update(ciphertext)
-    if mac.final() != b64decode(data['contentMac']):
-        raise DecryptorException('MAC verification failed')
 
-    # Unwrap the encryption key.
-    try:
-        aesKey = rsaPrivKey.private_decrypt(b64decode(data['wrappedEncryptionKey']),
-                                            M2Crypto.RSA.pkcs1_oaep_padding)
-    except:
-        raise DecryptorException("can't unwrap encryption key")
+# ===== Benchmark =====
 
-    # Decrypt the content.
+def _encrypt(rsa_public_key, plaintext):
+    # As the client does it
+    aesKey = os.urandom(16)
+    macKey = os.urandom(32)
+    iv = os.urandom(16)
 
-    aesCipher = M2Crypto.EVP.Cipher(alg='aes_128_cbc',
-                                    key=aesKey,
-                                    iv=iv,
-                                    op=0)
+    aesCipher = M2Crypto.EVP.Cipher(alg='aes_128_cbc', key=aesKey, iv=iv, op=1)
+    ciphertext = aesCipher.update(plaintext)
+    ciphertext += aesCipher.final()
 
-    plaintext = aesCipher.update(ciphertext)
-    plaintext += aesCipher.final()
+    mac = M2Crypto.EVP.HMAC(macKey, algo='sha256')
+    mac.update(iv)
+    mac.update(ciphertext)
 
-    return plaintext
+    return {'contentCiphertext': b64encode(ciphertext),
+            'iv': b64encode(iv),
+            'wrappedEncryptionKey': b64encode(rsa_public_key.public_encrypt(aesKey, M2Crypto.RSA.pkcs1_oaep_padding)),
+            'contentMac': b64encode(mac.final()),
+            'wrappedMacKey': b64encode(rsa_public_key.public_encrypt(macKey, M2Crypto.RSA.pkcs1_oaep_padding))}
+
+
+def _benchmark(item_count, item_size, key_bits):
+    # Compares loading the key for every item, as decrypt used to, with
+    # loading it once, using a generated key pair
+    password = 'password'
+    rsa_key = M2Crypto.RSA.gen_key(key_bits, 65537, lambda *_: None)
+    private_key_pem = rsa_key.as_pem(cipher='aes_128_cbc', callback=lambda *_: password)
+    rsa_public_key = M2Crypto.RSA.new_pub_key(rsa_key.pub())
+
+    data_list = [_encrypt(rsa_public_key, os.urandom(item_size)) for _ in range(item_count)]
+
+    start_time = time.time()
+    for data in data_list:
+        Decryptor(private_key_pem, password).decrypt(data)
+    per_item_elapsed = time.time() - start_time
+
+    decryptor = Decryptor(private_key_pem, password)
+    start_time = time.time()
+    results = decryptor.decrypt_many(data_list)
+    elapsed = time.time() - start_time
+    assert all(error is None for (_, error) in results)
+
+    print '%d items of %d bytes, %d-bit key' % (item_count, item_size, key_bits)
+    print 'key loaded per item: %.3f ms/item' % (1000 * per_item_elapsed / item_count)
+    print 'key loaded once:     %.3f ms/item' % (1000 * elapsed / item_count)
+    for stage in STAGES:
+        print '  %-12s %.3f ms/item' % (stage, 1000 * decryptor.timings[stage] / decryptor.decrypt_count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark feedback decryption with a generated key pair')
+    parser.add_argument('--count', type=int, default=200, help='number of items')
+    parser.add_argument('--size', type=int, default=16384, help='plaintext size of each item, in bytes')
+    parser.add_argument('--key-bits', type=int, default=4096)
+    args = parser.parse_args()
+    _benchmark(args.count, args.size, args.key_bits)
+    sys.exit(0)
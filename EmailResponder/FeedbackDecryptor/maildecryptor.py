@@ -138,17 +138,14 @@ _email_stripper_regex = re.compile(r'(.*<)?([^<>]+)(>)?')
 def _get_email_info(msg):
     logger.debug_log('maildecryptor._get_email_info start')
 
-    subject_translation = translation.translate(config['googleApiServers'],
-                                                config['googleApiKey'],
-                                                msg['subject'])
+    subject_translation, body_translation = translation.translate_many(config['googleApiServers'],
+                                                                       config['googleApiKey'],
+                                                                       [msg['subject'], msg['body']])
     subject = dict(text=msg['subject'],
                    text_lang_code=subject_translation[0],
                    text_lang_name=subject_translation[1],
                    text_translated=subject_translation[2])
 
-    body_translation = translation.translate(config['googleApiServers'],
-                                             config['googleApiKey'],
-                                             msg['body'])
     body = dict(text=msg['body'],
                 text_lang_code=body_translation[0],
                 text_lang_name=body_translation[1],
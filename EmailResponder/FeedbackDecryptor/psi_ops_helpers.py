@@ -17,8 +17,10 @@
 
 import sys
 import os
+import time
 
 from config import config
+import logger
 
 # Make the Automation (psi_ops) modules available
 sys.path.append(config['psiOpsPath'])
@@ -37,46 +39,110 @@ from psi_ops_s3 import \
 from transifex_pull import WEBSITE_LANGS
 
 
+# How often to check whether the psinet DB file has changed
+_PSINET_CHECK_INTERVAL_SECS = 60
+
+
+class RedactionIndex(object):
+    '''
+    The psinet lookups used to redact diagnostic info, as dicts. Gives the
+    same results as the PsiphonNetwork methods, which scan every server (or
+    sponsor, etc.) on each call.
+    '''
+
+    def __init__(self, psinet):
+        self._server_display_ids = {}
+        for ip, server in self._get_servers_by_ip_address(psinet.get_deleted_servers()).iteritems():
+            self._server_display_ids[ip] = '[%s][DELETED]' % server.id
+        # Live servers take precedence over deleted servers with the same IP
+        for ip, server in self._get_servers_by_ip_address(psinet.get_servers()).iteritems():
+            self._server_display_ids[ip] = '[%s]' % server.id
+
+        self._propagation_channel_names = dict((propagation_channel.id, propagation_channel.name)
+                                               for propagation_channel in psinet.get_propagation_channels())
+        self._sponsor_names = dict((sponsor.id, sponsor.name) for sponsor in psinet.get_sponsors())
+
+    def _get_servers_by_ip_address(self, servers):
+        # Like get_server_by_ip_address, IP addresses shared by more than one
+        # server aren't matched
+        matches = {}
+        for server in servers:
+            matches.setdefault(server.ip_address, []).append(server)
+        return dict((ip, servers[0]) for ip, servers in matches.iteritems() if len(servers) == 1)
+
+    def get_server_display_id(self, ip):
+        # If the psinet DB is stale, we might not find the IP address, but
+        # we still want to redact it.
+        return self._server_display_ids.get(ip, '[UNKNOWN]')
+
+    def get_propagation_channel_name(self, prop_channel_id):
+        return self._propagation_channel_names.get(prop_channel_id)
+
+    def get_sponsor_name(self, sponsor_id):
+        return self._sponsor_names.get(sponsor_id)
+
+
 _psinet = None
+_psinet_mtime = None
+_psinet_check_time = 0
+_redaction_index = None
+
+
 def _ensure_psinet_loaded():
-    # Load the psinet DB
-    global _psinet
-    if not _psinet:
-        _psinet = psi_ops.PsiphonNetwork.load_from_file(config['psinetFilePath'])
+    # Load the psinet DB, and load it again when the file changes
+    global _psinet, _psinet_mtime, _psinet_check_time, _redaction_index
+
+    now = time.time()
+    if _psinet and now < _psinet_check_time + _PSINET_CHECK_INTERVAL_SECS:
+        return
+    _psinet_check_time = now
+
+    try:
+        mtime = os.path.getmtime(config['psinetFilePath'])
+        if _psinet and mtime == _psinet_mtime:
+            return
+        psinet = psi_ops.PsiphonNetwork.load_from_file(config['psinetFilePath'])
+    except Exception as e:
+        if not _psinet:
+            raise
+        # Keep using the one we have. It may be in the middle of being
+        # replaced; try again after the interval.
+        logger.exception()
+        logger.error('psinet reload failed: %s' % str(e))
+        return
+
+    _psinet = psinet
+    _psinet_mtime = mtime
+    _redaction_index = None
+
+
+def get_redaction_index():
+    '''
+    Returns the RedactionIndex for the current psinet DB.
+    '''
+    global _redaction_index
+    _ensure_psinet_loaded()
+    if not _redaction_index:
+        _redaction_index = RedactionIndex(_psinet)
+    return _redaction_index
 
 
 def get_propagation_channel_name_by_id(prop_channel_id):
     '''
     Gets the Propagation Channel name from its ID. Returns None if not found.
     '''
-    _ensure_psinet_loaded()
-    propagation_channel = _psinet.get_propagation_channel_by_id(prop_channel_id)
-    return propagation_channel.name if propagation_channel else None
+    return get_redaction_index().get_propagation_channel_name(prop_channel_id)
 
 
 def get_sponsor_name_by_id(sponsor_id):
     '''
     Gets the Sponsor name from its ID. Returns None if not found.
     '''
-    _ensure_psinet_loaded()
-    sponsor = _psinet.get_sponsor_by_id(sponsor_id)
-    return sponsor.name if sponsor else None
+    return get_redaction_index().get_sponsor_name(sponsor_id)
 
 
 def get_server_display_id_from_ip(ip):
-    _ensure_psinet_loaded()
-    server_id = None
-    server = _psinet.get_server_by_ip_address(ip)
-    if server:
-        server_id = '[%s]' % server.id
-    else:
-        server = _psinet.get_deleted_server_by_ip_address(ip)
-        if server:
-            server_id = '[%s][DELETED]' % server.id
-
-    # If the psinet DB is stale, we might not find the IP address, but
-    # we still want to redact it.
-    return server_id if server_id else '[UNKNOWN]'
+    return get_redaction_index().get_server_display_id(ip)
 
 
 def get_bucket_name_and_email_address(sponsor_name, prop_channel_name):
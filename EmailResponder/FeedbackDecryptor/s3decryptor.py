@@ -17,11 +17,42 @@
 '''
 Periodically checks S3 upload bucket for new items. Gets them, deletes them.
 Decrypts them and stores them in the diagnostic-info-DB.
+
+The work is pipelined, so that a backlog (like the one after a client release)
+is worked through at the speed of the slowest stage instead of the sum of all
+of them:
+
+- A lister thread pages through the bucket, with the last key of each page as
+  the marker for the next one. It lists again right away while there are items
+  in the bucket, and backs off to once a minute while it is empty.
+- A pool of downloader threads gets and deletes the items.
+- A pool of processes decrypts and parses them, so this scales with the number
+  of cores.
+- The main thread converts psinet values, and transforms and stores the items
+  in batches, so that their feedback messages are translated together.
+
+Items are still deleted as soon as they're downloaded, so that a bad item isn't
+processed over and over. The flip side is that items which have been downloaded
+but not stored yet are lost if the process dies; the queues are bounded, so
+there are at most a few dozen of those.
+
+To measure throughput without S3 and without storing anything:
+
+  python s3decryptor.py --benchmark <directory of bucket objects>
 '''
 
+import os
+import sys
 import time
+import shutil
 import smtplib
 import json
+import tempfile
+import argparse
+import threading
+import traceback
+import multiprocessing
+import Queue
 import yaml
 from boto.s3.connection import S3Connection
 
@@ -34,9 +65,30 @@ import sender
 import datatransformer
 
 
-_SLEEP_TIME_SECS = 60
 _BUCKET_ITEM_MIN_SIZE = 100
 
+# The S3 maximum
+_LIST_PAGE_SIZE = 1000
+
+# Time between listing passes while the bucket is empty. Starts at the min and
+# doubles with each empty pass.
+_POLL_MIN_SECS = 1
+_POLL_MAX_SECS = 60
+
+_DOWNLOADER_COUNT = 8
+
+# Items can be as large as s3ObjectMaxSize, so only a few per decryptor
+# process are held in memory waiting to be decrypted
+_DECRYPT_BACKLOG_PER_PROCESS = 4
+
+# An item which hasn't been decrypted this long after it was submitted is
+# given up on: Python 2's Pool never returns a result for an item whose
+# decryptor process died, for example on a crafted item
+_DECRYPT_TIMEOUT_SECS = 600
+
+_STORE_BATCH_SIZE = 100
+_STORE_BATCH_MAX_WAIT_SECS = 2
+
 
 def _is_bucket_item_sane(key):
     logger.debug_log('s3decryptor._is_bucket_item_sane start')
@@ -51,33 +103,6 @@ def _is_bucket_item_sane(key):
     return True
 
 
-def _bucket_iterator(bucket):
-    logger.debug_log('s3decryptor._bucket_iterator start')
-
-    while True:
-        for key in bucket.list():
-            logger.debug_log('s3decryptor._bucket_iterator: %s' % key)
-
-            contents = None
-
-            # Do basic sanity checks before trying to download the object
-            if _is_bucket_item_sane(key):
-                logger.debug_log('s3decryptor._bucket_iterator: good item found, yielding')
-                contents = key.get_contents_as_string()
-
-            # Make sure to delete the key *before* proceeding, so we don't
-            # try to re-process if there's an error.
-            bucket.delete_key(key)
-
-            if contents:
-                yield contents
-
-        logger.debug_log('s3decryptor._bucket_iterator: no item found, sleeping')
-        time.sleep(_SLEEP_TIME_SECS)
-
-    logger.debug_log('s3decryptor._bucket_iterator end')
-
-
 def _should_email_data(diagnostic_info):
     '''
     Determine if this diagnostic info should be emailed. Not all diagnostic
@@ -88,80 +113,452 @@ def _should_email_data(diagnostic_info):
     return diagnostic_info.get('Feedback', {}).get('Message', {}).get('text')
 
 
-def go():
-    logger.debug_log('s3decryptor.go: start')
+def _decrypt_and_parse(encrypted_info_json):
+    '''
+    Runs in a decryptor process. Returns ('ok', diagnostic_info) on success.
+    Otherwise returns ('bad_object', error) if the item couldn't be decrypted,
+    or ('error', error) if it couldn't be parsed, where error is
+    (message, traceback). Errors are logged by the main process, as
+    `logger.error` also writes to the datastore.
+    '''
+    # In theory, all bucket items should be usable by us, but there's
+    # always the possibility that a user (or attacker) is messing with us.
+    try:
+        encrypted_info = json.loads(encrypted_info_json)
 
-    s3_conn = S3Connection(config['aws_access_key_id'], config['aws_secret_access_key'])
-    bucket = s3_conn.get_bucket(config['s3_bucket_name'])
+        diagnostic_info = decryptor.decrypt(encrypted_info)
 
-    # Note that `_bucket_iterator` throttles itself if/when there are no
-    # available objects in the bucket.
-    for encrypted_info_json in _bucket_iterator(bucket):
-        logger.debug_log('s3decryptor.go: processing item')
+        diagnostic_info = diagnostic_info.strip()
 
-        # In theory, all bucket items should be usable by us, but there's
-        # always the possibility that a user (or attacker) is messing with us.
+        # HACK: PyYaml only supports YAML 1.1, which is not a true superset
+        # of JSON. Therefore it can (and does) throw errors on some Android
+        # feedback. We will try to load using JSON first.
+        # TODO: Get rid of all YAML feedback and remove it from here.
+        try:
+            diagnostic_info = json.loads(diagnostic_info)
+            logger.debug_log('s3decryptor._decrypt_and_parse: loaded JSON')
+        except:
+            diagnostic_info = yaml.safe_load(diagnostic_info)
+            logger.debug_log('s3decryptor._decrypt_and_parse: loaded YAML')
+
+        return 'ok', diagnostic_info
+
+    except decryptor.DecryptorException as e:
+        return 'bad_object', (str(e), traceback.format_exc())
+
+    # Expected here are ValueError, TypeError and
+    # yaml.constructor.ConstructorError, which was being thown when a YAML
+    # value consisted of just string "=". Probably due to this PyYAML bug:
+    # http://pyyaml.org/ticket/140
+    # Anything else is also reported rather than raised, as it would only
+    # surface in the main process as a lost item.
+    except Exception as e:
+        return 'error', (str(e), traceback.format_exc())
+
+
+class _Pipeline(object):
+
+    def __init__(self, bucket_factory, downloader_count=_DOWNLOADER_COUNT,
+                 decryptor_count=None, store=True, until_empty=False):
+        # bucket_factory is called for a bucket object for each thread, as
+        # boto connections can't be shared between threads.
+        # With until_empty, run() returns once the bucket is empty and
+        # everything in it has been processed.
+        self._bucket_factory = bucket_factory
+        self._downloader_count = downloader_count
+        self._decryptor_count = decryptor_count or multiprocessing.cpu_count()
+        self._store = store
+        self._until_empty = until_empty
+
+        self._stop = threading.Event()
+        self._listing_done = threading.Event()
+
+        self._keys = Queue.Queue(downloader_count)
+        # Names of the listed keys which haven't been deleted yet, so the
+        # next listing pass skips them
+        self._listed = set()
+        self._listed_lock = threading.Lock()
+
+        # An item in _decrypt_slots for each item submitted to the decryptor
+        # pool and not handled by the main thread yet
+        self._decrypt_slots = Queue.Queue(self._decryptor_count * _DECRYPT_BACKLOG_PER_PROCESS)
+        self._decrypted = Queue.Queue()
+        self._submitted_count = 0
+        # Item ID -> (item, decryption deadline) for the submitted items
+        # which haven't been decrypted yet
+        self._decrypting = {}
+        self._submitted_lock = threading.Lock()
+        self._handled_count = 0
+
+        self._batch = []
+        self._batch_start_time = None
+        self.processed_count = 0
+
+    def run(self):
+        # Fork the decryptor processes before starting any threads
+        self._pool = multiprocessing.Pool(self._decryptor_count)
         try:
-            encrypted_info = json.loads(encrypted_info_json)
+            threads = [threading.Thread(target=self._list)]
+            threads += [threading.Thread(target=self._download)
+                        for _ in range(self._downloader_count)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            downloaders = threads[1:]
+
+            while True:
+                try:
+                    item_id, result = self._decrypted.get(timeout=_STORE_BATCH_MAX_WAIT_SECS)
+                except Queue.Empty:
+                    if (not any(downloader.is_alive() for downloader in downloaders) and
+                            self._handled_count == self._submitted_count):
+                        break
+                else:
+                    with self._submitted_lock:
+                        decrypting = self._decrypting.pop(item_id, None)
+                    # Otherwise, it was already given up on
+                    if decrypting:
+                        self._decrypt_slots.get_nowait()
+                        self._handled_count += 1
+                        self._handle(decrypting[0], result)
+
+                self._expire_decrypting()
+
+                if self._batch and (len(self._batch) >= _STORE_BATCH_SIZE or
+                                    time.time() - self._batch_start_time >= _STORE_BATCH_MAX_WAIT_SECS):
+                    self._store_batch()
+
+            self._store_batch()
+        finally:
+            self._stop.set()
+            self._pool.terminate()
+            self._pool.join()
+
+    def _put(self, queue, item):
+        # Blocks while the queue is full, but still notices shutdown
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
 
-            diagnostic_info = decryptor.decrypt(encrypted_info)
+    def _list(self):
+        try:
+            bucket = self._bucket_factory()
+            poll_secs = _POLL_MIN_SECS
+            while not self._stop.is_set():
+                found_count, queued_count = self._list_pass(bucket)
+                if queued_count:
+                    poll_secs = _POLL_MIN_SECS
+                    continue
+                if found_count:
+                    # Everything found is still being downloaded
+                    self._stop.wait(_POLL_MIN_SECS)
+                    continue
+                if self._until_empty:
+                    break
+                logger.debug_log('s3decryptor._Pipeline._list: no item found, sleeping')
+                self._stop.wait(poll_secs)
+                poll_secs = min(poll_secs * 2, _POLL_MAX_SECS)
+        except Exception as e:
+            # Leave it to the service to start over
+            logger.exception()
+            logger.error(str(e))
+            self._stop.set()
+        finally:
+            self._listing_done.set()
+
+    def _list_pass(self, bucket):
+        # Queues the keys that aren't being downloaded already. Returns the
+        # number of keys found in the bucket and the number queued.
+        found_count = 0
+        queued_count = 0
+        marker = ''
+        while not self._stop.is_set():
+            keys = bucket.get_all_keys(marker=marker, max_keys=_LIST_PAGE_SIZE)
+            for key in keys:
+                found_count += 1
+                with self._listed_lock:
+                    if key.name in self._listed:
+                        continue
+                    self._listed.add(key.name)
+                logger.debug_log('s3decryptor._Pipeline._list_pass: %s' % key)
+                if not self._put(self._keys, key):
+                    break
+                queued_count += 1
+            if not keys.is_truncated or not keys:
+                break
+            marker = keys[-1].name
+        return found_count, queued_count
+
+    def _download(self):
+        bucket = self._bucket_factory()
+        while not self._stop.is_set():
+            try:
+                key = self._keys.get(timeout=1)
+            except Queue.Empty:
+                if self._listing_done.is_set():
+                    return
+                continue
 
-            diagnostic_info = diagnostic_info.strip()
+            contents = None
+            try:
+                # Do basic sanity checks before trying to download the object
+                if _is_bucket_item_sane(key):
+                    logger.debug_log('s3decryptor._Pipeline._download: good item found')
+                    # key belongs to the lister's connection
+                    contents = bucket.new_key(key.name).get_contents_as_string()
+
+                # Make sure to delete the key *before* proceeding, so we don't
+                # try to re-process if there's an error.
+                bucket.delete_key(key.name)
+            except Exception as e:
+                # The key is listed again and retried, unless it was deleted
+                logger.exception()
+                logger.error(str(e))
+                continue
+            finally:
+                with self._listed_lock:
+                    self._listed.discard(key.name)
+
+            if not contents or not self._put(self._decrypt_slots, None):
+                continue
 
-            # HACK: PyYaml only supports YAML 1.1, which is not a true superset
-            # of JSON. Therefore it can (and does) throw errors on some Android
-            # feedback. We will try to load using JSON first.
-            # TODO: Get rid of all YAML feedback and remove it from here.
+            with self._submitted_lock:
+                self._submitted_count += 1
+                item_id = self._submitted_count
+                self._decrypting[item_id] = (contents, time.time() + _DECRYPT_TIMEOUT_SECS)
+            self._pool.apply_async(
+                _decrypt_and_parse, (contents,),
+                callback=lambda result, item_id=item_id: self._decrypted.put((item_id, result)))
+
+    def _expire_decrypting(self):
+        # Frees the decrypt slots of items that are past their deadline, and
+        # reports them as bad objects. The items were already deleted from
+        # the bucket.
+        now = time.time()
+        with self._submitted_lock:
+            expired = [item_id for (item_id, (_, deadline)) in self._decrypting.iteritems()
+                       if deadline <= now]
+            expired = [self._decrypting.pop(item_id)[0] for item_id in expired]
+
+        for encrypted_info_json in expired:
+            self._decrypt_slots.get_nowait()
+            self._handled_count += 1
+            self._handle(encrypted_info_json,
+                         ('bad_object',
+                          ('item not decrypted after %d seconds; the decryptor process may have died' % _DECRYPT_TIMEOUT_SECS,
+                           'item size: %d' % len(encrypted_info_json))))
+
+    def _handle(self, encrypted_info_json, result):
+        logger.debug_log('s3decryptor._Pipeline._handle: processing item')
+
+        status, value = result
+
+        if status == 'bad_object':
+            message, trace = value
+            logger.log(trace)
+            logger.error(message)
             try:
-                diagnostic_info = json.loads(diagnostic_info)
-                logger.debug_log('s3decryptor.go: loaded JSON')
-            except:
-                diagnostic_info = yaml.safe_load(diagnostic_info)
-                logger.debug_log('s3decryptor.go: loaded YAML')
+                # Something bad happened while decrypting. Report it via email.
+                sender.send(config['decryptedEmailRecipient'],
+                            config['emailUsername'],
+                            u'S3Decryptor: bad object',
+                            encrypted_info_json,
+                            None)  # no html body
+            except smtplib.SMTPException as e:
+                logger.exception()
+                logger.error(str(e))
+            return
+
+        if status == 'error':
+            # Try the next item
+            message, trace = value
+            logger.log(trace)
+            logger.error(message)
+            return
 
+        diagnostic_info = value
+
+        try:
             # Modifies diagnostic_info
             utils.convert_psinet_values(config, diagnostic_info)
 
             if not utils.is_diagnostic_info_sane(diagnostic_info):
                 # Something is wrong. Skip and continue.
+                return
+        except (ValueError, TypeError) as e:
+            logger.exception()
+            logger.error(str(e))
+            return
+
+        if not self._batch:
+            self._batch_start_time = time.time()
+        self._batch.append(diagnostic_info)
+
+    def _store_batch(self):
+        batch, self._batch = self._batch, []
+
+        # The batch's feedback messages are translated together. If that
+        # fails, transform() translates each message itself.
+        try:
+            datatransformer.prefetch_translations(batch)
+        except Exception as e:
+            logger.exception()
+            logger.error('prefetch_translations failed: %s' % utils.safe_str(e))
+        transformed = []
+        for diagnostic_info in batch:
+            try:
+                # Modifies diagnostic_info
+                datatransformer.transform(diagnostic_info)
+            except (ValueError, TypeError) as e:
+                logger.exception()
+                logger.error(str(e))
                 continue
+            transformed.append(diagnostic_info)
+        batch = transformed
 
-            # Modifies diagnostic_info
-            datatransformer.transform(diagnostic_info)
+        if not batch:
+            return
+
+        if not self._store:
+            self.processed_count += len(batch)
+            return
 
-            # Store the diagnostic info
-            record_id = datastore.insert_diagnostic_info(diagnostic_info)
+        record_ids = self._insert_diagnostic_infos(batch)
 
-            if _should_email_data(diagnostic_info):
-                logger.debug_log('s3decryptor.go: should email')
-                # Record in the DB that the diagnostic info should be emailed
-                datastore.insert_email_diagnostic_info(record_id, None, None)
+        # Record in the DB which diagnostic info should be emailed
+        email_record_ids = [record_id for (record_id, diagnostic_info) in zip(record_ids, batch)
+                            if record_id and _should_email_data(diagnostic_info)]
+        if email_record_ids:
+            datastore.insert_email_diagnostic_infos(email_record_ids)
 
-            # Store an autoresponder entry for this diagnostic info
-            datastore.insert_autoresponder_entry(None, record_id)
+        # Store an autoresponder entry for each diagnostic info
+        record_ids = [record_id for record_id in record_ids if record_id]
+        if record_ids:
+            datastore.insert_autoresponder_entries(record_ids)
 
-            logger.log('decrypted diagnostic data')
+        self.processed_count += len(record_ids)
+        logger.log('decrypted diagnostic data: %d items' % len(record_ids))
 
-        except decryptor.DecryptorException as e:
+    def _insert_diagnostic_infos(self, batch):
+        # Returns a record ID, or None if it couldn't be stored, for each item
+        try:
+            return datastore.insert_diagnostic_infos(batch)
+        except Exception as e:
             logger.exception()
             logger.error(str(e))
+
+        # Find the bad items by storing the batch one at a time. The insert
+        # assigned an _id to every item, and some may have been stored
+        # before the error.
+        record_ids = []
+        for diagnostic_info in batch:
+            if datastore.find_diagnostic_info(diagnostic_info.get('_id')):
+                record_ids.append(diagnostic_info['_id'])
+                continue
             try:
-                # Something bad happened while decrypting. Report it via email.
-                sender.send(config['decryptedEmailRecipient'],
-                            config['emailUsername'],
-                            u'S3Decryptor: bad object',
-                            encrypted_info_json,
-                            None)  # no html body
-            except smtplib.SMTPException as e:
+                record_ids.append(datastore.insert_diagnostic_info(diagnostic_info))
+            except Exception as e:
                 logger.exception()
                 logger.error(str(e))
+                record_ids.append(None)
+        return record_ids
 
-        # yaml.constructor.ConstructorError was being thown when a YAML value
-        # consisted of just string "=". Probably due to this PyYAML bug:
-        # http://pyyaml.org/ticket/140
-        except (ValueError, TypeError, yaml.constructor.ConstructorError) as e:
-            # Try the next attachment/message
-            logger.exception()
-            logger.error(str(e))
+
+def _get_bucket():
+    s3_conn = S3Connection(config['aws_access_key_id'], config['aws_secret_access_key'])
+    return s3_conn.get_bucket(config['s3_bucket_name'])
+
+
+def go():
+    logger.debug_log('s3decryptor.go: start')
+
+    # Only returns if there's an error
+    _Pipeline(_get_bucket).run()
 
     logger.debug_log('s3decryptor.go: end')
+
+
+class _DirectoryKeys(list):
+    is_truncated = False
+
+
+class _DirectoryKey(object):
+
+    def __init__(self, bucket, name, size=None):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+
+    def __str__(self):
+        return self.name
+
+    def get_contents_as_string(self):
+        with open(os.path.join(self.bucket.path, self.name), 'rb') as f:
+            return f.read()
+
+
+class _DirectoryBucket(object):
+    '''
+    Stands in for the boto S3 bucket, with an object per file in a directory.
+    Only what the pipeline uses is implemented.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_all_keys(self, marker='', max_keys=_LIST_PAGE_SIZE):
+        names = sorted(name for name in os.listdir(self.path) if name > marker)
+        keys = _DirectoryKeys()
+        for name in names[:max_keys]:
+            try:
+                keys.append(_DirectoryKey(self, name, os.path.getsize(os.path.join(self.path, name))))
+            except OSError:
+                # Deleted since the listdir
+                continue
+        keys.is_truncated = len(names) > max_keys
+        return keys
+
+    def new_key(self, name):
+        return _DirectoryKey(self, name)
+
+    def delete_key(self, name):
+        os.remove(os.path.join(self.path, name))
+
+
+def _benchmark(objects_dir, downloader_count, decryptor_count):
+    # The pipeline deletes the items, so it works on a copy
+    temp_dir = tempfile.mkdtemp()
+    try:
+        bucket_dir = os.path.join(temp_dir, 'bucket')
+        shutil.copytree(objects_dir, bucket_dir)
+        item_count = len(os.listdir(bucket_dir))
+
+        pipeline = _Pipeline(lambda: _DirectoryBucket(bucket_dir),
+                             downloader_count=downloader_count,
+                             decryptor_count=decryptor_count,
+                             store=False,
+                             until_empty=True)
+        start_time = time.time()
+        pipeline.run()
+        elapsed = time.time() - start_time
+
+        print '%d items, %d processed, %.3f s, %.1f items/s' % (
+                item_count, pipeline.processed_count, elapsed, item_count / elapsed)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure s3decryptor throughput')
+    parser.add_argument('--benchmark', metavar='DIR', required=True,
+                        help='directory of bucket objects, e.g. copied from the S3 bucket; nothing is stored')
+    parser.add_argument('--downloaders', type=int, default=_DOWNLOADER_COUNT)
+    parser.add_argument('--decryptors', type=int,
+                        help='number of decryptor processes; the default is the number of cores')
+    args = parser.parse_args()
+    _benchmark(args.benchmark, args.downloaders, args.decryptors)
+    sys.exit(0)
@@ -31,16 +31,40 @@ aliases must be of the form `[a-z0-9]+.googleapis.com`, because the SSL
 certificate will only match `*.googleapis.com`.
 
 If you don't want any failover, just leave `apiServers` empty or None.
+
+Feedback messages are very often duplicates or near-duplicates of each other
+("not working", "Slow!"), so translations are cached in the datastore, keyed
+by a hash of the normalized message. `translate_many` translates the messages
+that aren't cached with as few API requests as possible.
+
+To measure the cache hit rate and the time saved against a local mock of the
+API:
+
+  python translation.py [--count N] [--latency SECONDS]
 '''
 
 # The actual errors we've had from the Google API servers:
 # socket.error: [Errno 110] Connection timed out
 # socket.error: [Errno 101] Network is unreachable
 
+import re
+import sys
+import json
+import time
+import random
+import urllib
+import hashlib
+import urlparse
+import argparse
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
 import requests
 
 import logger
 import utils
+import datastore
 
 
 # See https://developers.google.com/translate/v2/using_rest
@@ -48,13 +72,28 @@ import utils
 _MAX_GET_REQUEST_SIZE = 2000
 _MAX_POST_REQUEST_SIZE = 15000
 
+# Room left in each request for the parameters other than the messages
+_REQUEST_OVERHEAD_SIZE = 200
+
+# The API's limit on the number of messages ("q" parameters) per request
+_MAX_MESSAGES_PER_REQUEST = 128
+
 _USE_POST_REQUEST = True
 
 _TARGET_LANGUAGE = 'en'
 
+_API_URL_FORMAT = 'https://%s/language/translate/v2%s'
+
 # This will be a dict of 'lang-code': 'full-lang-name'
 _languages = {}
 
+# Keeps connections to the API servers open between requests
+_session = requests.Session()
+
+# Where translations are cached: anything with `get_cached_translations` and
+# `cache_translations` functions, like the datastore.
+_cache = datastore
+
 
 def translate(apiServers, apiKey, msg):
     '''
@@ -67,39 +106,150 @@ def translate(apiServers, apiKey, msg):
         In this case, `original-language-fullname` will have the exception
         message.
     '''
+    return translate_many(apiServers, apiKey, [msg])[0]
+
+
+def translate_many(apiServers, apiKey, msgs):
+    '''
+    Translates each of `msgs` to English. Returns a list of the tuples that
+    `translate` returns, in the same order.
+
+    Cached translations are used where possible. Note that this means a
+    message can get the translation of a near-duplicate: a message which only
+    differs in case, punctuation or whitespace.
 
+    Like `translate`, doesn't raise: errors are returned as
+    "[TRANSLATION_FAIL]" results.
+    '''
     try:
-        if not _languages:
-            _load_languages(apiServers, apiKey)
+        return _translate_many(apiServers, apiKey, msgs)
+    except Exception as e:
+        logger.exception()
+        fail = ('[TRANSLATION_FAIL]', utils.safe_str(e), None)
+        return [fail] * len(msgs)
 
-        # Detect the language. We won't use the entire string, since we pay per
-        # character, and the #characters-to-accuracy curve is probably logarithmic.
-        # Note that truncating the request means we don't have to worry about the
-        # max request size yet.
-        detected = _make_request(apiServers, apiKey,
-                                 'detect', {'q': msg[:200]})
-        from_lang = detected['data']['detections'][0][0]['language']
-
-        # 'zh-CN' will be returned as a detected language, but it is not in the
-        # _languages set. So we might need to massage the detected language.
-        if from_lang not in _languages:
-            from_lang = from_lang.split('-')[0]
-            if from_lang not in _languages:
-                # This probably means that the detection failed
-                return ('[INDETERMINATE]',
-                        'Language could not be determined',
-                        None)
 
+def _translate_many(apiServers, apiKey, msgs):
+    results = [None] * len(msgs)
+
+    # Messages can be UTF-8 byte strings, such as from emails without a
+    # charset. Everything after this works with unicode.
+    unicode_msgs = {}
+    keys = {}
+    for i, msg in enumerate(msgs):
+        try:
+            unicode_msgs[i] = msg if isinstance(msg, unicode) else msg.decode('utf8')
+            keys[i] = _get_cache_key(unicode_msgs[i])
+        except Exception as e:
+            results[i] = ('[TRANSLATION_FAIL]', utils.safe_str(e), None)
+
+    try:
+        translations = _cache.get_cached_translations(set(keys.values()))
+    except Exception as e:
+        logger.exception()
+        logger.error('%s.py: cache error: %s' % (__name__, utils.safe_str(e)))
+        translations = {}
+
+    # Translate one of each of the messages that aren't cached
+    uncached = collections.OrderedDict()
+    for i in sorted(keys):
+        if keys[i] not in translations and keys[i] not in uncached:
+            uncached[keys[i]] = unicode_msgs[i]
+    if uncached:
+        translations.update(_translate_uncached(apiServers, apiKey, uncached))
+
+    for i, key in keys.iteritems():
+        from_lang, from_lang_name, msg_translated = translations.get(
+            key, ('[TRANSLATION_FAIL]', 'no result from translation API', None))
         if from_lang == _TARGET_LANGUAGE:
             # msg is already in the target language
-            return (from_lang, _languages[from_lang], msg)
+            msg_translated = msgs[i]
+        results[i] = (from_lang, from_lang_name, msg_translated)
+
+    return results
 
-        msg_translated = _translate_request_helper(apiServers, apiKey,
-                                                   from_lang, msg)
 
-        return (from_lang, _languages[from_lang], msg_translated)
+def _get_cache_key(msg):
+    # Case, punctuation and runs of whitespace rarely change the translation
+    normalized = u' '.join(re.split(r'[\W_]+', msg.lower(), flags=re.UNICODE)).strip()
+    return hashlib.sha1(normalized.encode('utf8')).hexdigest()
+
+
+def _translate_uncached(apiServers, apiKey, msgs):
+    '''
+    `msgs` is a dict of cache key: unicode message. Returns a dict of cache
+    key: `translate` result tuple, and caches the successful ones. A failed
+    request, or a response that can't be used, fails only the messages in it.
+    '''
+
+    results = {}
+
+    try:
+        if not _languages:
+            _load_languages(apiServers, apiKey)
+    except Exception as e:
+        fail = ('[TRANSLATION_FAIL]', utils.safe_str(e), None)
+        return dict((key, fail) for key in msgs)
+
+    # Detect the languages. We won't use the entire strings, since we pay per
+    # character, and the #characters-to-accuracy curve is probably logarithmic.
+    # Note that truncating the messages means none of them is too large for a
+    # request on its own.
+    detect_fragments = [(key, msg[:200]) for key, msg in msgs.iteritems()]
+    msgs_by_lang = collections.defaultdict(collections.OrderedDict)
+    for fragments, resp in _make_batch_requests(apiServers, apiKey, 'detect', {}, detect_fragments):
+        try:
+            if isinstance(resp, Exception):
+                raise resp
+            detected_langs = [detections[0]['language'] for detections in resp['data']['detections']]
+            if len(detected_langs) != len(fragments):
+                raise Exception('expected %d detections, got %d' % (len(fragments), len(detected_langs)))
+        except Exception as e:
+            fail = ('[TRANSLATION_FAIL]', utils.safe_str(e), None)
+            results.update((key, fail) for key, _ in fragments)
+            continue
+
+        for (key, _), from_lang in zip(fragments, detected_langs):
+
+            # 'zh-CN' will be returned as a detected language, but it is not
+            # in the _languages set. So we might need to massage the detected
+            # language.
+            if from_lang not in _languages:
+                from_lang = from_lang.split('-')[0]
+                if from_lang not in _languages:
+                    # This probably means that the detection failed
+                    results[key] = ('[INDETERMINATE]',
+                                    'Language could not be determined',
+                                    None)
+                    continue
+
+            if from_lang == _TARGET_LANGUAGE:
+                # The message is already in the target language. (It isn't
+                # cached, as the message that matched the key is returned.)
+                results[key] = (from_lang, _languages[from_lang], None)
+                continue
+
+            msgs_by_lang[from_lang][key] = msgs[key]
+
+    for from_lang, lang_msgs in msgs_by_lang.iteritems():
+        try:
+            lang_translations = _translate_request_helper(apiServers, apiKey, from_lang, lang_msgs)
+        except Exception as e:
+            lang_translations = dict((key, e) for key in lang_msgs)
+        for key, msg_translated in lang_translations.iteritems():
+            if isinstance(msg_translated, Exception):
+                results[key] = ('[TRANSLATION_FAIL]', utils.safe_str(msg_translated), None)
+            else:
+                results[key] = (from_lang, _languages[from_lang], msg_translated)
+
+    try:
+        _cache.cache_translations(dict((key, result) for key, result in results.iteritems()
+                                       if result[0] != '[TRANSLATION_FAIL]'))
     except Exception as e:
-        return ('[TRANSLATION_FAIL]', utils.safe_str(e), None)
+        logger.exception()
+        logger.error('%s.py: cache error: %s' % (__name__, utils.safe_str(e)))
+
+    return results
 
 
 def _load_languages(apiServers, apiKey):
@@ -111,51 +261,131 @@ def _load_languages(apiServers, apiKey):
                       in resp['data']['languages'])
 
 
-def _translate_request_helper(apiServers, apiKey, from_lang, msg):
+def _get_quoted_size(text):
+    # URL-encoded, which is also how a POST body is encoded
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return len(urllib.quote_plus(text))
+
+
+def _get_request_size(text):
+    # The size of `text` as a "q" parameter
+    return len('&q=') + _get_quoted_size(text)
+
+
+def _get_max_request_size():
+    max_size = _MAX_POST_REQUEST_SIZE if _USE_POST_REQUEST else _MAX_GET_REQUEST_SIZE
+    return max_size - _REQUEST_OVERHEAD_SIZE
+
+
+def _split_message(msg, max_size):
     '''
-    Because requests to the API have a maximum allowed size, we might need to
-    break up our request and recombine the results. This help encapsulates
-    that.
-    Returns translated `msg`.
-    Will throw and exception on error.
+    Splits `msg` into fragments which each fit in a request of `max_size`.
+    Splits between words where possible, and never within a character.
     '''
 
-    # This is a bit tricky. A unicode string of a particular length will
-    # encode to different length UTF-8 strings depending on what characters
-    # are in the unicode string (one to four bytes per character). This
-    # also means that a UTF-8 string can't be split just anywhere -- you might
-    # be splitting a byte sequence, resulting in invalid UTF-8.
-    # In addition, the length of a UTF-8 string will be multiplied by 3 to
-    # account for URL encoding ('\xe6' -> '%E6').
-    # If we wanted to do this naively/simply, we could do:
-    # 5000 - {a little bit for other params} - {unicode length * 4 * 3}
-    # And... that's how we're going to do it. It will result in about twice
-    # as many requests as needed, but a) we're not in a huge hurry, b) we pay
-    # per character, not per request, and c) it's much less complex and less
-    # prone to bugs.
-    # Another downside to smaller requests: Breaking the text up into smaller
-    # pieces surely impacts the quality of the translation.
-    # TESTING NOTE: When using POST, I can't actually get the size limit to
-    # trigger (before hitting "userRateLimitExceed"). So maybe breaking up
-    # this request is a waste of time...?
+    empty_size = _get_request_size(u'')
+    fragments = []
+    fragment = []
+    fragment_size = empty_size
+
+    # With re.split, the odd items are the whitespace
+    for word in re.split(r'(\s+)', msg):
+        word_size = _get_quoted_size(word)
+        if fragment and fragment_size + word_size > max_size:
+            fragments.append(u''.join(fragment))
+            fragment = []
+            fragment_size = empty_size
+
+        # Too large for a request on its own
+        chars = [word] if empty_size + word_size <= max_size else word
+        for char in chars:
+            char_size = _get_quoted_size(char)
+            if fragment and fragment_size + char_size > max_size:
+                fragments.append(u''.join(fragment))
+                fragment = []
+                fragment_size = empty_size
+            fragment.append(char)
+            fragment_size += char_size
+
+    if fragment:
+        fragments.append(u''.join(fragment))
+
+    return fragments
+
+
+def _make_batch_requests(apiServers, apiKey, action, params, fragments):
+    '''
+    `fragments` is a list of (key, text) tuples, where each text fits in a
+    request. Makes `action` requests with as many texts in each as will fit.
+    Yields a (fragments in the request, response) tuple for each request,
+    where response is the exception if the request failed.
+    '''
 
-    max_size = _MAX_POST_REQUEST_SIZE if _USE_POST_REQUEST else _MAX_GET_REQUEST_SIZE
-    msg_size_limit = (max_size - 200) / (4 * 3)
-    result_accumulator = u''
-    start_index = 0
-    while True:
-        msg_fragment = msg[start_index:start_index + msg_size_limit]
-        if not msg_fragment:
-            break
-        start_index += msg_size_limit
+    max_size = _get_max_request_size()
+    start = 0
+    while start < len(fragments):
+        end = start
+        size = 0
+        while (end < len(fragments) and end - start < _MAX_MESSAGES_PER_REQUEST and
+               (end == start or size + _get_request_size(fragments[end][1]) <= max_size)):
+            size += _get_request_size(fragments[end][1])
+            end += 1
+
+        request_fragments = fragments[start:end]
+        request_params = dict(params)
+        request_params['q'] = [text for (_, text) in request_fragments]
+        try:
+            resp = _make_request(apiServers, apiKey, action, request_params)
+        except Exception as e:
+            resp = e
+
+        yield request_fragments, resp
 
-        resp = _make_request(apiServers, apiKey,
-                             'translate',
-                             {'source': from_lang, 'q': msg_fragment})
+        start = end
 
-        result_accumulator += resp['data']['translations'][0]['translatedText']
 
-    return result_accumulator
+def _translate_request_helper(apiServers, apiKey, from_lang, msgs):
+    '''
+    Because requests to the API have a maximum allowed size, we might need to
+    break up our requests and recombine the results. This helper encapsulates
+    that, and puts as many messages into each request as will fit.
+    `msgs` is a dict of key: message, all in `from_lang`.
+    Returns a dict of key: translated message, or the exception if a request
+    for the message failed.
+    '''
+
+    # Messages are split by their URL-encoded size, so each fragment is as
+    # large as a request allows. (This used to assume the worst case of
+    # four UTF-8 bytes per character, each URL-encoded, which made about twice
+    # as many requests as needed.) Breaking the text up into smaller pieces
+    # surely impacts the quality of the translation, but with POST, it's rare
+    # for a message to need more than one request.
+
+    max_size = _get_max_request_size()
+    fragments = [(key, fragment)
+                 for key, msg in msgs.iteritems()
+                 for fragment in _split_message(msg, max_size)]
+
+    results = collections.OrderedDict((key, u'') for key in msgs)
+    for request_fragments, resp in _make_batch_requests(apiServers, apiKey, 'translate',
+                                                        {'source': from_lang}, fragments):
+        try:
+            if isinstance(resp, Exception):
+                raise resp
+            translations = [translation['translatedText'] for translation in resp['data']['translations']]
+            if len(translations) != len(request_fragments):
+                raise Exception('expected %d translations, got %d' % (len(request_fragments), len(translations)))
+        except Exception as e:
+            for key, _ in request_fragments:
+                results[key] = e
+            continue
+
+        for (key, _), translation in zip(request_fragments, translations):
+            if not isinstance(results[key], Exception):
+                results[key] += translation
+
+    return results
 
 
 _lastGoodApiServer = None
@@ -168,7 +398,6 @@ def _make_request(apiServers, apiKey, action, params=None):
     `params` must be None or a dict of query parameters.
     Throws exception on error.
     '''
-
     global _lastGoodApiServer
 
     assert(action in ('languages', 'detect', 'translate'))
@@ -214,13 +443,13 @@ def _make_request(apiServers, apiKey, action, params=None):
     for apiServer in apiServers:
         success = True
 
-        url = 'https://%s/language/translate/v2%s' % (apiServer, action)
+        url = _API_URL_FORMAT % (apiServer, action)
 
         try:
             if _USE_POST_REQUEST:
-                req = requests.post(url, headers=headers, data=params)
+                req = _session.post(url, headers=headers, data=params)
             else:
-                req = requests.get(url, headers=headers, params=params)
+                req = _session.get(url, headers=headers, params=params)
 
             extra_fail = _extra_fail_check(original_action, params, req)
 
@@ -267,9 +496,152 @@ def _extra_fail_check(action, params, req):
     '''
 
     if req.ok and action == 'translate':
-        msg = params['q']
-        msg_translated = req.json()['data']['translations'][0]['translatedText']
-        if msg == msg_translated:
+        # Some messages (like names or numbers) do translate to themselves, so
+        # with more than one message, it's only a failure if none of them
+        # were translated.
+        msgs = params['q'] if isinstance(params['q'], list) else [params['q']]
+        msgs_translated = [translation['translatedText']
+                           for translation in req.json()['data']['translations']]
+        if msgs == msgs_translated:
             return 'Google Translate returned same string'
 
     return False
+
+
+# ===== Benchmark =====
+
+class _MemoryTranslationCache(object):
+
+    def __init__(self):
+        self._translations = {}
+
+    def get_cached_translations(self, keys):
+        return dict((key, self._translations[key]) for key in keys if key in self._translations)
+
+    def cache_translations(self, translations):
+        self._translations.update(translations)
+
+
+class _NoTranslationCache(object):
+
+    def get_cached_translations(self, keys):
+        return {}
+
+    def cache_translations(self, translations):
+        pass
+
+
+class _MockApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Answers like the translate API, after `latency` seconds. ASCII messages
+    # are English, anything else is Persian.
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write
+    wbufsize = -1
+    latency = 0
+    request_count = 0
+
+    def do_POST(self):
+        _MockApiHandler.request_count += 1
+        time.sleep(self.latency)
+
+        params = urlparse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+        msgs = [msg.decode('utf8') for msg in params.get('q', [])]
+
+        if self.path.endswith('/languages'):
+            data = {'languages': [{'language': 'en', 'name': 'English'},
+                                  {'language': 'fa', 'name': 'Persian'}]}
+        elif self.path.endswith('/detect'):
+            data = {'detections': [[{'language': 'en' if all(ord(c) < 128 for c in msg) else 'fa'}]
+                                   for msg in msgs]}
+        else:
+            data = {'translations': [{'translatedText': u'[translated] ' + msg} for msg in msgs]}
+
+        body = json.dumps({'data': data})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _MockApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+# Common feedback messages, in English and Persian
+_BENCHMARK_COMMON_MSGS = [
+    u'not working', u'slow', u'very slow', u'cannot connect', u'thanks',
+    u'\u06a9\u0627\u0631 \u0646\u0645\u06cc \u06a9\u0646\u0647',
+    u'\u062e\u06cc\u0644\u06cc \u06a9\u0646\u062f\u0647',
+    u'\u0648\u0635\u0644 \u0646\u0645\u06cc \u0634\u0647',
+    u'\u0645\u0645\u0646\u0648\u0646',
+    u'\u0642\u0637\u0639 \u0645\u06cc\u0634\u0647',
+]
+
+
+def _get_benchmark_msgs(count):
+    # Most messages are one of the common ones, with varied case and
+    # punctuation; the rest are unique
+    random.seed(0)
+    msgs = []
+    for i in range(count):
+        if random.random() < 0.7:
+            msg = random.choice(_BENCHMARK_COMMON_MSGS)
+            msg = random.choice([msg, msg.upper(), msg.capitalize()]) + random.choice([u'', u'!', u'!!', u'.', u' '])
+        else:
+            msg = u' '.join(random.choice(_BENCHMARK_COMMON_MSGS) for _ in range(random.randint(2, 40))) + u' %d' % i
+        msgs.append(msg)
+    return msgs
+
+
+def _benchmark(count, latency, batch_size):
+    global _API_URL_FORMAT, _cache, _languages
+
+    _MockApiHandler.latency = latency
+    server = _MockApiServer(('127.0.0.1', 0), _MockApiHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    _API_URL_FORMAT = 'http://%s/language/translate/v2%s'
+    api_servers = ['127.0.0.1:%d' % server.server_address[1]]
+    msgs = _get_benchmark_msgs(count)
+
+    print '%d messages, %.3f s API latency' % (count, latency)
+
+    for name, cache, size in [('uncached, one message per call', _NoTranslationCache(), 1),
+                              ('cached, %d messages per call' % batch_size, _MemoryTranslationCache(), batch_size)]:
+        _cache = cache
+        _languages = {}
+        _MockApiHandler.request_count = 0
+        start_time = time.time()
+        results = []
+        for start in range(0, count, size):
+            results += translate_many(api_servers, 'key', msgs[start:start + size])
+        elapsed = time.time() - start_time
+
+        fail_count = len([result for result in results if result[0] == '[TRANSLATION_FAIL]'])
+        print '%s: %d requests, %.3f s, %.2f ms/message, %d failed' % (
+                name, _MockApiHandler.request_count, elapsed, 1000 * elapsed / count, fail_count)
+        if isinstance(cache, _MemoryTranslationCache):
+            print '  %d cached translations, cache hit rate %.1f%%' % (
+                    len(cache._translations), 100.0 * (count - len(cache._translations)) / count)
+
+    _session.close()
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark translation against a mock API server')
+    parser.add_argument('--count', type=int, default=1000, help='number of messages')
+    parser.add_argument('--latency', type=float, default=0.05, help='mock API latency, in seconds')
+    parser.add_argument('--batch-size', type=int, default=100, help='messages per translate_many call')
+    args = parser.parse_args()
+    _benchmark(args.count, args.latency, args.batch_size)
+    sys.exit(0)
@@ -128,6 +128,10 @@ ipv4_regex = re.compile(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})')
 # values that we want to leave intact (like the ID values).
 server_entry_regex = re.compile(r'([0-9A-Fa-f]{33,})')
 
+# Both of the above, so that a value is redacted in a single pass
+_redaction_regex = re.compile(r'(?P<server_entry>%s)|(?P<ipv4>%s)' % (server_entry_regex.pattern,
+                                                                     ipv4_regex.pattern))
+
 
 def convert_psinet_values(config, obj):
     '''
@@ -138,47 +142,35 @@ def convert_psinet_values(config, obj):
     if isinstance(obj, string_types):
         return
 
-    for path, val in objwalk(obj):
-
-        if isinstance(val, string_types):
-
-            #
-            # Find IP addresses in the value and replace them.
-            #
+    index = psi_ops_helpers.get_redaction_index()
 
-            split = re.split(ipv4_regex, val)
+    def redact(match):
+        if match.group('server_entry'):
+            # Remove server entries
+            return '[SERVER ENTRY REDACTED]'
 
-            # With re.split, the odd items are the matches.
-            val_modified = False
-            for i in range(1, len(split)-1, 2):
-                # Leave localhost IP intact
-                if split[i] != '127.0.0.1':
-                    split[i] = psi_ops_helpers.get_server_display_id_from_ip(split[i])
-                    val_modified = True
+        ip = match.group('ipv4')
+        # Leave localhost IP intact
+        if ip == '127.0.0.1':
+            return ip
+        # Replace IP addresses
+        return index.get_server_display_id(ip)
 
-            if val_modified:
-                clean_val = ''.join(split)
-                assign_value_to_obj_at_path(obj, path, clean_val)
-
-            #
-            # Find server entries and remove them
-            #
-
-            split = re.split(server_entry_regex, val)
+    for path, val in objwalk(obj):
 
-            if len(split) > 1:
-                # With re.split, the odd items are the matches. Keep the even items.
-                clean_val = '[SERVER ENTRY REDACTED]'.join(split[::2])
+        if isinstance(val, string_types):
+            clean_val = _redaction_regex.sub(redact, val)
+            if clean_val != val:
                 assign_value_to_obj_at_path(obj, path, clean_val)
 
         if path[-1] == 'PROPAGATION_CHANNEL_ID':
-            prop_channel_name = psi_ops_helpers.get_propagation_channel_name_by_id(val)
+            prop_channel_name = index.get_propagation_channel_name(val)
             if prop_channel_name:
                 assign_value_to_obj_at_path(obj,
                                             path,
                                             prop_channel_name)
         elif path[-1] == 'SPONSOR_ID':
-            sponsor_name = psi_ops_helpers.get_sponsor_name_by_id(val)
+            sponsor_name = index.get_sponsor_name(val)
             if sponsor_name:
                 assign_value_to_obj_at_path(obj,
                                             path,
@@ -19,8 +19,13 @@
 
 import os
 import errno
-import hashlib
 import urllib
+import json
+import mmap
+import time
+import tempfile
+import threading
+from cStringIO import StringIO
 
 import psi_ops_s3
 
@@ -54,25 +59,198 @@ def get_s3_cached_filepath(cache_dir, bucketname, bucket_filename):
     return cache_path
 
 
-def get_s3_attachment(attachment_cache_dir, bucketname, bucket_filename):
+# Files downloaded from S3 are recorded in a manifest in the cache dir, with
+# their ETag and the mtime and size they were written with. A cached file whose
+# mtime and size still match is the file with that ETag, so it doesn't need to
+# be read and hashed to check it. Files are downloaded to a temp file and
+# renamed into place, so a cached file is never partially written, and files
+# already open keep their data. The manifest is written the same way, and only
+# when a file changes: the time each file was last checked in S3 is only
+# updated in memory, so a new process checks each file once.
+S3_CACHE_MANIFEST_FILENAME = '.manifest'
+
+# cache_dir -> ((manifest mtime, size), {cache filename: entry})
+_s3_cache_manifests = {}
+# Cached files kept up to date by refresh_s3_cached_files:
+# cache path -> (cache_dir, bucketname, bucket_filename)
+_s3_refreshed_files = {}
+_s3_cache_lock = threading.Lock()
+
+
+class _MappedFile(mmap.mmap):
+    '''
+    Read-only memory-mapped file. Unlike mmap.read, read() with no size reads
+    to the end, like a file.
+    '''
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self) - self.tell()
+        return mmap.mmap.read(self, size)
+
+
+def get_s3_attachment(attachment_cache_dir, bucketname, bucket_filename, max_age=None):
     '''
     Returns a file-type object for the data.
     '''
-    return get_s3_cached_file(attachment_cache_dir, bucketname, bucket_filename)[0]
+    return get_s3_cached_file(attachment_cache_dir, bucketname, bucket_filename, max_age)[0]
 
 
-def get_s3_cached_file(cache_dir, bucketname, bucket_filename):
+def get_s3_cached_file(cache_dir, bucketname, bucket_filename, max_age=None):
     '''
     Returns a tuple of the file-type object for the data and a boolean indicating
     if this data is new (not from the cache).
     This function checks if the file has already been downloaded. If it has,
-    it checks that the checksum still matches the file in S3. If the file doesn't
-    exist, or if it the checksum doesn't match, the file is downloaded and
-    cached to disk.
+    it checks that the ETag still matches the file in S3. If the file doesn't
+    exist, or if the ETag doesn't match, the file is downloaded and cached to
+    disk.
+    If `max_age` is given, S3 is only checked if it hasn't been in the last
+    `max_age` seconds, and the file is kept up to date by
+    refresh_s3_cached_files.
+    The file-type object is memory-mapped, read-only.
+    '''
+
+    cache_path, _, is_new = _update_s3_cached_file(cache_dir, bucketname, bucket_filename, max_age)
+
+    with open(cache_path, 'rb') as cache_file:
+        # Empty files can't be mapped
+        if os.fstat(cache_file.fileno()).st_size == 0:
+            return (StringIO(''), is_new)
+        return (_MappedFile(cache_file.fileno(), 0, access=mmap.ACCESS_READ), is_new)
+
+
+def get_s3_cached_file_etag(cache_dir, bucketname, bucket_filename, max_age=None):
+    '''
+    Returns the ETag of the cached file, which changes when a new version is
+    downloaded. Arguments are as for get_s3_cached_file.
+    '''
+    return _update_s3_cached_file(cache_dir, bucketname, bucket_filename, max_age)[1]['etag']
+
+
+def refresh_s3_cached_files():
+    '''
+    Checks the files read with a `max_age` by this process in S3, and
+    downloads new versions. To be called periodically (at least every
+    `max_age` seconds) by long-running processes, so that reading files doesn't
+    wait on S3.
+    Returns a list of (bucket_filename, exception) for files that failed.
+    '''
+
+    with _s3_cache_lock:
+        refreshed_files = _s3_refreshed_files.values()
+
+    errors = []
+    for cache_dir, bucketname, bucket_filename in refreshed_files:
+        try:
+            _update_s3_cached_file(cache_dir, bucketname, bucket_filename, 0)
+        except Exception as ex:
+            errors.append((bucket_filename, ex))
+    return errors
+
+
+def _update_s3_cached_file(cache_dir, bucketname, bucket_filename, max_age):
+    '''
+    Downloads the file if it isn't cached or is stale.
+    Returns a tuple of (cache path, manifest entry, is new).
     '''
 
     cache_path = get_s3_cached_filepath(cache_dir, bucketname, bucket_filename)
+    cache_filename = os.path.basename(cache_path)
+
+    with _s3_cache_lock:
+        if max_age is not None:
+            _s3_refreshed_files[cache_path] = (cache_dir, bucketname, bucket_filename)
+        entry = _get_s3_cache_manifest(cache_dir).get(cache_filename)
+
+    # Check that the file is still the one in the manifest.
+    if entry:
+        try:
+            if _get_file_version(cache_path) != (entry['mtime'], entry['size']):
+                entry = None
+        except OSError:
+            entry = None
 
+    if entry and max_age is not None and time.time() - entry['checked'] < max_age:
+        return (cache_path, entry, False)
+
+    key = _get_s3_key(bucketname, bucket_filename)
+    etag = key.etag.strip('"').lower()
+
+    is_new = not entry or entry['etag'] != etag
+    if is_new:
+        # The cached file either doesn't exist or is stale.
+        mtime, size = _write_file_atomically(cache_path, key.get_file)
+    else:
+        mtime, size = entry['mtime'], entry['size']
+
+    entry = {'etag': etag, 'mtime': mtime, 'size': size, 'checked': time.time()}
+    with _s3_cache_lock:
+        manifest = _get_s3_cache_manifest(cache_dir)
+        old_entry = manifest.get(cache_filename)
+        manifest[cache_filename] = entry
+        if not old_entry or any(old_entry[field] != entry[field] for field in ('etag', 'mtime', 'size')):
+            manifest_path = os.path.join(cache_dir, S3_CACHE_MANIFEST_FILENAME)
+            _write_file_atomically(manifest_path, lambda f: json.dump(manifest, f))
+            _s3_cache_manifests[cache_dir] = (_get_file_version(manifest_path), manifest)
+
+    return (cache_path, entry, is_new)
+
+
+def _get_s3_cache_manifest(cache_dir):
+    # Must be called with _s3_cache_lock held. Reloads the manifest if another
+    # process has written it.
+    manifest_path = os.path.join(cache_dir, S3_CACHE_MANIFEST_FILENAME)
+    try:
+        manifest_version = _get_file_version(manifest_path)
+    except OSError:
+        manifest_version = None
+
+    cached = _s3_cache_manifests.get(cache_dir)
+    if cached and cached[0] == manifest_version:
+        return cached[1]
+
+    manifest = {}
+    if manifest_version:
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except ValueError:
+            # The files will be checked and the manifest rewritten.
+            pass
+
+    _s3_cache_manifests[cache_dir] = (manifest_version, manifest)
+    return manifest
+
+
+def _get_file_version(path):
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+
+def _write_file_atomically(path, write):
+    '''
+    Calls `write(file)` with a temp file, and renames it to `path`.
+    Returns the (mtime, size) of the written file.
+    '''
+
+    temp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                            prefix='.tmp',
+                                            delete=False)
+    try:
+        with temp_file:
+            write(temp_file)
+        # Readable like files created by open(), not just by this user
+        os.chmod(temp_file.name, 0644)
+        file_version = _get_file_version(temp_file.name)
+        os.rename(temp_file.name, path)
+    except:
+        os.remove(temp_file.name)
+        raise
+
+    return file_version
+
+
+def _get_s3_key(bucketname, bucket_filename):
     # Make the connection using the credentials in the boto config file.
     conn = S3Connection()
 
@@ -84,30 +262,7 @@ def get_s3_cached_file(cache_dir, bucketname, bucket_filename):
     # If we don't specify `validate=False`, then this call will attempt to
     # list all keys, which might not be permitted by the bucket (and isn't).
     bucket = conn.get_bucket(bucketname, validate=False)
-    key = bucket.get_key(bucket_filename)
-    etag = key.etag.strip('"').lower()
-
-    # Check if the file exists. If so, check if it's stale.
-    if os.path.isfile(cache_path):
-        cache_file = open(cache_path, 'rb')
-        cache_hex = hashlib.md5(cache_file.read()).hexdigest().lower()
-
-        # Do the hashes match?
-        if etag == cache_hex:
-            cache_file.seek(0)
-            return (cache_file, False)
-
-        cache_file.close()
-
-    # The cached file either doesn't exist or is stale.
-    cache_file = open(cache_path, 'w')
-    key.get_file(cache_file)
-
-    # Close the file and re-open for read-only
-    cache_file.close()
-    cache_file = open(cache_path, 'rb')
-
-    return (cache_file, True)
+    return bucket.get_key(bucket_filename)
 
 
 def get_s3_string(bucketname, bucket_filename):
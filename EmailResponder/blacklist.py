@@ -24,20 +24,24 @@ in a day. This is both to hinder/prevent abuse of the system.
 
 import argparse
 import hashlib
+import time
+import threading
 import settings
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy import Column, String, Integer
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.exc import IntegrityError
 
 
 _Base = declarative_base()
 
 
 class _BlacklistAdhoc(_Base):
-    __tablename__ = 'blacklist_adhoc'
+    # Request counts per address per day (UTC, in days since the epoch). The
+    # counts of previous days are deleted by clear_adhoc.
+    __tablename__ = 'blacklist_adhoc_daily'
     emailhash = Column(String(40), primary_key=True, nullable=False)
+    day = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
     count = Column(Integer, default=0, nullable=False)
 
 
@@ -61,10 +65,57 @@ class _WhitelistEmail(_Base):
     emailhash = Column(String(40), primary_key=True, nullable=False)
 
 
-_dbengine = create_engine('mysql://%s:%s@localhost/%s' % (settings.DB_USERNAME, settings.DB_PASSWORD, settings.DB_DBNAME))
+# The mail_process service keeps pooled connections open indefinitely;
+# recycle them before MySQL's wait_timeout closes them.
+_dbengine = create_engine('mysql://%s:%s@localhost/%s' % (settings.DB_USERNAME, settings.DB_PASSWORD, settings.DB_DBNAME),
+                          pool_recycle=3600)
 _Base.metadata.create_all(_dbengine)
 _Session = sessionmaker(bind=_dbengine)
 
+# Adds a request to the address's count for the day in one statement. The row
+# stays locked until the transaction is committed, so concurrent requests from
+# the same address are counted one after the other.
+_ADHOC_INCREMENT = text('INSERT INTO blacklist_adhoc_daily (emailhash, day, count) '
+                        'VALUES (:emailhash, :day, 1) '
+                        'ON DUPLICATE KEY UPDATE count = count + 1')
+
+# The perma-black/whitelists are small and rarely change, so they're kept in
+# memory as sets of hashes, and reloaded every
+# BLACKLIST_LISTS_REFRESH_INTERVAL_SECONDS.
+# table class -> set of hashes
+_lists = None
+_lists_load_time = 0
+
+# Hashes of the addresses which have reached the daily limit: (day, set).
+# Counts only go up during a day, so these aren't looked up again.
+_over_limit = (None, set())
+
+_lock = threading.Lock()
+
+
+def _current_day():
+    return int(time.time()) // (24*60*60)
+
+
+def _get_lists():
+    global _lists, _lists_load_time
+
+    with _lock:
+        if _lists is None or \
+                time.time() - _lists_load_time > settings.BLACKLIST_LISTS_REFRESH_INTERVAL_SECONDS:
+            dbsession = _Session()
+            try:
+                _lists = dict((column.class_, set(hashvalue for (hashvalue,) in dbsession.query(column)))
+                              for column in (_WhitelistEmail.emailhash,
+                                             _WhitelistDomain.domainhash,
+                                             _BlacklistEmail.emailhash,
+                                             _BlacklistDomain.domainhash))
+            finally:
+                dbsession.close()
+            _lists_load_time = time.time()
+
+        return _lists
+
 
 class Blacklist(object):
     def __init__(self):
@@ -72,14 +123,15 @@ class Blacklist(object):
 
     def clear_adhoc(self):
         '''
-        Deletes *all* entries from the blacklist table. Should be run exactly
-        once a day (or whatever the blacklist window is).
+        Deletes the request counts of previous days. Counts are kept per day,
+        so this only needs to be run once in a while (daily) to free space.
         '''
-        # Drop the table.
-        _BlacklistAdhoc.__table__.drop(bind=_dbengine)
+        dbsession = _Session()
+        dbsession.query(_BlacklistAdhoc).filter(_BlacklistAdhoc.day < _current_day()).delete(synchronize_session=False)
+        dbsession.commit()
 
-        # Re-create the table so that any immediately following calls won't fail.
-        _BlacklistAdhoc.__table__.create(bind=_dbengine)
+        # The table of counts from before they were kept per day
+        _dbengine.execute('DROP TABLE IF EXISTS blacklist_adhoc')
 
     def _hash_addr(self, email_addr):
         return hashlib.sha1(email_addr.lower()).hexdigest()
@@ -104,43 +156,51 @@ class Blacklist(object):
             return False
 
         emailhash = self._hash_addr(email_addr)
+        domainhash = self._hash_addr(domain)
 
-        dbsession = _Session()
+        lists = _get_lists()
 
         # Is this address whitelisted via DB info?
-        if self.is_email_whitelisted(email_addr, dbsession) or \
-           self.is_domain_whitelisted(domain, dbsession):
+        if emailhash in lists[_WhitelistEmail] or \
+           domainhash in lists[_WhitelistDomain]:
             return True
 
         # Is the user or his domain total blacklisted?
-        if self.is_email_blacklisted(email_addr, dbsession) or \
-           self.is_domain_blacklisted(domain, dbsession):
+        if emailhash in lists[_BlacklistEmail] or \
+           domainhash in lists[_BlacklistDomain]:
             return False
 
-        match = dbsession.query(_BlacklistAdhoc).filter_by(emailhash=emailhash).first()
+        return self._count_request(emailhash)
 
-        if not match:
-            newrecord = _BlacklistAdhoc(emailhash=emailhash, count=1)
-            dbsession.add(newrecord)
-        else:
-            if match.count < settings.BLACKLIST_DAILY_LIMIT:
-                match.count += 1
-            else:
+    def _count_request(self, emailhash):
+        '''
+        Adds a request to the address's count for today. Returns False if that
+        exceeds the daily limit.
+        '''
+        global _over_limit
+
+        day = _current_day()
+
+        with _lock:
+            if _over_limit[0] != day:
+                _over_limit = (day, set())
+            if emailhash in _over_limit[1]:
                 # Request count limit exceeded
                 return False
 
-        # We added/incremented the request count for this user, but they haven't
-        # exceeded the limit.
-
+        dbsession = _Session()
         try:
+            dbsession.execute(_ADHOC_INCREMENT, {'emailhash': emailhash, 'day': day})
+            count = dbsession.query(_BlacklistAdhoc.count).filter_by(emailhash=emailhash, day=day).scalar()
             dbsession.commit()
-        except IntegrityError:
-            # This can occur in a race condition scenario: two emails arrive
-            # from the same email address at the same time; two
-            # mail_process.py instances are created to process them; both
-            # instances do  blacklist checks and don't find a pre-existing
-            # entry; both  instances try to insert a new blacklist entry; the
-            # last to commit get a duplicate primary key error.
+        finally:
+            dbsession.close()
+
+        if count > settings.BLACKLIST_DAILY_LIMIT:
+            # Request count limit exceeded
+            with _lock:
+                if _over_limit[0] == day:
+                    _over_limit[1].add(emailhash)
             return False
 
         return True
@@ -243,7 +303,7 @@ class Blacklist(object):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Interact with the blacklist table')
-    parser.add_argument('--clear-adhoc', action='store_true', help='clear all blacklist entries')
+    parser.add_argument('--clear-adhoc', action='store_true', help='clear blacklist entries from previous days')
     parser.add_argument('--add-blacklist', action='store', help='add email or domain to blacklist')
     parser.add_argument('--add-whitelist', action='store', help='add email or domain to whitelist')
     args = parser.parse_args()
@@ -31,13 +31,16 @@ echo "Copying source files..."
 
 # Copy the simple files
 sudo cp blacklist.py log_processor.py mail_direct.py mail_process.py mail_stats.py \
-        aws_helpers.py sendmail.py settings.py conf_pull.py postfix_queue_check.pl \
+        service_mail_process.py aws_helpers.py sendmail.py settings.py conf_pull.py postfix_queue_check.pl \
         mon-put-instance-data.pl CloudWatchClient.pm AwsSignatureV4.pm \
         ../Automation/psi_ops_s3.py helo_access sender_access header_checks logger.py \
         $MAIL_HOME
 
-# forward needs to be copied to .forward
-sudo cp forward $MAIL_HOME/.forward
+# Postfix delivers requests to the spool processed by the mail_process service.
+# forward_spool needs to be copied to .forward. (To fall back to running
+# mail_process.py for each email instead, copy forward to .forward and stop
+# the service.)
+sudo cp forward_spool $MAIL_HOME/.forward
 
 # Fix ownership of the files
 sudo chown mail_responder:mail_responder $MAIL_HOME/* $MAIL_HOME/.forward
@@ -65,6 +68,10 @@ sudo reload rsyslog
 sudo service rsyslog restart
 sudo cp 50_scores.cf /etc/spamassassin/
 sudo service spamassassin restart
+sed "s|fill-in-with-path-to-source|$MAIL_HOME|" mail_process.conf > mail_process.conf.configured
+sudo mv mail_process.conf.configured /etc/init/mail_process.conf
+sudo chown root:root /etc/init/mail_process.conf
+sudo chmod 644 /etc/init/mail_process.conf
 
 
 # Create the cron jobs.
@@ -80,5 +87,10 @@ fi
 # Do an initial config pull
 cd $MAIL_HOME && sudo -u$MAIL_USER python conf_pull.py && cd -
 
+# (Re)start the mail_process service to pick up the new code. Spooled email
+# waits for it.
+echo "Restarting mail_process service..."
+sudo restart mail_process || sudo start mail_process
+
 
 echo "Done"
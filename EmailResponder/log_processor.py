@@ -21,9 +21,13 @@ import os
 import sys
 import re
 import time
+import threading
+import Queue
+import argparse
+import logging
 import settings
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy import Column, String, Integer
 from sqlalchemy.dialects.mysql import BIGINT
 from sqlalchemy.orm import sessionmaker
@@ -32,6 +36,17 @@ Base = declarative_base()
 
 QUEUE_ID_LENGTH = 10
 
+# This regex accomodates both default and high-precision date-times.
+# Jun 28 16:11:25
+# 2012-06-28T16:11:25.696983+00:00
+LOG_REGEX = re.compile("^(?P<date>(?:[a-zA-Z]{3}\s+\d\d?\s[0-9\:]+)|(?:[0-9T\:\.+-]+))(?:\s(?P<suppliedhost>[a-zA-Z0-9_-]+))?\s(?P<host>[a-zA-Z0-9_-]+)\s(?P<process>[a-zA-Z0-9\/_-]+)(\[(?P<pid>\d+)\])?:\s(?P<message>.+)$")
+
+# Log lines are processed in one DB transaction, which is committed when it
+# has been open this long or has this many lines. A crash loses at most that
+# much.
+COMMIT_INTERVAL_SECONDS = 5
+COMMIT_BATCH_SIZE = 1000
+
 
 def now_milliseconds():
     return int(time.time()*1000)
@@ -131,8 +146,10 @@ class LogHandlers(object):
              self._no_op),
 
             # Jun 27 19:24:05 myhostname postfix/local[30853]: 9B578221EA: to=<mail_responder+get@localhost>, orig_to=<get@psiphon3.com>, relay=local, delay=0.83, delays=0.06/0.01/0/0.76, dsn=2.0.0, status=sent (delivered to command: python /home/mail_responder/mail_process.py)
+            # With the mail_process service, the request is delivered to its spool instead:
+            # ... status=sent (delivered to maildir)
             (re.compile(r'^postfix/local$'),
-             re.compile(r'^'+self.queue_id_matcher+': to=<mail_responder.*status=sent \(delivered to command'),
+             re.compile(r'^'+self.queue_id_matcher+': to=<mail_responder.*status=sent \(delivered to (command|maildir)'),
              self._process_response_done),
 
             # Jun 27 19:24:05 myhostname postfix/qmgr[821]: 9B578221EA: removed
@@ -374,6 +391,28 @@ class LogHandlers(object):
 
             )
 
+        # process -> [(message matcher, handler), ...], in the order of
+        # self.handlers. Filled in as process names are seen, so each line is
+        # only matched against the messages of its process.
+        self._process_handlers = {}
+
+    def get_handler(self, process, message):
+        '''
+        Returns the first handler matching the process and message, or None.
+        '''
+        process_handlers = self._process_handlers.get(process)
+        if process_handlers is None:
+            process_handlers = [(message_matcher, handler)
+                                for process_matcher, message_matcher, handler in self.handlers
+                                if process_matcher.match(process)]
+            self._process_handlers[process] = process_handlers
+
+        for message_matcher, handler in process_handlers:
+            if message_matcher.match(message):
+                return handler
+
+        return None
+
     def _no_op(self, logdict, dbsession):
         return self.NO_RECORD_MATCH
 
@@ -430,7 +469,8 @@ class LogHandlers(object):
 
     def _process_response_done(self, logdict, dbsession):
         '''
-        Process notification that mail_process.py finished its work.
+        Process notification that mail_process.py finished its work (or, with
+        the mail_process service, that the request was spooled for it).
         Record the time.
         '''
         m = re.match('^(?P<queue_id>'+self.queue_id_matcher+'): .*, orig_to=<(?P<request_address>[^>]+)>, .*',
@@ -578,64 +618,192 @@ class curry:
 
         return self.fun(*(self.pending + args), **kw)
 
-def process_log(log_line):
-
-    # This regex accomodates both default and high-precision date-times.
-    # Jun 28 16:11:25
-    # 2012-06-28T16:11:25.696983+00:00
-    log_regex = re.compile("^(?P<date>(?:[a-zA-Z]{3}\s+\d\d?\s[0-9\:]+)|(?:[0-9T\:\.+-]+))(?:\s(?P<suppliedhost>[a-zA-Z0-9_-]+))?\s(?P<host>[a-zA-Z0-9_-]+)\s(?P<process>[a-zA-Z0-9\/_-]+)(\[(?P<pid>\d+)\])?:\s(?P<message>.+)$")
-
-    log_handlers = LogHandlers()
-
-    log_search_res = log_regex.search(log_line)
-    if log_search_res is None:
-        return
+class LogProcessor(object):
+    '''
+    Processes log lines with one set of handlers and one DB session. Changes
+    are committed every COMMIT_INTERVAL_SECONDS or COMMIT_BATCH_SIZE lines
+    (see commit_if_due), and by commit().
+    '''
+
+    def __init__(self,
+                 session_factory=None,
+                 commit_interval=COMMIT_INTERVAL_SECONDS,
+                 commit_batch_size=COMMIT_BATCH_SIZE):
+        self._log_handlers = LogHandlers()
+        self._dbsession = (session_factory or Session)()
+        self._commit_interval = commit_interval
+        self._commit_batch_size = commit_batch_size
+        self._uncommitted_count = 0
+        self._uncommitted_start = None
+        self._process_name = os.path.basename(sys.argv[0])
+
+    def process_log(self, log_line):
+        log_search_res = LOG_REGEX.search(log_line)
+        if log_search_res is None:
+            return
+
+        logdict = log_search_res.groupdict()
+
+        # Exclude logs created by this process to avoid circular disaster.
+        if logdict['process'] == self._process_name:
+            return
+
+        handler = self._log_handlers.get_handler(logdict['process'], logdict['message'])
+        if not handler:
+            logger.warning('no handler match found for: %s', log_line)
+            return
+
+        # Each line is handled in a savepoint, so that an exception only
+        # loses that line's changes and not the uncommitted lines before it
+        savepoint = self._dbsession.begin_nested()
+        try:
+            ret = handler(logdict, self._dbsession)
+        except:
+            savepoint.rollback()
+            self.commit()
+            raise
+        savepoint.commit()
+
+        # Handlers don't change anything before failing, so there's nothing
+        # to roll back for a failure.
+        if ret == LogHandlers.SUCCESS:
+            if not self._uncommitted_count:
+                self._uncommitted_start = time.time()
+            self._uncommitted_count += 1
+        elif ret == LogHandlers.NO_RECORD_MATCH:
+            logger.warning('no record match for: %s', log_line)
+        else:
+            logger.warning('handler failed for: %s', log_line)
 
-    logdict = log_search_res.groupdict()
+        self.commit_if_due()
 
-    # Exclude logs created by this process to avoid circular disaster.
-    if logdict['process'] == os.path.basename(sys.argv[0]):
-        return
+    def next_commit_time(self):
+        '''
+        Returns the time by which commit_if_due should be called, or None if
+        there is nothing to commit.
+        '''
+        if not self._uncommitted_count:
+            return None
+        return self._uncommitted_start + self._commit_interval
 
-    handler_found = False
+    def commit_if_due(self):
+        if self._uncommitted_count >= self._commit_batch_size or \
+                (self._uncommitted_count and time.time() >= self.next_commit_time()):
+            self.commit()
 
-    for handler in log_handlers.handlers:
-        if handler[0].match(logdict['process']) and handler[1].match(logdict['message']):
-            dbsession = Session()
+    def commit(self):
+        if self._uncommitted_count:
+            self._dbsession.commit()
+            self._uncommitted_count = 0
+            self._uncommitted_start = None
 
-            ret = handler[2](logdict, dbsession)
 
-            if ret == LogHandlers.SUCCESS:
-                dbsession.commit()
-            elif ret == LogHandlers.NO_RECORD_MATCH:
-                logger.warning('no record match for: %s', log_line)
-                dbsession.rollback()
-            else:
-                logger.warning('handler failed for: %s', log_line)
-                dbsession.rollback()
+def _read_lines(stream, lines):
+    # Reading blocks, so it's done in this thread while the main thread
+    # processes lines and commits on time
+    while True:
+        line = stream.readline()
+        lines.put(line)
+        if not line:
+            return
 
-            handler_found = True
-            break
 
-    if not handler_found:
-        logger.warning('no handler match found for: %s', log_line)
+def main():
+    log_processor = LogProcessor()
 
+    lines = Queue.Queue(COMMIT_BATCH_SIZE)
+    reader = threading.Thread(target=_read_lines, args=(sys.stdin, lines))
+    reader.daemon = True
+    reader.start()
 
-if __name__ == '__main__':
     while True:
-        log_line = sys.stdin.readline()
+        next_commit_time = log_processor.next_commit_time()
+        try:
+            if next_commit_time is None:
+                log_line = lines.get()
+            else:
+                log_line = lines.get(timeout=max(0, next_commit_time - time.time()))
+        except Queue.Empty:
+            log_processor.commit_if_due()
+            continue
 
         # rsyslog's omprog sends an empty string to indicate that the processor should quit.
         if not log_line:
+            log_processor.commit()
             sys.exit(0)
 
         try:
-            process_log(log_line)
+            log_processor.process_log(log_line)
         except:
             logger.error('exception for log: %s', log_line)
             raise
 
 
+def _benchmark(log_filename, db_url):
+    '''
+    Replays a captured Postfix log (such as /var/log/mail.log) through the
+    processor, into a scratch database, and reports lines/second: with
+    handlers and a session created and committed for each line, as before,
+    with a commit per line, and with batched commits.
+    '''
+
+    # Don't log warnings or bad addresses from the replay into the real logs
+    logger.setLevel(logging.ERROR)
+
+    with open(log_filename) as log_file:
+        log_lines = log_file.readlines()
+
+    benchmark_engine = create_engine(db_url)
+    if benchmark_engine.dialect.name == 'sqlite':
+        # pysqlite's own transaction handling breaks the savepoints used by
+        # process_log; let SQLAlchemy begin transactions instead
+        @event.listens_for(benchmark_engine, 'connect')
+        def _connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(benchmark_engine, 'begin')
+        def _begin(connection):
+            connection.execute('BEGIN')
+
+    BenchmarkSession = sessionmaker(bind=benchmark_engine)
+
+    def per_line(log_line):
+        LogProcessor(BenchmarkSession, commit_batch_size=1).process_log(log_line)
+
+    commit_per_line = LogProcessor(BenchmarkSession, commit_batch_size=1)
+    batched = LogProcessor(BenchmarkSession)
+
+    for name, process_log, log_processor in (('new processor per line', per_line, None),
+                                             ('commit per line', commit_per_line.process_log, commit_per_line),
+                                             ('batched commits', batched.process_log, batched)):
+        Base.metadata.drop_all(benchmark_engine)
+        Base.metadata.create_all(benchmark_engine)
+
+        start_time = time.time()
+        for log_line in log_lines:
+            process_log(log_line)
+        if log_processor:
+            log_processor.commit()
+        elapsed = time.time() - start_time
+
+        print('%-24s %d lines in %.3f s: %.0f lines/s' % (name, len(log_lines), elapsed, len(log_lines) / elapsed))
+
+    Base.metadata.drop_all(benchmark_engine)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        parser = argparse.ArgumentParser(description='Process Postfix logs from rsyslog (on stdin)')
+        parser.add_argument('--benchmark', metavar='LOGFILE', required=True,
+                            help='replay a captured log and report lines/second')
+        parser.add_argument('--db-url', default='sqlite://',
+                            help='scratch database for --benchmark (tables are dropped); default in-memory SQLite')
+        args = parser.parse_args()
+        _benchmark(args.benchmark, args.db_url)
+    else:
+        main()
+
+
 '''
 This is a what the syslogs look like for a successful request+response.
 
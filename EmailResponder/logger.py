@@ -72,3 +72,12 @@ _handler_json.formatter = logging.Formatter(fmt='%(ident)s[%(process)d][%(facili
 logger_json = logging.getLogger(_main+'-json')
 logger_json.setLevel(logging.DEBUG if _DEBUG else logging.INFO)
 logger_json.addHandler(_handler_json)
+
+
+def set_ident(ident):
+    '''
+    Log as `ident` instead of the main module's file name. Used by services
+    which run another module's code and must log like it.
+    '''
+    _handler.ident = ident
+    _handler_json.ident = ident
@@ -25,10 +25,16 @@ import re
 import traceback
 import time
 import tempfile
+import threading
+import socket
+import smtplib
 import dkim
 import authres
 import errno
+import hashlib
+import collections
 from boto.exception import BotoServerError
+from boto.ses.connection import SESConnection
 
 from logger import logger, logger_json
 import settings
@@ -43,6 +49,27 @@ ADDRESS_MAPS_LIST_FILE = os.path.join(os.path.expanduser('~%s' % settings.MAIL_R
                                       'postfix_address_maps')
 
 
+# Files read for every email (the responder config and the DKIM key) are kept
+# in memory until they change on disk. This matters when running as the
+# mail_process service, where one process handles many emails.
+# path -> ((mtime, size), value)
+_file_cache = {}
+_file_cache_lock = threading.Lock()
+
+# Encoded response bodies and attachments (see sendmail.create_raw_email_template),
+# so that the attachments aren't read and base64-encoded again for every
+# response. Least recently used templates are dropped when the total size
+# exceeds RESPONSE_TEMPLATE_CACHE_MAX_BYTES.
+# config entry digest -> (attachment ETags, template)
+RESPONSE_TEMPLATE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+_response_templates = collections.OrderedDict()
+_response_templates_lock = threading.Lock()
+
+# Connections kept open between emails in the mail_process service. Each
+# worker thread has its own.
+_connections = threading.local()
+
+
 class MailResponder(object):
     '''
     Takes a configuration file and an email and sends back the appropriate
@@ -67,12 +94,12 @@ class MailResponder(object):
         self._response_from_addr = settings.RESPONSE_FROM_ADDR
 
         try:
-            with open(aws_helpers.get_s3_cached_filepath(
-                                    settings.ATTACHMENT_CACHE_DIR,
-                                    settings.CONFIG_S3_BUCKET,
-                                    settings.CONFIG_S3_KEY)) as conffile:
-                # Note that json.load reads in unicode strings.
-                self._conf = json.load(conffile)
+            # Note that json.load reads in unicode strings.
+            self._conf = _read_cached_file(aws_helpers.get_s3_cached_filepath(
+                                                settings.ATTACHMENT_CACHE_DIR,
+                                                settings.CONFIG_S3_BUCKET,
+                                                settings.CONFIG_S3_KEY),
+                                           json.load)
 
             all_email_addrs = set()
             # Do some validation
@@ -121,16 +148,6 @@ class MailResponder(object):
         full_success = True
         exception_to_raise = None
         for conf in request_conf:
-            attachments = None
-            if conf['attachments']:
-                attachments = []
-                for attachment_info in conf['attachments']:
-                    bucketname, bucket_filename, attachment_filename = attachment_info
-                    attachments.append((aws_helpers.get_s3_attachment(settings.ATTACHMENT_CACHE_DIR,
-                                                                      bucketname,
-                                                                      bucket_filename),
-                                        attachment_filename))
-
             extra_headers = {
                 'Reply-To': self.requested_addr,
                 'Auto-Submitted': 'auto-replied' }
@@ -139,12 +156,11 @@ class MailResponder(object):
                 extra_headers['In-Reply-To'] = self._requester_msgid
                 extra_headers['References'] = self._requester_msgid
 
-            raw_response = sendmail.create_raw_email(self._requester_addr,
-                                                     self._response_from_addr,
-                                                     self._subject,
-                                                     conf['body'],
-                                                     attachments,
-                                                     extra_headers)
+            raw_response = sendmail.create_raw_email_from_template(_get_response_template(conf),
+                                                                   self._requester_addr,
+                                                                   self._response_from_addr,
+                                                                   self._subject,
+                                                                   extra_headers)
 
             if not raw_response:
                 full_success = False
@@ -154,7 +170,8 @@ class MailResponder(object):
                 # If sending via SES, we'll use its DKIM facility -- so don't do it here.
                 try:
                     if not sendmail.send_raw_email_amazonses(raw_response,
-                                                             self._response_from_addr):
+                                                             self._response_from_addr,
+                                                             conn=_get_ses_connection()):
                         return False
                 except BotoServerError as ex:
                     if ex.error_message == 'Address blacklisted.':
@@ -167,9 +184,9 @@ class MailResponder(object):
             else:
                 raw_response = _dkim_sign_email(raw_response)
 
-                if not sendmail.send_raw_email_smtp(raw_response,
-                                                    settings.COMPLAINTS_ADDRESS,  # will be Return-Path
-                                                    self._requester_addr):
+                if not _send_raw_email_smtp(raw_response,
+                                            settings.COMPLAINTS_ADDRESS,  # will be Return-Path
+                                            self._requester_addr):
                     full_success = False
                     continue
 
@@ -432,10 +449,113 @@ def _dkim_sign_email(raw_email):
     '''
 
     sig = dkim.sign(raw_email, settings.DKIM_SELECTOR, settings.DKIM_DOMAIN,
-                    open(settings.DKIM_PRIVATE_KEY).read())
+                    _read_cached_file(settings.DKIM_PRIVATE_KEY, lambda f: f.read()))
     return sig + raw_email
 
 
+def _read_cached_file(path, load):
+    '''
+    Returns `load(file)` for the file at `path`, from memory if the file
+    hasn't changed since it was last loaded.
+    '''
+
+    stat = os.stat(path)
+    file_version = (stat.st_mtime, stat.st_size)
+
+    with _file_cache_lock:
+        cached = _file_cache.get(path)
+    if cached and cached[0] == file_version:
+        return cached[1]
+
+    with open(path) as f:
+        value = load(f)
+
+    with _file_cache_lock:
+        _file_cache[path] = (file_version, value)
+
+    return value
+
+
+def _get_response_template(conf):
+    '''
+    Returns the response template for the config entry, from memory unless
+    the entry or any of its attachments in S3 has changed.
+    '''
+
+    attachments_info = conf['attachments'] or []
+
+    # Config entries are compared by value, as the config is reloaded when it
+    # changes. Attachments are compared by the ETag of the cached file, which
+    # changes whenever a new version is downloaded.
+    conf_digest = hashlib.sha1(json.dumps([conf['body'], attachments_info],
+                                          sort_keys=True)).hexdigest()
+    etags = tuple(aws_helpers.get_s3_cached_file_etag(settings.ATTACHMENT_CACHE_DIR,
+                                                      bucketname,
+                                                      bucket_filename,
+                                                      settings.ATTACHMENT_CACHE_REFRESH_INTERVAL_SECONDS)
+                  for bucketname, bucket_filename, _ in attachments_info)
+
+    with _response_templates_lock:
+        cached = _response_templates.pop(conf_digest, None)
+        if cached and cached[0] == etags:
+            _response_templates[conf_digest] = cached
+            return cached[1]
+
+    attachments = None
+    if attachments_info:
+        attachments = []
+        for bucketname, bucket_filename, attachment_filename in attachments_info:
+            attachments.append((aws_helpers.get_s3_attachment(settings.ATTACHMENT_CACHE_DIR,
+                                                              bucketname,
+                                                              bucket_filename,
+                                                              settings.ATTACHMENT_CACHE_REFRESH_INTERVAL_SECONDS),
+                                attachment_filename))
+
+    template = sendmail.create_raw_email_template(conf['body'], attachments)
+
+    with _response_templates_lock:
+        _response_templates[conf_digest] = (etags, template)
+        # Keep at least the newest template, however big
+        while len(_response_templates) > 1 and \
+                sum(len(mime_headers) + len(encoded_body)
+                    for _, (mime_headers, encoded_body) in _response_templates.itervalues()) \
+                > RESPONSE_TEMPLATE_CACHE_MAX_BYTES:
+            _response_templates.popitem(last=False)
+
+    return template
+
+
+def _get_ses_connection():
+    if getattr(_connections, 'ses', None) is None:
+        _connections.ses = SESConnection()
+    return _connections.ses
+
+
+def _send_raw_email_smtp(raw_email, from_address, recipients):
+    '''
+    Sends the raw email via the local SMTP send service, reusing this thread's
+    connection. Returns True on success, False otherwise; may raise exceptions.
+    '''
+
+    for attempt in range(2):
+        smtp_server = getattr(_connections, 'smtp', None)
+        if smtp_server is None:
+            try:
+                smtp_server = smtplib.SMTP('localhost', settings.LOCAL_SMTP_SEND_PORT)
+            except:
+                return False
+            _connections.smtp = smtp_server
+
+        try:
+            return sendmail.send_raw_email_smtp(raw_email, from_address, recipients,
+                                                smtp_server, quit=False)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # The connection was closed while idle. Reconnect and try again.
+            _connections.smtp = None
+            if attempt > 0:
+                raise
+
+
 def dump_to_exception_file(string):
     # Debug only. Disabling.
     return
@@ -473,9 +593,9 @@ def forward_to_administrator(email_type, email_string):
         raw = _dkim_sign_email(raw)
 
         # Throws exception on error
-        if not sendmail.send_raw_email_smtp(raw,
-                                            settings.RESPONSE_FROM_ADDR,
-                                            settings.ADMIN_FORWARD_ADDRESSES):
+        if not _send_raw_email_smtp(raw,
+                                    settings.RESPONSE_FROM_ADDR,
+                                    settings.ADMIN_FORWARD_ADDRESSES):
             print('send_raw_email_smtp failed')
             return False
 
@@ -500,26 +620,18 @@ def process_input(email_string):
     return responder.requested_addr
 
 
-if __name__ == '__main__':
+def handle_email(email_string):
     '''
-    Note that we *must always* exit with 0. If we don't, the email we're
-    processing will be put back into the Postfix deferred queue and will get
-    processed again later. This will either end up in an infinite backlog of
-    email, or in responses to the same request being sent over and over.
+    Processes the email, sends the response, and logs the outcome and metrics.
+    Never raises: errors are logged.
     '''
 
     try:
         starttime = time.time()
 
-        email_string = sys.stdin.read()
-
-        if not email_string:
-            logger.critical('error: no stdin')
-            sys.exit(0)
-
         requested_addr = process_input(email_string)
         if not requested_addr:
-            sys.exit(0)
+            return
 
     except UnicodeDecodeError as ex:
         # Bad input. Just log and exit.
@@ -560,5 +672,31 @@ if __name__ == '__main__':
             if settings.EXCEPTION_DIR:
                 dump_to_exception_file('Exception caught: %s\n%s' % (ex,
                                                                      traceback.format_exc()))
+
+
+if __name__ == '__main__':
+    '''
+    Run by Postfix, through the .forward pipe, for each email. (Normally
+    emails are delivered to the spool processed by the mail_process service;
+    see service_mail_process.py.)
+
+    Note that we *must always* exit with 0. If we don't, the email we're
+    processing will be put back into the Postfix deferred queue and will get
+    processed again later. This will either end up in an infinite backlog of
+    email, or in responses to the same request being sent over and over.
+    '''
+
+    try:
+        email_string = sys.stdin.read()
+
+        if not email_string:
+            logger.critical('error: no stdin')
+            sys.exit(0)
+
+        handle_email(email_string)
+
+    except Exception as ex:
+        logger.critical('exception: %s: %s', ex, traceback.format_exc())
+
     finally:
         sys.exit(0)
@@ -33,6 +33,8 @@ import textwrap
 import datetime
 import collections
 import httplib
+import sqlite3
+import argparse
 from boto.ses.connection import SESConnection
 from boto.ec2.cloudwatch import CloudWatchConnection
 
@@ -154,129 +156,249 @@ def get_send_info():
                       })
 
 
-def process_log_file(logfile):
+# One regex for all of the log entries we count. The value captured for each
+# type is in the group named for it.
+LOG_LINE_REGEX = re.compile(r'^(?P<timestamp>[^ ]+) .* (?:'
+                            r'mail_process\.py.*: (?:'
+                                r'success: (?P<success>.*):|'
+                                r'fail: (?P<fail>.*)|'
+                                r'exception: (?P<exception>.*)|'
+                                r'error: (?P<error>.*))|'
+                            r'log_processor\.py.*: bad_address: (?P<bad_address>.*))')
+LOG_TYPES = ('success', 'fail', 'exception', 'error', 'bad_address')
+
+# Hours are kept this long
+LOG_STATS_RETENTION_DAYS = 14
+
+# At most this many unmatched lines are kept per hour, and shown in a report
+UNMATCHED_LINES_SAMPLE_SIZE = 20
+UNMATCHED_LINES_REPORT_SIZE = 100
+
+# For detecting a log file that has replaced one (with the same inode) that we
+# had read from
+LOG_FILE_FINGERPRINT_SIZE = 256
+
+
+def _get_hour(timestamp):
+    # Hours are compared as strings, like '2014-04-15T17'. Logs should have
+    # high-precision (ISO 8601) timestamps in UTC; otherwise the current hour
+    # is used.
+    if re.match(r'^\d{4}-\d\d-\d\dT\d\d', timestamp):
+        return timestamp[:13]
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H')
+
+
+class LogStats(object):
     '''
-    Takes a file-like object, processes it, extracts info about activity, and
-    returns a human-readable text summary of its contents.
+    Hourly counts of the responder log entries, kept in a SQLite DB. Each
+    update only reads the log lines added since the previous one, so reports
+    come from the counts instead of the whole log.
     '''
 
-    logtypes = {
-                'success': {
-                            'regex': re.compile('^([^ ]+) .* mail_process\.py.*: success: (.*):'),
-                            'results': {}
-                            },
-                'fail': {
-                            'regex': re.compile('^([^ ]+) .* mail_process\.py.*: fail: (.*)'),
-                            'results': {}
-                            },
-                'exception': {
-                              'regex': re.compile('^([^ ]+) .* mail_process\.py.*: exception: (.*)'),
-                              'results': {}
-                              },
-                'error': {
-                          'regex': re.compile('^([^ ]+) .* mail_process\.py.*: error: (.*)'),
-                          'results': {}
-                          },
-                'bad_address': {
-                          'regex': re.compile('^([^ ]+) .* log_processor\.py.*: bad_address: (.*)'),
-                          'results': {}
-                          },
-                }
-
-    unmatched_lines = []
-
-    start_timestamp = None
-    end_timestamp = None
+    def __init__(self, db_filename):
+        self._db = sqlite3.connect(db_filename)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS log_counts '
+                             '(hour TEXT, logtype TEXT, value TEXT, count INTEGER, '
+                             'PRIMARY KEY (hour, logtype, value))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS log_hours '
+                             '(hour TEXT PRIMARY KEY, start TEXT, end TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS unmatched_lines '
+                             '(hour TEXT, line TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS log_files '
+                             '(inode INTEGER PRIMARY KEY, fingerprint BLOB, offset INTEGER)')
+
+    def update(self, log_filenames):
+        '''
+        Reads the lines added to the log files since the last update. The files
+        must be given oldest first. Rotated files keep their inode, so how far
+        a file has been read follows it through rotation.
+        '''
+
+        # (hour, logtype, value) -> count; 'unmatched' is also counted
+        counts = collections.Counter()
+        # hour -> [first timestamp, last timestamp]
+        hours = collections.OrderedDict()
+        # hour -> [line, ...]
+        unmatched_lines = collections.defaultdict(list)
+
+        log_files = dict((saved_inode, (str(saved_fingerprint), saved_offset))
+                         for saved_inode, saved_fingerprint, saved_offset
+                         in self._db.execute('SELECT inode, fingerprint, offset FROM log_files'))
+        new_log_files = {}
+
+        for log_filename in log_filenames:
+            try:
+                logfile = open(log_filename, 'rb')
+            except IOError:
+                continue
 
-    while True:
-        line = logfile.readline()
-        if not line:
-            break
-        line = line.strip()
+            with logfile:
+                inode = os.fstat(logfile.fileno()).st_ino
+                fingerprint = logfile.read(LOG_FILE_FINGERPRINT_SIZE)
+
+                offset = 0
+                if inode in log_files:
+                    last_fingerprint, last_offset = log_files[inode]
+                    # The fingerprint may have been taken when the file was
+                    # shorter than it is now
+                    if fingerprint.startswith(last_fingerprint):
+                        offset = last_offset
+
+                logfile.seek(offset)
+                for line in logfile:
+                    # A partial line will be read next time
+                    if not line.endswith('\n'):
+                        break
+                    offset += len(line)
+                    self._count_line(line.strip(), counts, hours, unmatched_lines)
+
+                new_log_files[inode] = (fingerprint, offset)
+
+        with self._db:
+            for (hour, logtype, value), count in counts.iteritems():
+                if not self._db.execute('UPDATE log_counts SET count = count + ? '
+                                        'WHERE hour = ? AND logtype = ? AND value = ?',
+                                        (count, hour, logtype, value)).rowcount:
+                    self._db.execute('INSERT INTO log_counts VALUES (?, ?, ?, ?)',
+                                     (hour, logtype, value, count))
+
+            for hour, (start, end) in hours.iteritems():
+                if not self._db.execute('UPDATE log_hours SET end = ? WHERE hour = ?',
+                                        (end, hour)).rowcount:
+                    self._db.execute('INSERT INTO log_hours VALUES (?, ?, ?)',
+                                     (hour, start, end))
+
+            for hour, lines in unmatched_lines.iteritems():
+                sample_count = self._db.execute('SELECT COUNT(*) FROM unmatched_lines WHERE hour = ?',
+                                                (hour,)).fetchone()[0]
+                self._db.executemany('INSERT INTO unmatched_lines VALUES (?, ?)',
+                                     [(hour, line) for line in lines[:max(0, UNMATCHED_LINES_SAMPLE_SIZE - sample_count)]])
+
+            # Only the files that still exist need to be remembered
+            self._db.execute('DELETE FROM log_files')
+            self._db.executemany('INSERT INTO log_files VALUES (?, ?, ?)',
+                                 [(file_inode, sqlite3.Binary(file_fingerprint), file_offset)
+                                  for file_inode, (file_fingerprint, file_offset) in new_log_files.iteritems()])
+
+            oldest_hour = (datetime.datetime.utcnow() - datetime.timedelta(LOG_STATS_RETENTION_DAYS)).strftime('%Y-%m-%dT%H')
+            for table in ('log_counts', 'log_hours', 'unmatched_lines'):
+                self._db.execute('DELETE FROM %s WHERE hour < ?' % table, (oldest_hour,))
+
+    @staticmethod
+    def _count_line(line, counts, hours, unmatched_lines):
+        res = LOG_LINE_REGEX.search(line)
+        if not res:
+            hour = _get_hour(line.split(' ', 1)[0])
+            counts[(hour, 'unmatched', '')] += 1
+            if len(unmatched_lines[hour]) < UNMATCHED_LINES_SAMPLE_SIZE:
+                unmatched_lines[hour].append(line)
+            return
 
-        match = False
-        for logtype in logtypes.values():
-            res = logtype['regex'].search(line)
-            if not res:
-                continue
+        for logtype in LOG_TYPES:
+            value = res.group(logtype)
+            if value is not None:
+                break
 
-            timestamp = res.groups()[0]
-            val = res.groups()[1]
-            logtype['results'][val] = logtype['results'].get(val, 0) + 1
+        timestamp = res.group('timestamp')
+        hour = _get_hour(timestamp)
+        counts[(hour, logtype, value)] += 1
 
-            # Record the timestamp of the first and last logs.
-            # Assume we're processing logs in increasing chronological order.
-            if not start_timestamp:
-                start_timestamp = timestamp
-            end_timestamp = timestamp
+        # Record the timestamp of the first and last logs.
+        # Assume we're processing logs in increasing chronological order.
+        if hour not in hours:
+            hours[hour] = [timestamp, timestamp]
+        hours[hour][1] = timestamp
 
-            match = True
-            break
+    def report(self, hours):
+        '''
+        Returns a human-readable text summary of the log entries of the last
+        `hours` hours (including the current one).
+        '''
 
-        if not match:
-            unmatched_lines.append(line)
+        # The current hour is one of the `hours` buckets
+        since_hour = (datetime.datetime.utcnow() - datetime.timedelta(hours=hours - 1)).strftime('%Y-%m-%dT%H')
 
-    text = ''
+        logtypes = dict((logtype, {}) for logtype in LOG_TYPES)
+        unmatched_count = 0
+        for logtype, value, count in self._db.execute('SELECT logtype, value, SUM(count) FROM log_counts '
+                                                      'WHERE hour >= ? GROUP BY logtype, value',
+                                                      (since_hour,)):
+            if logtype == 'unmatched':
+                unmatched_count += count
+            else:
+                logtypes[logtype][value] = count
 
-    # Success logs
+        unmatched_lines = [line for (line,) in self._db.execute('SELECT line FROM unmatched_lines WHERE hour >= ? '
+                                                                'ORDER BY hour, rowid LIMIT ?',
+                                                                (since_hour, UNMATCHED_LINES_REPORT_SIZE))]
 
-    results = logtypes['success']['results']
+        start_timestamp, end_timestamp = self._db.execute('SELECT MIN(start), MAX(end) FROM log_hours WHERE hour >= ?',
+                                                          (since_hour,)).fetchone()
 
-    text += 'Successfully sent\n----------------------\n'
+        text = ''
 
-    text += 'TOTAL: %d\n' % sum(results.values())
+        # Success logs
 
-    for item in filter(lambda (k,v): v >= 1,
-                       sorted(results.iteritems(),
-                              key=lambda (k,v): (v,k),
-                              reverse=True)):
-        text += '%s %s\n' % (str(item[1]).rjust(4), item[0])
+        results = logtypes['success']
 
-    # Fail logs
+        text += 'Successfully sent\n----------------------\n'
 
-    results = logtypes['fail']['results']
+        text += 'TOTAL: %d\n' % sum(results.values())
 
-    text += '\n\nFailures\n----------------------\n\n'
+        for item in filter(lambda (k,v): v >= 1,
+                           sorted(results.iteritems(),
+                                  key=lambda (k,v): (v,k),
+                                  reverse=True)):
+            text += '%s %s\n' % (str(item[1]).rjust(4), item[0])
 
-    text += 'TOTAL: %d\n' % sum(results.values())
+        # Fail logs
 
-    # Only itemize the entries with a reasonably large count
-    for item in filter(lambda (k,v): v >= 10,
-                       sorted(results.iteritems(),
-                              key=lambda (k,v): (v,k),
-                              reverse=True)):
-        text += '%s %s\n' % (str(item[1]).rjust(4), item[0])
+        results = logtypes['fail']
 
-    # Bad addresses
+        text += '\n\nFailures\n----------------------\n\n'
 
-    results = logtypes['bad_address']['results']
+        text += 'TOTAL: %d\n' % sum(results.values())
 
-    text += '\n\nBad Addresses\n----------------------\n\n'
+        # Only itemize the entries with a reasonably large count
+        for item in filter(lambda (k,v): v >= 10,
+                           sorted(results.iteritems(),
+                                  key=lambda (k,v): (v,k),
+                                  reverse=True)):
+            text += '%s %s\n' % (str(item[1]).rjust(4), item[0])
 
-    text += 'TOTAL: %d\n' % sum(results.values())
+        # Bad addresses
 
-    # Only itemize the entries with a reasonably large count
-    for item in filter(lambda (k,v): v >= 10,
-                       sorted(results.iteritems(),
-                              key=lambda (k,v): (v,k),
-                              reverse=True)):
-        text += '%s %s\n' % (str(item[1]).rjust(4), item[0])
+        results = logtypes['bad_address']
 
-    # Process the rest of the log types
+        text += '\n\nBad Addresses\n----------------------\n\n'
 
-    for logtype_name in ('exception', 'error'):
-        text += '\n%s\n----------------------\n\n' % logtype_name
-        for info, count in logtypes[logtype_name]['results'].iteritems():
-            text += '%s\nCOUNT: %d\n\n' % (info, count)
+        text += 'TOTAL: %d\n' % sum(results.values())
 
-    text += '\n\nunmatched lines\n---------------------------\n'
-    text += '\n'.join(unmatched_lines)
+        # Only itemize the entries with a reasonably large count
+        for item in filter(lambda (k,v): v >= 10,
+                           sorted(results.iteritems(),
+                                  key=lambda (k,v): (v,k),
+                                  reverse=True)):
+            text += '%s %s\n' % (str(item[1]).rjust(4), item[0])
 
-    text += '\n\nStart: %s\n' % start_timestamp
-    text += '  End: %s\n' % end_timestamp
-    text += ' Sent: %s+00:00\n' % datetime.datetime.utcnow().isoformat()
+        # Process the rest of the log types
 
-    return text
+        for logtype_name in ('exception', 'error'):
+            text += '\n%s\n----------------------\n\n' % logtype_name
+            for info, count in logtypes[logtype_name].iteritems():
+                text += '%s\nCOUNT: %d\n\n' % (info, count)
+
+        text += '\n\nunmatched lines\n---------------------------\n'
+        text += '\n'.join(unmatched_lines)
+        if unmatched_count > len(unmatched_lines):
+            text += '\n(%d unmatched lines in total)' % unmatched_count
+
+        text += '\n\nStart: %s\n' % start_timestamp
+        text += '  End: %s\n' % end_timestamp
+        text += ' Sent: %s+00:00\n' % datetime.datetime.utcnow().isoformat()
+
+        return text
 
 
 def get_exception_info():
@@ -359,17 +481,28 @@ def get_cloudwatch_top_metrics():
 
 if __name__ == '__main__':
 
-    cloudwatch_info = get_cloudwatch_top_metrics()
+    parser = argparse.ArgumentParser(description='Email mail responder stats')
+    parser.add_argument('--update', action='store_true',
+                        help='only read new log entries into the stats DB (can be run from cron, to keep up)')
+    parser.add_argument('--print-hours', type=int, metavar='HOURS',
+                        help='print the log stats for the last HOURS hours instead of emailing all the stats')
+    args = parser.parse_args()
 
-    # We want to process the most recently rotated file (so that we're processing
-    # a whole day of results, and not a partial day).
-    loginfo = ''
-    try:
-        logfile = open('%s.1' % settings.LOG_FILENAME, 'r')
-        loginfo = process_log_file(logfile)
-        logfile.close()
-    except:
-        pass
+    # Read whatever hasn't been read yet of the most recently rotated file
+    # and the current one.
+    log_stats = LogStats(settings.STATS_DB_FILENAME)
+    log_stats.update(['%s.1' % settings.LOG_FILENAME, settings.LOG_FILENAME])
+
+    if args.update:
+        sys.exit(0)
+
+    if args.print_hours:
+        print(log_stats.report(args.print_hours))
+        sys.exit(0)
+
+    loginfo = log_stats.report(24)
+
+    cloudwatch_info = get_cloudwatch_top_metrics()
 
     queue_check = subprocess.Popen(shlex.split('sudo perl %s' % os.path.expanduser('~%s/postfix_queue_check.pl' % settings.MAIL_RESPONDER_USERNAME)), stdout=subprocess.PIPE).communicate()[0]
     logwatch_basic = subprocess.Popen(shlex.split('logwatch --output stdout --format text'), stdout=subprocess.PIPE).communicate()[0]
@@ -19,6 +19,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email.header import Header
+from email.message import Message
 from email import Charset
 from email.generator import Generator
 from email import encoders
@@ -43,6 +44,23 @@ def create_raw_email(recipients,
     extra_headers should be a dictionary of header-name:header-string values.
     '''
 
+    return create_raw_email_from_template(create_raw_email_template(body, attachments),
+                                          recipients,
+                                          from_address,
+                                          subject,
+                                          extra_headers)
+
+
+def create_raw_email_template(body, attachments=None):
+    '''
+    Creates the encoded body and attachments of a raw email, which don't depend
+    on the recipient or headers. Use create_raw_email_from_template to create
+    emails from it; encoding the attachments is most of the work of
+    create_raw_email, so a template can be reused for many emails.
+    body and attachments are as for create_raw_email.
+    Returns a tuple of (MIME headers, encoded body) strings.
+    '''
+
     # For email with attachments, the MIME structure will be as follows:
     #    multipart/mixed
     #        multipart/alternative
@@ -61,15 +79,60 @@ def create_raw_email(recipients,
     if body is None:
         body = []
 
-    # Override python's weird assumption that utf-8 text should be encoded with
-    # base64, and instead use quoted-printable (for both subject and body).  I
-    # can't figure out a way to specify QP (quoted-printable) instead of base64 in
-    # a way that doesn't modify global state. :-(
-    Charset.add_charset('utf-8', Charset.QP, Charset.QP, 'utf-8')
+    _set_utf8_charset()
 
     # The root MIME section.
     msgRoot = MIMEMultipart('mixed')
 
+    # The MIME section that contains the plaintext and HTML alternatives.
+    msgAlternative = MIMEMultipart('alternative')
+    msgRoot.attach(msgAlternative)
+
+    # Attach the body alternatives with the given encodings.
+    for mimetype, content in body:
+        msgpart = MIMEText(content.encode('utf-8'), mimetype, 'UTF-8')
+        msgAlternative.attach(msgpart)
+
+    # Attach the attachments
+    if attachments:
+        for attachment in attachments:
+            fp, filename = attachment
+
+            msgAttachment = MIMEBase('application', 'octet-stream')
+
+            msgAttachment.add_header('Content-Disposition', 'attachment', filename=filename)
+
+            msgAttachment.set_payload(fp.read())
+            fp.close()
+
+            encoders.encode_base64(msgAttachment)
+
+            msgRoot.attach(msgAttachment)
+
+    # The root section's headers (Content-Type, with the multipart boundary,
+    # and MIME-Version) are followed by a blank line and then the body.
+    mime_headers, encoded_body = _flatten(msgRoot).split('\n\n', 1)
+
+    return (mime_headers + '\n', encoded_body)
+
+
+def create_raw_email_from_template(template,
+                                   recipients,
+                                   from_address,
+                                   subject,
+                                   extra_headers=None):
+    '''
+    Creates a raw email from a template made by create_raw_email_template.
+    The result is the same as create_raw_email with the template's body and
+    attachments. Only the headers are encoded here.
+    recipients, from_address, subject and extra_headers are as for
+    create_raw_email.
+    '''
+
+    mime_headers, encoded_body = template
+
+    _set_utf8_charset()
+
     # We need to use Header objects here instead of just assigning the strings in
     # order to get our headers properly encoded (with QP).
     # You may want to avoid this if your headers are already ASCII, just so people
@@ -85,10 +148,14 @@ def create_raw_email(recipients,
     if type(recipients) == list:
         recipients = ', '.join(recipients)
 
-    msgRoot['To'] = Header(recipients.encode('utf-8'), 'ascii').encode()
-    msgRoot['From'] = Header(from_address.encode('utf-8'), 'ascii').encode()
+    # A message with only headers. Flattening it formats them just like they
+    # would be in the root section, followed by the blank line.
+    msgHeaders = Message()
+
+    msgHeaders['To'] = Header(recipients.encode('utf-8'), 'ascii').encode()
+    msgHeaders['From'] = Header(from_address.encode('utf-8'), 'ascii').encode()
 
-    msgRoot['Subject'] = Header(subject.encode('utf-8'), 'UTF-8').encode()
+    msgHeaders['Subject'] = Header(subject.encode('utf-8'), 'UTF-8').encode()
 
     if extra_headers:
         for header_name, header_value in extra_headers.iteritems():
@@ -97,40 +164,27 @@ def create_raw_email(recipients,
             encoding = 'UTF-8'
             if header_name.lower() == 'reply-to':
                 encoding = 'ascii'
-            msgRoot[header_name] = Header(header_value.encode('utf-8'), encoding).encode()
+            msgHeaders[header_name] = Header(header_value.encode('utf-8'), encoding).encode()
 
-    # The MIME section that contains the plaintext and HTML alternatives.
-    msgAlternative = MIMEMultipart('alternative')
-    msgRoot.attach(msgAlternative)
+    return mime_headers + _flatten(msgHeaders) + encoded_body
 
-    # Attach the body alternatives with the given encodings.
-    for mimetype, content in body:
-        msgpart = MIMEText(content.encode('utf-8'), mimetype, 'UTF-8')
-        msgAlternative.attach(msgpart)
 
-    # Attach the attachments
-    if attachments:
-        for attachment in attachments:
-            fp, filename = attachment
-
-            msgAttachment = MIMEBase('application', 'octet-stream')
-
-            msgAttachment.add_header('Content-Disposition', 'attachment', filename=filename)
-
-            msgAttachment.set_payload(fp.read())
-            fp.close()
-
-            encoders.encode_base64(msgAttachment)
+def _set_utf8_charset():
+    # Override python's weird assumption that utf-8 text should be encoded with
+    # base64, and instead use quoted-printable (for both subject and body).  I
+    # can't figure out a way to specify QP (quoted-printable) instead of base64 in
+    # a way that doesn't modify global state. :-(
+    Charset.add_charset('utf-8', Charset.QP, Charset.QP, 'utf-8')
 
-            msgRoot.attach(msgAttachment)
 
+def _flatten(msg):
     # And here we have to instantiate a Generator object to convert the multipart
     # object to a string (can't use multipart.as_string, because that escapes
     # "From" lines).
 
     io = StringIO()
     g = Generator(io, False)  # second argument means "should I mangle From?"
-    g.flatten(msgRoot)
+    g.flatten(msg)
 
     return io.getvalue()
 
@@ -138,11 +192,13 @@ def create_raw_email(recipients,
 def send_raw_email_smtp(raw_email,
                         from_address,
                         recipients,
-                        smtp_server=None):
+                        smtp_server=None,
+                        quit=True):
     '''
     Sends the raw email via the specified SMTP server.
     `smtp_server` should be None, or a logged-in instance of smtplib.SMTP or smtplib.SMTP_SSL.
-    `smtp_server.quit()` is called when done.
+    `smtp_server.quit()` is called when done, unless `quit` is False (so the
+    caller can reuse `smtp_server`).
     `recipients` may be an array of address or a single address string.
     Returns True on success, False otherwise.
     '''
@@ -157,7 +213,8 @@ def send_raw_email_smtp(raw_email,
             return False
 
     smtp_server.sendmail(from_address, recipients, raw_email)
-    smtp_server.quit()
+    if quit:
+        smtp_server.quit()
 
     return True
 
@@ -166,15 +223,18 @@ def send_raw_email_amazonses(raw_email,
                              from_address,
                              recipient=None,
                              aws_key=None,
-                             aws_secret_key=None):
+                             aws_secret_key=None,
+                             conn=None):
     '''
     Send the raw email via Amazon SES.
     If the credential arguments are None, boto will attempt to retrieve the
     values from environment variables and config files.
     recipient seems to be redudant with the values in the raw email headers.
+    `conn` may be an existing SESConnection to reuse.
     '''
 
-    conn = SESConnection(aws_key, aws_secret_key)
+    if conn is None:
+        conn = SESConnection(aws_key, aws_secret_key)
 
     if isinstance(recipient, str) or isinstance(recipient, unicode):
         recipient = [recipient]
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016, Psiphon Inc.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Long-running mail responder service.
+
+Postfix delivers requests to a Maildir spool (the `.forward` installed from
+`forward_spool`) instead of piping each one to a new `mail_process.py`
+process. This service picks the emails up and processes them with a pool of
+worker threads. The config, DKIM key, database connection pool and SES/SMTP
+connections stay loaded between emails, and a thread checks S3 for new
+attachments in the background.
+
+An email is claimed by moving it from `new/` to `cur/`, and is deleted once it
+has been processed (successfully or not, as with the pipe). Emails left in
+`cur/` by a crash are processed on the next start.
+
+Run by Upstart; see mail_process.conf.
+'''
+
+import os
+import signal
+import sys
+import time
+import threading
+import traceback
+import Queue
+
+from logger import logger, set_ident
+import settings
+import mail_process
+import aws_helpers
+
+
+# Log like mail_process.py run by the pipe, for rsyslog filtering and mail_stats
+set_ident('mail_process.py')
+
+
+_stop = threading.Event()
+
+
+def _do_exit(signum, frame):
+    logger.info('Shutting down')
+    _stop.set()
+
+
+def _worker(queue):
+    while True:
+        path = queue.get()
+        try:
+            with open(path) as f:
+                email_string = f.read()
+
+            if not email_string:
+                logger.critical('error: empty email: %s', path)
+            else:
+                mail_process.handle_email(email_string)
+        except Exception as ex:
+            logger.critical('exception: %s: %s', ex, traceback.format_exc())
+        finally:
+            try:
+                os.remove(path)
+            except OSError as ex:
+                logger.critical('error: failed to remove %s: %s', path, ex)
+            queue.task_done()
+
+
+def _refresh_attachments():
+    # Keeps the attachment cache up to date, so responses don't wait on S3
+    while not _stop.wait(settings.ATTACHMENT_CACHE_REFRESH_INTERVAL_SECONDS):
+        try:
+            errors = aws_helpers.refresh_s3_cached_files()
+        except Exception as ex:
+            errors = [('', ex)]
+        for bucket_filename, ex in errors:
+            logger.critical('error: attachment refresh failed: %s: %s', bucket_filename, ex)
+
+
+def _put(queue, path):
+    # Blocks while all workers are busy, but still notices shutdown
+    while not _stop.is_set():
+        try:
+            queue.put(path, timeout=1)
+            return True
+        except Queue.Full:
+            continue
+    return False
+
+
+def main():
+    logger.info('Starting up')
+
+    signal.signal(signal.SIGTERM, _do_exit)
+    signal.signal(signal.SIGINT, _do_exit)
+
+    new_dir = os.path.join(settings.MAIL_SPOOL_DIR, 'new')
+    cur_dir = os.path.join(settings.MAIL_SPOOL_DIR, 'cur')
+    for subdir in ('tmp', 'new', 'cur'):
+        path = os.path.join(settings.MAIL_SPOOL_DIR, subdir)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    # At most one queued email per worker: the rest wait in the spool, where
+    # they survive a restart
+    queue = Queue.Queue(settings.MAIL_PROCESS_WORKER_COUNT)
+    for _ in range(settings.MAIL_PROCESS_WORKER_COUNT):
+        worker = threading.Thread(target=_worker, args=(queue,))
+        worker.daemon = True
+        worker.start()
+
+    refresher = threading.Thread(target=_refresh_attachments)
+    refresher.daemon = True
+    refresher.start()
+
+    # Emails claimed before a crash or restart haven't been processed
+    for filename in sorted(os.listdir(cur_dir)):
+        if not _put(queue, os.path.join(cur_dir, filename)):
+            break
+
+    while not _stop.is_set():
+        claimed = False
+        # Maildir file names start with the delivery time, so this is
+        # roughly oldest first
+        for filename in sorted(os.listdir(new_dir)):
+            if _stop.is_set():
+                break
+            path = os.path.join(cur_dir, filename)
+            try:
+                os.rename(os.path.join(new_dir, filename), path)
+            except OSError:
+                # Claimed by another instance
+                continue
+            claimed = True
+            if not _put(queue, path):
+                break
+        if not claimed:
+            time.sleep(settings.MAIL_SPOOL_POLL_INTERVAL_SECONDS)
+
+    # Finish the emails already claimed
+    queue.join()
+    logger.info('Stopped')
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -55,6 +55,10 @@ CONFIG_S3_KEY = 'EmailResponder/conf.json'
 # The directory where attachment files are cached.
 ATTACHMENT_CACHE_DIR = os.path.expanduser('~%s/attach_cache' % MAIL_RESPONDER_USERNAME)
 
+# How long a cached attachment is used before checking S3 for a new version.
+# The mail_process service checks in the background at this interval.
+ATTACHMENT_CACHE_REFRESH_INTERVAL_SECONDS = 60
+
 # We're going to use a fixed address to reply to all email from.
 # If this becomes a problem in the future, it can be changed.
 RESPONSE_FROM_ADDR = 'Example Responder <noreply@example.com>'
@@ -74,6 +78,16 @@ ADMIN_FORWARD_SUBJECT_TAG = '[MailResponder]'
 # This must match the local send service specified in /etc/postfix/master.cf
 LOCAL_SMTP_SEND_PORT = 2525
 
+# Postfix delivers requests to this Maildir spool (see forward_spool), where
+# the mail_process service picks them up.
+MAIL_SPOOL_DIR = os.path.expanduser('~%s/spool' % MAIL_RESPONDER_USERNAME)
+
+# The number of emails the mail_process service processes at once
+MAIL_PROCESS_WORKER_COUNT = 8
+
+# How often the mail_process service checks the spool for new email
+MAIL_SPOOL_POLL_INTERVAL_SECONDS = 0.2
+
 
 #
 # Blacklist stuff
@@ -81,6 +95,10 @@ LOCAL_SMTP_SEND_PORT = 2525
 
 BLACKLIST_DAILY_LIMIT = 2
 
+# How often processes reload the perma-blacklist and -whitelist from the DB
+# (so changes made with blacklist.py take up to this long to be applied)
+BLACKLIST_LISTS_REFRESH_INTERVAL_SECONDS = 300
+
 # Email addresses from domains in this list will never be blacklisted.
 # Leave empty if functionality is not desired.
 BLACKLIST_EXEMPTION_DOMAINS = ['example.com']
@@ -106,6 +124,10 @@ STATS_SENDER_ADDRESS = 'Example Responder <%s>' % STATS_SENDER_ADDRESS_BARE
 # The location of our log file
 LOG_FILENAME = '/var/log/mail_responder.log'
 
+# Where mail_stats.py keeps hourly counts of the log entries, and how far it
+# has read the log files
+STATS_DB_FILENAME = os.path.expanduser('~%s/mail_stats.db' % MAIL_RESPONDER_USERNAME)
+
 # TODO: Use aws_helpers._get_autoscaling_group() instead of this hardcoded value
 CLOUDWATCH_DIMENSIONS = { 'AutoScalingGroupName': 'mailresponder-autoscaling-group-1' }
 CLOUDWATCH_NAMESPACE = 'Psiphon/MailResponder'
@@ -24,12 +24,12 @@ import pam
 import GeoIP
 import syslog
 import traceback
-import redis
 import json
 import socket
 import urllib
 import urllib2
 import psi_config
+import psi_session_db
 
 sys.path.insert(0, os.path.abspath(os.path.join('..', 'Automation')))
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Automation')))
@@ -120,14 +120,7 @@ def set_session_region(pam_rhost, session_id):
         # of loading psi_geoip
         geoip = {'region': 'None', 'city': 'None', 'isp': 'None'}
 
-    redis_session = redis.StrictRedis(
-            host=psi_config.SESSION_DB_HOST,
-            port=psi_config.SESSION_DB_PORT,
-            db=psi_config.SESSION_DB_INDEX)
-
-    if redis_session.get(session_id) == None:
-        redis_session.set(session_id, json.dumps(geoip))
-        redis_session.expire(session_id, psi_config.SESSION_EXPIRE_SECONDS)
+    psi_session_db.SessionStore(cache_size=0).set_if_absent(session_id, json.dumps(geoip))
 
     # Now fill in the discovery database
     # NOTE: We are storing a value derived from the user's IP address
@@ -137,14 +130,7 @@ def set_session_region(pam_rhost, session_id):
     # this data, and it will also be discarded immediately after use
     try:
         client_ip_address_strategy_value = psi_ops_discovery.calculate_ip_address_strategy_value(pam_rhost)
-        redis_discovery = redis.StrictRedis(
-                host=psi_config.DISCOVERY_DB_HOST,
-                port=psi_config.DISCOVERY_DB_PORT,
-                db=psi_config.DISCOVERY_DB_INDEX)
-
-        if redis_discovery.get(session_id) == None:
-            redis_discovery.set(session_id, json.dumps({'client_ip_address_strategy_value' : client_ip_address_strategy_value}))
-            redis_discovery.expire(session_id, psi_config.DISCOVERY_EXPIRE_SECONDS)
+        psi_session_db.DiscoveryStore().set_strategy_value_if_absent(session_id, client_ip_address_strategy_value)
     except socket.error:
         pass
 
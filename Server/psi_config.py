@@ -38,6 +38,10 @@ ROUTES_PATH = '/opt/PsiphonV/routes'
 ROUTE_FILE_NAME_TEMPLATE = '%s.route.zlib'
 DATA_FILE_NAME = posixpath.join(HOST_SOURCE_ROOT, 'Automation', 'psi_ops.dat')
 GEOIP_SERVICE_PORT = 6000
+# Number of pre-fork web server processes sharing each server address with
+# SO_REUSEPORT (Linux 3.9+). 1 runs all web servers in a single process;
+# 0 runs one process per CPU.
+WEB_SERVER_PROCESSES = 1
 
 
 #==== VPN =====================================================================
@@ -69,6 +73,9 @@ SESSION_DB_INDEX = 0
 SESSION_EXPIRE_SECONDS = 60 * 60 # Discard session_ids older than 60 minutes
 SESSION_ID_BYTE_LENGTH = 16
 SESSION_ID_CHARACTERS = string.hexdigits
+# In-process cache of session records in the web server; 0 disables
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL_SECONDS = 10
 
 
 #==== Discovery Database ======================================================
@@ -79,6 +86,13 @@ DISCOVERY_DB_INDEX = 1
 DISCOVERY_EXPIRE_SECONDS = 60 * 5 # Discard discovery records older than 5 minutes
 
 
+#==== Database Connections ====================================================
+
+# Connection pool limits, per database, shared by all web server threads
+DB_MAX_CONNECTIONS = 64
+DB_CONNECTION_TIMEOUT_SECONDS = 5
+
+
 #==== Preemptive Reconnect ====================================================
 
 PREEMPTIVE_RECONNECT_LIFETIME_MILLISECONDS = 60000
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, Psiphon Inc.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+Host health probe, run over SSH by Automation/load.py.
+
+Prints one JSON document with the host's users, load, memory, swap and disk
+usage, and a count of running processes for each process name given on the
+command line:
+
+  psi_host_probe.py [process name ...]
+
+Everything is read from /proc and statvfs, so the probe doesn't run any
+other programs. It must only use the standard library: it's deployed to both
+legacy and TCS hosts (see psi_ops_deploy.deploy_host_probe).
+'''
+
+import os
+import sys
+import json
+
+
+# Process names in /proc/<pid>/comm (and matched by pgrep -x) are truncated
+COMM_MAX_LENGTH = 15
+
+
+def read_file(path):
+    with open(path) as file:
+        return file.read()
+
+
+def get_load():
+    # Load averages over 1, 5 and 15 minutes
+    return [float(value) for value in read_file('/proc/loadavg').split()[:3]]
+
+
+def get_cpu_count():
+    return len([line for line in read_file('/proc/cpuinfo').split('\n')
+                if line.startswith('processor')])
+
+
+def get_meminfo():
+    # Values in kB
+    meminfo = {}
+    for line in read_file('/proc/meminfo').split('\n'):
+        fields = line.split()
+        if len(fields) >= 2:
+            meminfo[fields[0].rstrip(':')] = int(fields[1])
+    return meminfo
+
+
+def get_disk_usage(path):
+    stat = os.statvfs(path)
+    size = stat.f_blocks * stat.f_frsize
+    used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+    return size, used
+
+
+def get_processes():
+    # [(process name, command line)] for each process
+    processes = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            comm = read_file('/proc/%s/comm' % (pid,)).rstrip('\n')
+            cmdline = read_file('/proc/%s/cmdline' % (pid,)).replace('\0', ' ')
+        except IOError:
+            # Exited
+            continue
+        processes.append((comm, cmdline))
+    return processes
+
+
+def get_vpn_user_count():
+    # One ppp interface per VPN user
+    return len([line for line in read_file('/proc/net/dev').split('\n')[2:]
+                if line.strip().startswith('ppp')])
+
+
+def get_ssh_user_count(processes):
+    # Each SSH user has a privileged and an unprivileged sshd process
+    return len([cmdline for (_, cmdline) in processes
+                if 'ssh' in cmdline and 'psiphon' in cmdline]) // 2
+
+
+def percent(part, whole):
+    if whole == 0:
+        return 0.0
+    return 100.0 * part / whole
+
+
+def probe(process_names):
+    processes = get_processes()
+    meminfo = get_meminfo()
+    disk_size, disk_used = get_disk_usage('/')
+
+    process_counts = dict((name, 0) for name in process_names)
+    for (comm, _) in processes:
+        for name in process_names:
+            if comm == name[:COMM_MAX_LENGTH]:
+                process_counts[name] += 1
+
+    return {
+        'vpn_users': get_vpn_user_count(),
+        'ssh_users': get_ssh_user_count(processes),
+        'load': get_load(),
+        'cpu_count': get_cpu_count(),
+        # Free memory not counting buffers and cache, as reported by free
+        'memory_free_percent': percent(meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0),
+                                       meminfo['MemTotal']),
+        'swap_free_percent': percent(meminfo.get('SwapFree', 0), meminfo.get('SwapTotal', 0)),
+        'disk_used_percent': percent(disk_used, disk_size),
+        'process_counts': process_counts
+    }
+
+
+if __name__ == "__main__":
+    json.dump(probe(sys.argv[1:]), sys.stdout)
+    sys.stdout.write('\n')
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, Psiphon Inc.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+
+Session and discovery database access.
+
+Each operation is a single round trip to redis: writes use SET with EX (and NX
+where an existing record must be kept), read-and-extend and read-and-delete are
+sent as one MULTI/EXEC pipeline. All stores in a process share one bounded
+connection pool per database.
+
+'''
+
+import json
+import time
+import threading
+import collections
+import redis
+import psi_config
+
+
+# Shared connection pools, keyed by (host, port, db). All stores in any
+# thread share these pools.
+
+_pools_lock = threading.Lock()
+_pools = {}
+
+
+def _get_redis(host, port, db):
+    with _pools_lock:
+        key = (host, port, db)
+        if key not in _pools:
+            _pools[key] = redis.BlockingConnectionPool(
+                                host=host,
+                                port=port,
+                                db=db,
+                                max_connections=psi_config.DB_MAX_CONNECTIONS,
+                                timeout=psi_config.DB_CONNECTION_TIMEOUT_SECONDS)
+        return redis.StrictRedis(connection_pool=_pools[key])
+
+
+def reset_pools():
+    # Connections must not be shared with a forked child process; call this
+    # in the child before using any store
+    with _pools_lock:
+        _pools.clear()
+
+
+class _ExpiringLRUCache(object):
+
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            expiry, value = item
+            if expiry < time.time():
+                return None
+            # Re-insert to mark as most recently used
+            self.items[key] = item
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl_seconds, value)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class SessionStore(object):
+
+    def __init__(self, cache_size=None, cache_ttl_seconds=None):
+        self.redis = _get_redis(psi_config.SESSION_DB_HOST,
+                                psi_config.SESSION_DB_PORT,
+                                psi_config.SESSION_DB_INDEX)
+        if cache_size is None:
+            cache_size = psi_config.SESSION_CACHE_SIZE
+        if cache_ttl_seconds is None:
+            cache_ttl_seconds = psi_config.SESSION_CACHE_TTL_SECONDS
+        # Optional in-process cache of session records, so a burst of
+        # requests in the same session doesn't go to redis for each request.
+        # The TTL is kept much shorter than SESSION_EXPIRE_SECONDS: requests
+        # served from the cache don't extend the redis expiry.
+        self.cache = None
+        if cache_size > 0 and cache_ttl_seconds > 0:
+            self.cache = _ExpiringLRUCache(cache_size, cache_ttl_seconds)
+
+    def get_and_extend(self, session_id):
+        # Returns the raw session record, or None, and extends its expiry
+        if self.cache:
+            record = self.cache.get(session_id)
+            if record is not None:
+                return record
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.get(session_id)
+        pipeline.expire(session_id, psi_config.SESSION_EXPIRE_SECONDS)
+        record, _ = pipeline.execute()
+        if record is not None and self.cache:
+            self.cache.set(session_id, record)
+        return record
+
+    def set(self, session_id, record):
+        self.redis.set(session_id, record, ex=psi_config.SESSION_EXPIRE_SECONDS)
+        if self.cache:
+            self.cache.set(session_id, record)
+
+    def set_if_absent(self, session_id, record):
+        self.redis.set(session_id, record, ex=psi_config.SESSION_EXPIRE_SECONDS, nx=True)
+
+    def delete(self, session_id):
+        if self.cache:
+            self.cache.delete(session_id)
+        self.redis.delete(session_id)
+
+
+class DiscoveryStore(object):
+
+    def __init__(self):
+        self.redis = _get_redis(psi_config.DISCOVERY_DB_HOST,
+                                psi_config.DISCOVERY_DB_PORT,
+                                psi_config.DISCOVERY_DB_INDEX)
+
+    def pop_strategy_value(self, session_id):
+        # Discovery records are discarded immediately after use
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.get(session_id)
+        pipeline.delete(session_id)
+        record, _ = pipeline.execute()
+        if record is None:
+            return None
+        return json.loads(record)['client_ip_address_strategy_value']
+
+    def set_strategy_value_if_absent(self, session_id, client_ip_address_strategy_value):
+        self.redis.set(session_id,
+                       json.dumps({'client_ip_address_strategy_value' : client_ip_address_strategy_value}),
+                       ex=psi_config.DISCOVERY_EXPIRE_SECONDS,
+                       nx=True)
+
+
+def _benchmark(iterations=10000):
+    # Compare the previous command sequences with the store operations for a
+    # status request burst in one session and a handshake. Run against a local
+    # redis-server (or stand-in) at SESSION_DB_HOST:SESSION_DB_PORT.
+    record = json.dumps({'region': 'CA', 'city': 'Toronto', 'isp': 'Example'})
+    session_redis = redis.StrictRedis(
+            host=psi_config.SESSION_DB_HOST,
+            port=psi_config.SESSION_DB_PORT,
+            db=psi_config.SESSION_DB_INDEX)
+    discovery_redis = redis.StrictRedis(
+            host=psi_config.DISCOVERY_DB_HOST,
+            port=psi_config.DISCOVERY_DB_PORT,
+            db=psi_config.DISCOVERY_DB_INDEX)
+    session_id = 'benchmark'
+
+    def legacy_status():
+        if session_redis.get(session_id):
+            session_redis.expire(session_id, psi_config.SESSION_EXPIRE_SECONDS)
+
+    def legacy_handshake():
+        if discovery_redis.get(session_id) == None:
+            discovery_redis.set(session_id, json.dumps({'client_ip_address_strategy_value' : 1}))
+            discovery_redis.expire(session_id, psi_config.DISCOVERY_EXPIRE_SECONDS)
+        if discovery_redis.get(session_id):
+            discovery_redis.delete(session_id)
+
+    uncached_session_store = SessionStore(cache_size=0)
+    cached_session_store = SessionStore()
+    discovery_store = DiscoveryStore()
+
+    def store_handshake():
+        discovery_store.set_strategy_value_if_absent(session_id, 1)
+        discovery_store.pop_strategy_value(session_id)
+
+    session_redis.set(session_id, record)
+    for (name, function) in [
+            ('status (legacy)', legacy_status),
+            ('status (store)', lambda: uncached_session_store.get_and_extend(session_id)),
+            ('status (store, cached)', lambda: cached_session_store.get_and_extend(session_id)),
+            ('handshake discovery (legacy)', legacy_handshake),
+            ('handshake discovery (store)', store_handshake)]:
+        start_time = time.time()
+        for _ in xrange(iterations):
+            function()
+        elapsed = time.time() - start_time
+        print '%-30s %8.1f us/request' % (name, elapsed / iterations * 1000000)
+    session_redis.delete(session_id)
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -15,7 +15,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import types
+import socket
 from OpenSSL import SSL
+from cherrypy import wsgiserver
 
 
 def patch_ssl_adapter(ssl_adapter):
@@ -24,6 +26,17 @@ def patch_ssl_adapter(ssl_adapter):
     ssl_adapter.get_context = types.MethodType(get_context_disallow_SSLv3, ssl_adapter)
 
 
+# Not defined by the Python 2 socket module; this is the Linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def patch_server_reuse_port(server):
+    # Patch CherryPyWSGIServer to set SO_REUSEPORT on its listening socket so
+    # that multiple web server processes can bind the same address and port
+    # and the kernel distributes incoming connections between them
+    server.bind = types.MethodType(bind_reuse_port, server)
+
+
 # This is a modified copy of get_content() from:
 # https://bitbucket.org/cherrypy/cherrypy/src/default/cherrypy/wsgiserver/ssl_pyopenssl.py
 # with SSLv3 disabled.
@@ -64,3 +77,23 @@ def get_context_disallow_SSLv3(self):
         c.load_verify_locations(self.certificate_chain)
     c.use_certificate_file(self.certificate)
     return c
+
+
+# This is a modified copy of HTTPServer.bind() from:
+# https://bitbucket.org/cherrypy/cherrypy/src/default/cherrypy/wsgiserver/wsgiserver2.py
+# with SO_REUSEPORT set. (Same copyright and license as above.)
+
+def bind_reuse_port(self, family, type, proto=0):
+    """Create (or recreate) the actual socket object."""
+    self.socket = socket.socket(family, type, proto)
+    if hasattr(wsgiserver, 'prevent_socket_inheritance'):
+        wsgiserver.prevent_socket_inheritance(self.socket)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1) # PSIPHON
+    if self.nodelay and not isinstance(self.bind_addr, str):
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    if self.ssl_adapter is not None:
+        self.socket = self.ssl_adapter.bind(self.socket)
+
+    self.socket.bind(self.bind_addr)